@@ -1,7 +1,12 @@
 import os
 import sys
-from PIL import Image, ImageTk
-import tkinter as tk
+
+from record_history import RecordHistory
+from vocabulary import parse_allergies, parse_medications
+
+BACKGROUND_IMAGE = "pexels-miguel-á-padriñán-255379.jpg"
+BACKGROUND_MAX_SIZE = (1280, 800)
+CACHE_DIR = os.path.join("medilink_data", "cache")
 
 class MedicalRecordEntry:
     def __init__(self, condition, medications, allergies, timestamp, url=None):
@@ -37,6 +42,7 @@ class HealthcareProvider:
 class HealthLinkSystem:
     def __init__(self):
         self.providers = []
+        self.record_history = RecordHistory()
 
     def register_provider(self, name):
         provider = HealthcareProvider(name)
@@ -50,13 +56,14 @@ class HealthLinkSystem:
 
     def add_medical_record_entry(self, patient):
         condition = input("Enter updated medical condition: ")
-        medications = input("Enter medications (comma-separated): ").split(', ')
-        allergies = input("Enter allergies (comma-separated): ").split(', ')
+        medications = parse_medications(input("Enter medications (comma-separated): "))
+        allergies = parse_allergies(input("Enter allergies (comma-separated): "))
         timestamp = input("Enter the timestamp (optional): ")
         url = input("Enter URL (optional): ")
 
         record_entry = MedicalRecordEntry(condition, medications, allergies, timestamp, url)
         patient.add_medical_record_entry(record_entry)
+        self.record_history.record_added(patient, len(patient.medical_records) - 1)
         print("Medical record has been updated successfully.")
 
     def update_medical_record(self, patient):
@@ -79,12 +86,13 @@ class HealthLinkSystem:
         record_index -= 1  # Adjust to match the list index
 
         condition = input("Enter updated medical condition: ")
-        medications = input("Enter updated medications (comma-separated): ").split(', ')
-        allergies = input("Enter updated allergies (comma-separated): ").split(', ')
+        medications = parse_medications(input("Enter updated medications (comma-separated): "))
+        allergies = parse_allergies(input("Enter updated allergies (comma-separated): "))
         timestamp = input("Enter the timestamp (optional): ")
         url = input("Enter URL (optional): ")
 
-        patient.medical_records[record_index] = MedicalRecordEntry(condition, medications, allergies, timestamp, url)
+        record_entry = MedicalRecordEntry(condition, medications, allergies, timestamp, url)
+        self.record_history.replace_record(patient, record_index, record_entry)
         print("Medical record has been updated successfully.")
 
     def print_medical_records(self, patient):
@@ -113,115 +121,167 @@ def resource_path0(relative_path):
         os.path.dirname(os.path.abspath(__file__)))
     return os.path.join(base_path, relative_path)
 
-# Load the background image
-bg_image_path = resource_path0("pexels-miguel-á-padriñán-255379.jpg")
-bg_image = Image.open(bg_image_path)
-
-healthlink_system = HealthLinkSystem()
-
-# Create Tkinter window
-window = tk.Tk()
-window.title("HealthLink System")
-
-# Set window size to the size of the background image
-window.geometry(f"{bg_image.width}x{bg_image.height}")
-
-# Convert the image for Tkinter
-tk_image = ImageTk.PhotoImage(bg_image)
-
-# Create a label with the background image
-background_label = tk.Label(window, image=tk_image)
-background_label.place(relwidth=1, relheight=1)
-
-provider1 = healthlink_system.register_provider("City Hospital")
-provider2 = healthlink_system.register_provider("General Clinic")
-
-# Main menu for hospitals and patients
-while True:
-    print("\nMain Menu:")
-    print("1. Hospital")
-    print("2. Patient")
-    print("3. Exit")
-    main_choice = input("Enter your choice (1/2/3): ")
-
-    if main_choice == '1':
-        current_provider = None
-        while True:
-            print("\nHospital Menu:")
-            print("1. Switch to City Hospital")
-            print("2. Switch to General Clinic")
-            print("3. Back to Main Menu")
-            hospital_choice = input("Enter your choice (1/2/3): ")
-
-            if hospital_choice == '1':
-                current_provider = provider1
-            elif hospital_choice == '2':
-                current_provider = provider2
-            elif hospital_choice == '3':
-                break
-            else:
-                print("Invalid choice. Please enter 1, 2, or 3.")
-
-            if current_provider:
-                print(f"\nOptions for {current_provider.name}:")
-                print("1. Access Medical Records")
-                print("2. Register a New Patient")
-                print("3. Update Patient Medical Information")
-                print("4. Print Medical Records")
-                print("5. Back to Hospital Menu")
-                provider_choice = input("Enter your choice (1/2/3/4/5): ")
-
-                if provider_choice == '1':
-                    access_code = input("Enter access code: ")
-                    patient = healthlink_system.share_medical_record(access_code, current_provider)
-                    if patient:
-                        healthlink_system.print_medical_records(patient)
-                    else:
-                        print("Access denied. Invalid access code.")
-
-                elif provider_choice == '2':
-                    name = input("Enter patient's name: ")
-                    access_code = input("Set access code for the patient: ")
-                    condition = input("Enter medical condition: ")
-                    medications = input("Enter medications (comma-separated): ").split(', ')
-                    allergies = input("Enter allergies (comma-separated): ").split(', ')
-                    timestamp = input("Enter the timestamp (optional): ")
-                    healthlink_system.register_patient(name, access_code, condition, medications, allergies, timestamp, current_provider)
-
-                elif provider_choice == '3':
-                    access_code = input("Enter access code: ")
-                    patient = healthlink_system.share_medical_record(access_code, current_provider)
-                    if patient:
-                        healthlink_system.update_medical_record(patient)
-                    else:
-                        print("Access denied. Invalid access code.")
+def cached_background_path(source_path, max_size=BACKGROUND_MAX_SIZE):
+    # The cache key changes whenever the source image is replaced or the target size changes
+    stat = os.stat(source_path)
+    name = f"background-{max_size[0]}x{max_size[1]}-{stat.st_size}-{stat.st_mtime_ns}.png"
+    return os.path.join(CACHE_DIR, name)
 
-                elif provider_choice == '4':
-                    access_code = input("Enter access code: ")
-                    patient = healthlink_system.share_medical_record(access_code, current_provider)
-                    if patient:
-                        healthlink_system.print_medical_records(patient)
-                    else:
-                        print("Access denied. Invalid access code.")
+def prepare_background_image(max_size=BACKGROUND_MAX_SIZE):
+    """ Return the path of a downscaled PNG copy of the background, or None if there is no image """
+    source_path = resource_path0(BACKGROUND_IMAGE)
+    if not os.path.exists(source_path):
+        return None
 
-                elif provider_choice == '5':
-                    current_provider = None
+    cache_path = cached_background_path(source_path, max_size)
+    if os.path.exists(cache_path):
+        return cache_path
 
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    with Image.open(source_path) as image:
+        # draft() lets the JPEG decoder scale down while decoding instead of afterwards
+        image.draft('RGB', max_size)
+        image = image.convert('RGB')
+        image.thumbnail(max_size)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        image.save(cache_path, 'PNG')
+    return cache_path
+
+def create_window():
+    import tkinter as tk
+
+    window = tk.Tk()
+    window.title("HealthLink System")
+
+    background_path = prepare_background_image()
+    if background_path:
+        # Tk reads PNG natively, so a cache hit does not need PIL at all
+        tk_image = tk.PhotoImage(file=background_path)
+
+        # Set window size to the size of the background image
+        window.geometry(f"{tk_image.width()}x{tk_image.height()}")
+
+        # Create a label with the background image
+        background_label = tk.Label(window, image=tk_image)
+        background_label.image = tk_image
+        background_label.place(relwidth=1, relheight=1)
+    else:
+        window.geometry("900x600")
+
+    return window
+
+def run_console_menu(healthlink_system, provider1, provider2):
+    # Main menu for hospitals and patients
+    while True:
+        print("\nMain Menu:")
+        print("1. Hospital")
+        print("2. Patient")
+        print("3. Exit")
+        main_choice = input("Enter your choice (1/2/3): ")
+
+        if main_choice == '1':
+            current_provider = None
+            while True:
+                print("\nHospital Menu:")
+                print("1. Switch to City Hospital")
+                print("2. Switch to General Clinic")
+                print("3. Back to Main Menu")
+                hospital_choice = input("Enter your choice (1/2/3): ")
+
+                if hospital_choice == '1':
+                    current_provider = provider1
+                elif hospital_choice == '2':
+                    current_provider = provider2
+                elif hospital_choice == '3':
+                    break
                 else:
-                    print("Invalid choice. Please enter 1, 2, 3, 4, or 5.")
+                    print("Invalid choice. Please enter 1, 2, or 3.")
+
+                if current_provider:
+                    print(f"\nOptions for {current_provider.name}:")
+                    print("1. Access Medical Records")
+                    print("2. Register a New Patient")
+                    print("3. Update Patient Medical Information")
+                    print("4. Print Medical Records")
+                    print("5. Back to Hospital Menu")
+                    provider_choice = input("Enter your choice (1/2/3/4/5): ")
+
+                    if provider_choice == '1':
+                        access_code = input("Enter access code: ")
+                        patient = healthlink_system.share_medical_record(access_code, current_provider)
+                        if patient:
+                            healthlink_system.print_medical_records(patient)
+                        else:
+                            print("Access denied. Invalid access code.")
+
+                    elif provider_choice == '2':
+                        name = input("Enter patient's name: ")
+                        access_code = input("Set access code for the patient: ")
+                        condition = input("Enter medical condition: ")
+                        medications = parse_medications(input("Enter medications (comma-separated): "))
+                        allergies = parse_allergies(input("Enter allergies (comma-separated): "))
+                        timestamp = input("Enter the timestamp (optional): ")
+                        healthlink_system.register_patient(name, access_code, condition, medications, allergies, timestamp, current_provider)
+
+                    elif provider_choice == '3':
+                        access_code = input("Enter access code: ")
+                        patient = healthlink_system.share_medical_record(access_code, current_provider)
+                        if patient:
+                            healthlink_system.update_medical_record(patient)
+                        else:
+                            print("Access denied. Invalid access code.")
+
+                    elif provider_choice == '4':
+                        access_code = input("Enter access code: ")
+                        patient = healthlink_system.share_medical_record(access_code, current_provider)
+                        if patient:
+                            healthlink_system.print_medical_records(patient)
+                        else:
+                            print("Access denied. Invalid access code.")
+
+                    elif provider_choice == '5':
+                        current_provider = None
+
+                    else:
+                        print("Invalid choice. Please enter 1, 2, 3, 4, or 5.")
+
+        elif main_choice == '2':
+            access_code = input("Enter your access code: ")
+            patient = healthlink_system.share_medical_record(access_code, None)
+            if patient:
+                healthlink_system.print_medical_records(patient)
+            else:
+                print("Access denied. Invalid access code.")
+
+        elif main_choice == '3':
+            break
 
-    elif main_choice == '2':
-        access_code = input("Enter your access code: ")
-        patient = healthlink_system.share_medical_record(access_code, None)
-        if patient:
-            healthlink_system.print_medical_records(patient)
         else:
-            print("Access denied. Invalid access code.")
+            print("Invalid choice. Please enter 1, 2, or 3.")
 
-    elif main_choice == '3':
-        break
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
 
-    else:
-        print("Invalid choice. Please enter 1, 2, or 3.")
+    # Create Tkinter window
+    window = create_window()
+
+    if '--gui' in argv:
+        import healthlink_gui
+        healthlink_gui.run(window)
+        return
+
+    healthlink_system = HealthLinkSystem()
+
+    provider1 = healthlink_system.register_provider("City Hospital")
+    provider2 = healthlink_system.register_provider("General Clinic")
+
+    run_console_menu(healthlink_system, provider1, provider2)
+
+    window.mainloop()
 
-window.mainloop()
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+from vocabulary import parse_allergies, parse_medications
+
 class MedicalRecordEntry:
     def __init__(self, condition, medications, allergies, timestamp, url=None):
         self.condition = condition
@@ -45,8 +47,8 @@ class HealthLinkSystem:
 
     def add_medical_record_entry(self, patient):
         condition = input("Enter updated medical condition: ")
-        medications = input("Enter medications (comma-separated): ").split(', ')
-        allergies = input("Enter allergies (comma-separated): ").split(', ')
+        medications = parse_medications(input("Enter medications (comma-separated): "))
+        allergies = parse_allergies(input("Enter allergies (comma-separated): "))
         timestamp = input("Enter the timestamp (optional): ")
         url = input("Enter URL (optional): ")
 
@@ -74,8 +76,8 @@ class HealthLinkSystem:
         record_index -= 1  # Adjust to match the list index
 
         condition = input("Enter updated medical condition: ")
-        medications = input("Enter updated medications (comma-separated): ").split(', ')
-        allergies = input("Enter updated allergies (comma-separated): ").split(', ')
+        medications = parse_medications(input("Enter updated medications (comma-separated): "))
+        allergies = parse_allergies(input("Enter updated allergies (comma-separated): "))
         timestamp = input("Enter the timestamp (optional): ")
         url = input("Enter URL (optional): ")
 
@@ -152,8 +154,8 @@ while True:
                     name = input("Enter patient's name: ")
                     access_code = input("Set access code for the patient: ")
                     condition = input("Enter medical condition: ")
-                    medications = input("Enter medications (comma-separated): ").split(', ')
-                    allergies = input("Enter allergies (comma-separated): ").split(', ')
+                    medications = parse_medications(input("Enter medications (comma-separated): "))
+                    allergies = parse_allergies(input("Enter allergies (comma-separated): "))
                     timestamp = input("Enter the timestamp (optional): ")
                     healthlink_system.register_patient(name, access_code, condition, medications, allergies, timestamp, current_provider)
 
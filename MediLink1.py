@@ -3,12 +3,37 @@ import pickle
 import random
 import string
 import csv
-from datetime import datetime
+import io
+from datetime import datetime, timedelta
+import itertools
 import threading
 import time
 from email.mime.text import MIMEText
 import smtplib
 import json
+from contextlib import contextmanager
+
+import backup
+import codec
+import metrics
+import reports
+from access_control import AccessGuard
+from aggregates import AggregateStats
+from beds import BedManager
+from changefeed import ChangeFeed
+from encryption import (EncryptedPatientStore, Keyring, dump_encrypted, load_encrypted, open_file, seal_file,
+                        update_encrypted)
+from education import EducationCatalog
+from facilities import FacilityRegistry
+from linkage import DEFAULT_THRESHOLD, RecordLinker
+from membership import PatientDirectory
+from record_archive import RecordArchive
+from record_history import RecordHistory
+from refills import RefillQueue
+from timeline import ChangeIndex, PatientTimeline, normalize_timestamp
+import websync
+from vocabulary import ALLERGIES, MEDICATIONS, normalize_record, parse_allergies, parse_medications, term_key
+from transaction import FileGroup, Transaction, atomic_write, recover_file_group
 
 
 class MedicalRecordEntry:
@@ -18,6 +43,13 @@ class MedicalRecordEntry:
         self.allergies = allergies
         self.timestamp = timestamp
 
+    def to_dict(self):
+        return codec.record_to_dict(self)
+
+    @classmethod
+    def from_dict(cls, data):
+        return codec.record_from_dict(data, cls)
+
 
 class Patient:
     def __init__(self, name, access_code, condition, medications, allergies, timestamp):
@@ -26,6 +58,14 @@ class Patient:
         self.medical_records = [MedicalRecordEntry(condition, medications, allergies, timestamp)]
         self.location = None
         self.medication_reminders = []
+        self.appointments = []
+
+    def to_dict(self):
+        return codec.patient_to_dict(self)
+
+    @classmethod
+    def from_dict(cls, data):
+        return codec.patient_from_dict(data, cls, MedicalRecordEntry)
 
     def add_medical_record_entry(self, record_entry):
         self.medical_records.append(record_entry)
@@ -45,43 +85,32 @@ class Patient:
             print("No medication reminders set.")
 
 
+DEFAULT_CATALOG = EducationCatalog()
+# Lists the files of a save that committed; load_data() finishes moving them into place after a crash
+SAVE_JOURNAL = os.path.join("medilink_data", "save.journal")
+
+
 class HealthcareProvider:
-    def __init__(self, name, password):
+    def __init__(self, name, password, directory=None, catalog=None, keyring=None):
         self.name = name
         self.password = password
-        self.patients = []
+        # Set when the system stores data encrypted; snapshots are then sealed too
+        self.keyring = keyring
+        # Shared with HealthLinkSystem once the provider is registered there
+        self.directory = directory if directory is not None else PatientDirectory()
         self.appointments = []
-        self.education_resources = {
-            'Diabetes': 'https://www.diabetes.org/diabetes',
-            'Hypertension': 'https://www.heart.org/en/health-topics/high-blood-pressure',
-            'Asthma': 'https://www.lung.org/lung-health-diseases/lung-disease-lookup/asthma',
-            'Obesity': 'https://www.cdc.gov/obesity/index.html',
-            'Heart Disease': 'https://www.nhlbi.nih.gov/health-topics/heart-disease',
-            'Arthritis': 'https://www.arthritis.org/health-wellness',
-            'Depression': 'https://www.nimh.nih.gov/health/topics/depression',
-            'Anxiety Disorders': 'https://adaa.org/understanding-anxiety',
-            'Alzheimer\'s Disease': 'https://www.alz.org/alzheimers-dementia/what-is-alzheimers',
-            'Osteoporosis': 'https://www.bones.nih.gov/health-info/bone/osteoporosis/overview',
-            'Chronic Kidney Disease': 'https://www.kidney.org/atoz/content/about-chronic-kidney-disease',
-            'COPD': 'https://www.copdfoundation.org/What-is-COPD/Understanding-COPD/What-is-COPD.aspx',
-            'Hepatitis': 'https://www.cdc.gov/hepatitis/index.htm',
-            'HIV/AIDS': 'https://www.hiv.gov/hiv-basics',
-            'Parkinson\'s Disease': 'https://www.parkinson.org/understanding-parkinsons',
-            'Multiple Sclerosis': 'https://www.nationalmssociety.org/What-is-MS',
-            'Celiac Disease': 'https://celiac.org/about-celiac-disease/what-is-celiac-disease/',
-            'Fibromyalgia': 'https://www.fmcpaware.org/aboutfibromyalgia',
-            'Lupus': 'https://www.lupus.org/resources/what-is-lupus',
-            'Epilepsy': 'https://www.epilepsy.com/learn/about-epilepsy-basics'
-        }
+        self.education_resources = (catalog if catalog is not None else DEFAULT_CATALOG).provider_view()
+
+    @property
+    def patients(self):
+        return self.directory.patients_of(self.name)
 
+    @metrics.timed('lookup', 'provider_access_medical_record')
     def access_medical_record(self, access_code):
-        for patient in self.patients:
-            if patient.access_code == access_code:
-                return patient
-        return None
+        return self.patients.get(access_code)
 
     def add_patient(self, patient):
-        self.patients.append(patient)
+        self.directory.attach(self.name, patient)
 
     def save_patient_record(self, patient):
         # Serialize patient data and save to file
@@ -90,6 +119,11 @@ class HealthcareProvider:
             os.makedirs(patient_folder)
 
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        if self.keyring is not None:
+            file_name = os.path.join(patient_folder, f"{timestamp}.enc")
+            with open(file_name, 'wb') as f:
+                f.write(seal_file(self.keyring, file_name, json.dumps(patient.to_dict()).encode('utf-8')))
+            return
         file_name = os.path.join(patient_folder, f"{timestamp}.json")
         with open(file_name, 'w') as f:
             json.dump(patient.to_dict(), f)
@@ -106,13 +140,14 @@ class HealthcareProvider:
             print("No patients found.")
 
     def delete_patient_data(self, access_code):
-        for patient in self.patients:
-            if access_code == patient.access_code:
-                self.patients.remove(patient)
-                print(f"Patient data with access code {access_code} deleted.")
-                return
+        if access_code in self.patients:
+            # Removes the patient from every provider and from HealthLinkSystem as well
+            self.directory.remove(access_code)
+            print(f"Patient data with access code {access_code} deleted.")
+            return
         print("Access code not found. No patient data deleted.")
 
+    @metrics.timed('search')
     def search_patient(self, keyword):
         found = False
         for patient in self.patients:
@@ -125,98 +160,360 @@ class HealthcareProvider:
 
 
 class HealthLinkSystem:
-    def __init__(self):
+    def __init__(self, start_backup=True, storage_format=None):
         self.providers = []
         self.staff_profiles = []
         self.appointment_reminders = {}
         self.users = {}
         self.patients = {}
         self.inventory = {}  # Add this line
-        self.bed_occupancy = {}  # Add this line
+        self.beds = BedManager()
+        self.education_catalog = EducationCatalog()
+        self.directory = PatientDirectory()
+        self.directory.removal_listeners.append(self.forget_patient)
+        # 'json' (default), 'binary' (the faster codec.dump_binary format) or 'encrypted'
+        self.storage_format = storage_format or os.getenv('MEDILINK_STORAGE_FORMAT', 'json')
+        self.keyring = Keyring.load() if self.storage_format == 'encrypted' else None
+        self.encrypted_store = None
+        # In encrypted mode every file below seals its contents with the same keyring
+        archive_name = "record_archive.enc" if self.keyring is not None else "record_archive.bin"
+        self.archive = RecordArchive(os.path.join("medilink_data", archive_name), self.keyring)
+        self.seal_plain_archive()
+        # History positions count a patient's archived records first, so archiving moves them (see reindex)
+        self.record_history = RecordHistory(os.path.join("medilink_data", "record_history.jsonl"),
+                                            self.archive.count, self.keyring)
+        self.changes = ChangeFeed(os.path.join("medilink_data", "changes.jsonl"), self.keyring)
+        self.access_guard = AccessGuard()
+        self.refills = RefillQueue(os.path.join("medilink_data", "refills.jsonl"), self.keyring)
+        self.record_history.buffer = lambda: self.transaction_buffer('record_history')
+        self.changes.buffer = lambda: self.transaction_buffer('changes')
+        # Read from medilink_data/facilities.csv on first use
+        self.facilities = None
+        # Built on first duplicate search, then kept up to date by index_patient and forget_patient
+        self.linker = None
+        # Per-patient sorted records, built when a patient is first queried by time
+        self.timelines = {}
+        # Every record by the time it last changed, built on the first "changed since" query
+        self.change_index = None
+        # Records older than this many days move to the archive on each backup; unset disables it
+        archive_after_days = os.getenv('MEDILINK_ARCHIVE_AFTER_DAYS')
+        self.archive_after_days = int(archive_after_days) if archive_after_days else None
+        # A compressed backup (see backup.py) is taken every this many minutes; unset or 0 disables it
+        backup_minutes = os.getenv('MEDILINK_BACKUP_INTERVAL_MINUTES')
+        self.backup_interval = int(backup_minutes) * 60 if backup_minutes else None
+        self.backups_kept = int(os.getenv('MEDILINK_BACKUPS_KEPT', '48'))
+        # Seconds between the background thread's saves
+        self.save_interval = 300
+        # Set to end periodic_backup after its current round
+        self.backup_stop = threading.Event()
+        # Held while a transaction is open or data is being saved, so backups never see half a batch
+        self.lock = threading.RLock()
+        self.active_transaction = None
         self.load_data()
+        if self.keyring is not None:
+            self.remove_plain_files()
 
-        self.backup_thread = threading.Thread(target=self.periodic_backup)
-        self.backup_thread.daemon = True
-        self.backup_thread.start()
+        self.backup_thread = None
+        if start_backup:
+            self.backup_thread = threading.Thread(target=self.periodic_backup, name='backup')
+            self.backup_thread.daemon = True
+            self.backup_thread.start()
 
     def periodic_backup(self):
+        last_backup = time.monotonic()
         while True:
+            if self.archive_after_days is not None:
+                self.archive_old_records()
+            with self.lock:
+                self.save_data()
+            if self.archive.dead_bytes:
+                # Deleted patients' archived records are removed in one batch per save
+                self.archive.compact()
+            if self.backup_interval and time.monotonic() - last_backup >= self.backup_interval:
+                backup.create_backup(self, keep=self.backups_kept)
+                last_backup = time.monotonic()
+            if self.backup_stop.wait(self.save_interval):
+                break
+
+    def remove_plain_files(self):
+        # Plaintext files from before encrypted mode was switched on were read by load_data; seal them and drop them
+        paths = [path for path in ('patients.json', 'patients.bin', 'memberships.json', 'state.json', 'users.json',
+                                   'patient_stats.json', 'patient_data.csv',
+                                   os.path.join("medilink_data", "staff_profiles.pkl"))
+                 if os.path.exists(path)]
+        if paths:
             self.save_data()
-            time.sleep(300)  # Save data every 5 minutes
-
+            for path in paths:
+                os.remove(path)
+
+    def seal_plain_archive(self):
+        # Records archived before encrypted mode was switched on move into the sealed archive
+        plain_path = os.path.join("medilink_data", "record_archive.bin")
+        if self.keyring is None or self.archive.size or not os.path.exists(plain_path):
+            return
+        plain = RecordArchive(plain_path)
+        self.archive.append_many([(code, list(plain.iter_records(code, MedicalRecordEntry))) for code in plain.index])
+        plain.close()
+        os.remove(plain_path)
+
+    @metrics.timed('load')
     def load_data(self):
-        if os.path.exists('patients.json'):
+        recover_file_group(SAVE_JOURNAL)
+        self.close_encrypted_store()
+        self.all_patients_loaded = True
+        # A JSON file is still read when binary or encrypted storage is selected but its file does not exist yet
+        if self.keyring is not None and os.path.exists('patients.enc'):
+            # Nobody is decrypted yet: access_medical_record opens one patient at a time,
+            # and load_all_patients() the rest once something needs every patient
+            self.patients = {}
+            self.all_patients_loaded = False
+            metrics.set_gauge('patients', len(self.stored_patients()))
+        elif self.storage_format == 'binary' and os.path.exists('patients.bin'):
+            with open('patients.bin', 'rb') as f:
+                self.patients = codec.load_binary(f, Patient, MedicalRecordEntry)
+            metrics.set_gauge('patients', len(self.patients))
+        elif os.path.exists('patients.json'):
             with open('patients.json', 'r') as f:
-                patient_data = json.load(f)
-                self.patients = {}
-                for name, data in patient_data.items():
-                    patient = Patient(
-                        name=data['name'],
-                        access_code=data['access_code'],
-                        condition=data['medical_records'][0]['condition'],
-                        medications=data['medical_records'][0]['medications'],
-                        allergies=data['medical_records'][0]['allergies'],
-                        timestamp=datetime.strptime(data['medical_records'][0]['timestamp'], "%Y-%m-%d %H:%M:%S")
-                    )
-                    for record in data['medical_records'][1:]:
-                        patient.add_medical_record_entry(MedicalRecordEntry(
-                            condition=record['condition'],
-                            medications=record['medications'],
-                            allergies=record['allergies'],
-                            timestamp=datetime.strptime(record['timestamp'], "%Y-%m-%d %H:%M:%S")
-                        ))
-                    self.patients[name] = patient
+                self.patients = codec.load_json(f, Patient, MedicalRecordEntry)
+            metrics.set_gauge('patients', len(self.patients))
+
+        self.index_all_patients()
+
+        state = self.read_json_file('state') or {}
+        self.appointment_reminders = state.get('appointment_reminders', {})
+        self.inventory = state.get('inventory', {})
+        self.beds = BedManager.from_dict(state.get('beds'))
+        # Refill batches committed after the state file was last saved
+        self.refills.apply_stock(self.inventory, state.get('refill_sequence', 0))
 
         self.load_staff_profiles()
 
+    def index_all_patients(self):
+        memberships = self.read_json_file('memberships') or {}
+        self.directory.reset(self.patients.values(), memberships)
+        self.linker = None
+        self.timelines = {}
+        self.change_index = None
+        self.normalize_terms(self.patients.values())
+        self.stats = AggregateStats.build((patient, patient_records(patient, self.archive))
+                                          for patient in self.directory.patients.values())
+
+    def load_all_patients(self):
+        """Decrypt the patients load_data() left sealed; does nothing once every patient is loaded."""
+        with self.lock:
+            if self.all_patients_loaded:
+                return
+            with open('patients.enc', 'rb') as f:
+                patients = load_encrypted(f, self.keyring, Patient, MedicalRecordEntry)
+            # Patients already opened for a lookup may have changed since, so those objects stay
+            opened = {patient.access_code for patient in self.patients.values()}
+            self.patients.update((name, patient) for name, patient in patients.items()
+                                 if patient.access_code not in opened)
+            self.all_patients_loaded = True
+            # Memberships cannot change before this, so the saved ones are still current
+            self.index_all_patients()
+            metrics.set_gauge('patients', len(self.patients))
+
+    def read_json_file(self, name):
+        """Read ``name``.json, or the sealed ``name``.enc in encrypted mode; None if it does not exist."""
+        if self.keyring is not None and os.path.exists(f'{name}.enc'):
+            return json.loads(open_file(self.keyring, f'{name}.enc'))
+        if os.path.exists(f'{name}.json'):
+            with open(f'{name}.json', 'r') as f:
+                return json.load(f)
+        return None
+
+    def write_json_file(self, name, data, write=atomic_write):
+        # ``write`` is atomic_write or a FileGroup's write, with the same arguments
+        if self.keyring is not None:
+            with write(f'{name}.enc', 'wb') as f:
+                f.write(seal_file(self.keyring, f'{name}.enc', json.dumps(data).encode('utf-8')))
+        else:
+            with write(f'{name}.json') as f:
+                json.dump(data, f)
+
+    def state_to_dict(self):
+        # Everything besides patients, memberships, users and staff that save_data() keeps
+        return {
+            'appointment_reminders': self.appointment_reminders,
+            'inventory': self.inventory,
+            'beds': self.beds.to_dict(),
+            'refill_sequence': self.refills.sequence,
+        }
+
+    @metrics.timed('save')
     def save_data(self):
-        user_data = {username: user.to_dict() for username, user in self.users.items()}
-        with open('users.json', 'w') as f:
-            json.dump(user_data, f)
+        # One save at a time: concurrent saves would write the same .tmp files
+        with self.lock:
+            # All files are replaced together, so a crash never leaves patients and memberships out of step
+            with FileGroup(SAVE_JOURNAL) as group:
+                user_data = {username: user.to_dict() for username, user in self.users.items()}
+                self.write_json_file('users', user_data, group.write)
+
+                if self.keyring is not None:
+                    with group.write('patients.enc', 'wb') as f:
+                        if self.all_patients_loaded:
+                            dump_encrypted(self.patients.values(), f, self.keyring)
+                        else:
+                            # Only the patients opened so far are sealed again; the others are copied as stored
+                            update_encrypted(self.stored_patients(), self.patients.values(), f, self.keyring)
+                elif self.storage_format == 'binary':
+                    with group.write('patients.bin', 'wb') as f:
+                        codec.dump_binary(self.patients.values(), f)
+                else:
+                    with group.write('patients.json') as f:
+                        codec.dump_json(self.patients.values(), f)
+
+                if self.all_patients_loaded:
+                    # Before that the directory holds only the opened patients, and their memberships are unchanged
+                    self.write_json_file('memberships', self.directory.memberships_to_dict(), group.write)
+                self.write_json_file('state', self.state_to_dict(), group.write)
+
+                self.save_staff_profiles(group.write)
+            # Its offsets belong to the patients.enc that was just replaced
+            self.close_encrypted_store()
+
+    @contextmanager
+    def transaction(self):
+        """Group several changes into one save.
+
+        Everything inside the block is written with a single save_data() when it
+        exits. If the block (or the save) raises, every change made through the
+        system's methods is undone and nothing is written. Nested blocks join the
+        outer transaction.
+        """
+        with self.lock:
+            if self.current_transaction() is not None:
+                yield self.active_transaction
+                return
+            tx = self.active_transaction = Transaction()
+            try:
+                yield tx
+                if tx.dirty:
+                    self.save_data()
+            except BaseException:
+                try:
+                    # Still active, so the undo actions' history lines and events land in the buffers that are dropped
+                    tx.rollback()
+                finally:
+                    self.active_transaction = None
+                # Only the moves of records that were archived anyway are still written
+                self.record_history.write_lines(self.record_history.discard_lines(tx.buffer('record_history')))
+                raise
+            self.active_transaction = None
+            self.record_history.write_lines(tx.buffer('record_history'))
+            self.changes.write_events(tx.buffer('changes'))
+            tx.run_commit_hooks()
+
+    def transaction_buffer(self, name):
+        # Lines written inside this thread's transaction wait in it until commit
+        tx = self.current_transaction()
+        return tx.buffer(name) if tx is not None else None
+
+    def current_transaction(self):
+        # Only the thread that opened the transaction is part of it
+        tx = self.active_transaction
+        return tx if tx is not None and tx.owner == threading.get_ident() else None
+
+    def persist(self):
+        tx = self.current_transaction()
+        if tx is not None:
+            tx.dirty = True
+        else:
+            self.save_data()
 
-        patient_data = {patient.name: patient.to_dict() for patient in self.patients.values()}
-        with open('patients.json', 'w') as f:
-            json.dump(patient_data, f)
+    def record_undo(self, action):
+        tx = self.current_transaction()
+        if tx is not None:
+            tx.add_undo(action)
 
-        self.save_staff_profiles()
+    def after_commit(self, hook):
+        """Run ``hook`` once the current transaction commits, or right away outside one."""
+        tx = self.current_transaction()
+        if tx is not None:
+            tx.add_commit_hook(hook)
+        else:
+            hook()
 
+    @metrics.timed('load')
     def load_staff_profiles(self):
-        filename = os.path.join("medilink_data", "staff_profiles.pkl")  # Updated path
+        filename = self.staff_profiles_path()
         if os.path.exists(filename):
             print(f"Loading staff profiles from {filename}")
             try:
-                with open(filename, 'rb') as f:
-                    self.staff_profiles = pickle.load(f)
-                    print("Staff profiles loaded successfully.")
+                if self.keyring is not None:
+                    self.staff_profiles = pickle.loads(open_file(self.keyring, filename))
+                else:
+                    with open(filename, 'rb') as f:
+                        self.staff_profiles = pickle.load(f)
+                metrics.set_gauge('staff_profiles', len(self.staff_profiles))
+                print("Staff profiles loaded successfully.")
             except EOFError:
+                metrics.increment('staff_profile_load_errors')
                 print("Staff profile file is empty or corrupted.")
                 self.staff_profiles = []
             except Exception as e:
+                metrics.increment('staff_profile_load_errors')
                 print(f"An error occurred while loading staff profiles: {e}")
                 self.staff_profiles = []
         else:
             print("Staff profile file does not exist.")
             self.staff_profiles = []
 
-    def save_staff_profiles(self):
-        filename = os.path.join("medilink_data", "staff_profiles.pkl")  # Updated path
-        with open(filename, 'wb') as f:
-            pickle.dump(self.staff_profiles, f)
+    @metrics.timed('save')
+    def save_staff_profiles(self, write=atomic_write):
+        filename = self.staff_profiles_path()
+        with write(filename, 'wb') as f:
+            if self.keyring is not None:
+                f.write(seal_file(self.keyring, filename, pickle.dumps(self.staff_profiles)))
+            else:
+                pickle.dump(self.staff_profiles, f)
+
+    def staff_profiles_path(self):
+        name = "staff_profiles.enc" if self.keyring is not None else "staff_profiles.pkl"
+        return os.path.join("medilink_data", name)  # Updated path
 
+    @metrics.timed('load')
     def load_patient_records(self):
         for root, dirs, files in os.walk(os.path.join("medilink_data", "Patient_Records")):  # Updated path
-            for file in files:
-                if file.endswith(".json"):
-                    file_path = os.path.join(root, file)
+            # Snapshot names are timestamps, so the newest snapshot of a patient is loaded last
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                if file.endswith(".enc") and self.keyring is not None:
+                    patient_data = json.loads(open_file(self.keyring, file_path))
+                elif file.endswith(".json"):
                     with open(file_path, 'r') as f:
                         patient_data = json.load(f)
-                        patient = Patient.from_dict(patient_data)
-                        self.patients[patient.name] = patient
-                        for provider in self.providers:
-                            provider.add_patient(patient)
+                else:
+                    continue
+                patient = Patient.from_dict(patient_data)
+                self.normalize_terms([patient])
+                self.patients[patient.name] = patient
+                self.index_patient(patient)
+                if not self.directory.providers_of(patient.access_code) and self.providers:
+                    self.providers[0].add_patient(patient)
+
+    def normalize_terms(self, patients):
+        """Normalize and intern the medications and allergies of ``patients``' live records."""
+        changed = 0
+        for patient in patients:
+            for record in patient.medical_records:
+                changed += normalize_record(record)
+        metrics.increment('records_renormalized', changed)
+        return changed
+
+    def renormalize_stored_data(self):
+        """Normalize every stored record and save once if anything changed; returns the number changed."""
+        self.load_all_patients()
+        changed = self.normalize_terms(self.directory.patients.values())
+        if changed:
+            self.stats = AggregateStats.build((patient, patient_records(patient, self.archive))
+                                              for patient in self.directory.patients.values())
+            self.persist()
+        return changed
 
     def register_provider(self, name, password):
-        provider = HealthcareProvider(name, password)
+        provider = HealthcareProvider(name, password, self.directory, self.education_catalog, self.keyring)
         self.providers.append(provider)
         return provider
 
@@ -226,6 +523,7 @@ class HealthLinkSystem:
         self.staff_profiles.append({'name': name, 'password': password})
         print("Profile created successfully.")
 
+    @metrics.timed('lookup')
     def authenticate_provider(self, name, password):
         for profile in self.staff_profiles:
             if profile['name'] == name and profile['password'] == password:
@@ -233,20 +531,39 @@ class HealthLinkSystem:
         return False
 
     def schedule_appointment(self, patient, date):
+        self.undo_reminder_change(patient)
         self.appointment_reminders[patient.name] = date
-        self.send_appointment_reminder(patient, date)
+        self.publish_appointment(patient, 'scheduled', date)
+        self.after_commit(lambda: self.send_appointment_reminder(patient, date))
 
     def reschedule_appointment(self, patient, new_date):
+        self.undo_reminder_change(patient)
         self.appointment_reminders[patient.name] = new_date
-        self.send_appointment_reminder(patient, new_date)
+        self.publish_appointment(patient, 'rescheduled', new_date)
+        self.after_commit(lambda: self.send_appointment_reminder(patient, new_date))
 
     def cancel_appointment(self, patient):
         if patient.name in self.appointment_reminders:
-            del self.appointment_reminders[patient.name]
+            self.undo_reminder_change(patient)
+            date = self.appointment_reminders.pop(patient.name)
+            self.publish_appointment(patient, 'cancelled', date)
             print("Appointment cancelled.")
         else:
             print("No appointment found to cancel.")
 
+    def publish_appointment(self, patient, action, appointment):
+        self.changes.emit('appointment_changed', access_code=patient.access_code, action=action)
+
+    def undo_reminder_change(self, patient):
+        if self.current_transaction() is None:
+            return
+        if patient.name in self.appointment_reminders:
+            previous = self.appointment_reminders[patient.name]
+            self.record_undo(lambda: self.appointment_reminders.__setitem__(patient.name, previous))
+        else:
+            self.record_undo(lambda: self.appointment_reminders.pop(patient.name, None))
+
+    @metrics.timed('reminder')
     def send_appointment_reminder(self, patient, date):
         if hasattr(patient, 'email') and patient.email:
             msg = MIMEText(f"Reminder: Your appointment is scheduled for {date}.")
@@ -265,10 +582,13 @@ class HealthLinkSystem:
                     if smtp_username and smtp_password:
                         server.login(smtp_username, smtp_password)
                     server.send_message(msg)
+                metrics.increment('reminders_sent')
                 print(f"Appointment reminder sent to {patient.email}.")
             except Exception as e:
+                metrics.increment('reminders_failed')
                 print(f"Failed to send appointment reminder: {str(e)}")
         else:
+            metrics.increment('reminders_skipped')
             print("Patient email not set. Cannot send reminder.")
 
     def generate_patient_report(self):
@@ -276,9 +596,9 @@ class HealthLinkSystem:
         if patient_name in self.patients:
             patient = self.patients[patient_name]
             print(f"Generating patient report for {patient.name}...")
-            if patient.medical_records:
+            if patient.medical_records or self.archive.count(patient.access_code):
                 print(f"Patient Report for {patient.name}:")
-                for record in patient.medical_records:
+                for record in patient_records(patient, self.archive):
                     print(f"Condition: {record.condition}")
                     print(f"Medications: {', '.join(record.medications)}")
                     print(f"Allergies: {', '.join(record.allergies)}")
@@ -289,45 +609,360 @@ class HealthLinkSystem:
         else:
             print("Patient not found. Unable to generate the report.")
 
-    def export_patient_data(self):
-        with open('patient_data.csv', 'w', newline='') as csvfile:
+    @metrics.timed('export')
+    def export_patient_data(self, since=None):
+        self.load_all_patients()
+        # With ``since``, only the records added or edited from then on are exported
+        if since is not None:
+            rows = [(patient, record) for _, patient, record in self.records_changed_since(since)]
+        else:
+            rows = ((patient, record) for patient in self.patients.values()
+                    for record in patient_records(patient, self.archive))
+        # In encrypted mode the export is sealed too, as patient_data.csv.enc
+        csvfile = open('patient_data.csv', 'w', newline='') if self.keyring is None else io.StringIO(newline='')
+        with csvfile:
             fieldnames = ['Name', 'Access Code', 'Condition', 'Medications', 'Allergies', 'Timestamp']
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
-            for patient in self.patients.values():
-                for record in patient.medical_records:
-                    writer.writerow({
-                        'Name': patient.name,
-                        'Access Code': patient.access_code,
-                        'Condition': record.condition,
-                        'Medications': ', '.join(record.medications),
-                        'Allergies': ', '.join(record.allergies),
-                        'Timestamp': record.timestamp
-                    })
+            for patient, record in rows:
+                writer.writerow({
+                    'Name': patient.name,
+                    'Access Code': patient.access_code,
+                    'Condition': record.condition,
+                    'Medications': ', '.join(record.medications),
+                    'Allergies': ', '.join(record.allergies),
+                    'Timestamp': record.timestamp
+                })
+            if self.keyring is not None:
+                with atomic_write('patient_data.csv.enc', 'wb') as f:
+                    f.write(seal_file(self.keyring, 'patient_data.csv.enc', csvfile.getvalue().encode('utf-8')))
+        if self.keyring is not None:
+            self.write_json_file('patient_stats', self.stats.to_dict(self.provider_patient_counts()))
+        else:
+            self.stats.dump('patient_stats.json', self.provider_patient_counts())
+
+    def select_report_patients(self, provider_name=None, condition=None, changed_since=None):
+        """Patients for a batch report: one provider's or everyone, optionally only those with ``condition``
+        or with records changed since ``changed_since``."""
+        self.load_all_patients()
+        if provider_name:
+            patients = list(self.directory.patients_of(provider_name))
+        else:
+            patients = list(self.directory.patients.values())
+        if changed_since is not None:
+            changed = {patient.access_code for patient in self.patients_changed_since(changed_since)}
+            patients = [patient for patient in patients if patient.access_code in changed]
+        if condition:
+            key = term_key(condition)
+            patients = [patient for patient in patients
+                        if any(term_key(record.condition or '') == key
+                               for record in patient_records(patient, self.archive))]
+        return patients
+
+    @metrics.timed('export')
+    def generate_batch_reports(self, patients, output_dir='reports', formats=('text',), workers=None, progress=None):
+        """Write reports for ``patients`` to one file per format; returns {format: path}."""
+        rows = [reports.patient_row(patient, patient_records(patient, self.archive)) for patient in patients]
+        paths = reports.generate_reports(rows, output_dir, formats, workers=workers, progress=progress)
+        metrics.increment('patient_reports', len(rows))
+        return paths
+
+    @metrics.timed('save')
+    def archive_old_records(self, max_age_days=None):
+        self.load_all_patients()
+        if max_age_days is None:
+            max_age_days = self.archive_after_days if self.archive_after_days is not None else 365
+        cutoff = datetime.now() - timedelta(days=max_age_days)
+        with self.lock:
+            batches = []
+            moves = {}
+            for patient in self.directory.patients.values():
+                old = [record for record in patient.medical_records
+                       if isinstance(record.timestamp, datetime) and record.timestamp < cutoff]
+                if old:
+                    batches.append((patient.access_code, old))
+                    # Archived records go to the end of the archive, the rest follow them in their order
+                    archived = self.archive.count(patient.access_code)
+                    moved, kept = archived, archived + len(old)
+                    patient_moves = moves[patient.access_code] = {}
+                    for index, record in enumerate(patient.medical_records):
+                        if isinstance(record.timestamp, datetime) and record.timestamp < cutoff:
+                            patient_moves[archived + index] = moved
+                            moved += 1
+                        else:
+                            patient_moves[archived + index] = kept
+                            kept += 1
+                    patient.medical_records = [record for record in patient.medical_records
+                                               if not (isinstance(record.timestamp, datetime) and record.timestamp < cutoff)]
+            self.archive.append_many(batches)
+            self.record_history.reindex(moves)
+        if batches:
+            # Archived records are read back as new objects, so both indexes start again
+            self.timelines = {}
+            self.change_index = None
+        moved = sum(len(records) for _, records in batches)
+        metrics.increment('records_archived', moved)
+        if moved:
+            self.persist()
+        return moved
+
+    @property
+    def education_resources(self):
+        return self.education_catalog.resources
 
     def add_health_education_resources(self, condition, url):
-        for provider in self.providers:
-            provider.education_resources[condition] = url
+        # Every provider reads the shared catalog, so one write reaches all of them
+        self.education_catalog.add(condition, url)
 
     def view_health_education_resources(self):
         print("Health Education Resources:")
-        for provider in self.providers:
-            for condition, url in provider.education_resources.items():
-                print(f"{condition}: {url}")
+        for condition, url in self.education_catalog.resources.items():
+            print(f"{condition}: {url}")
 
+    @metrics.timed('lookup')
     def access_medical_record(self, access_code):
-        for patient in self.patients.values():
-            if patient.access_code == access_code:
-                return patient
-        return None
-
-    def add_patient(self, patient):
+        patient = self.directory.get(access_code)
+        if patient is None and not self.all_patients_loaded:
+            patient = self.read_stored_patient(access_code)
+            if patient is not None:
+                # Kept, so later lookups, saves and load_all_patients() use this object
+                self.normalize_terms([patient])
+                self.patients[patient.name] = patient
+                self.directory.add(patient)
+        return patient
+
+    def read_stored_patient(self, access_code):
+        """Decrypt one patient straight from patients.enc, without loading or decrypting the others."""
+        if self.keyring is None or not os.path.exists('patients.enc'):
+            return None
+        return self.stored_patients().get(access_code, Patient, MedicalRecordEntry)
+
+    def stored_patients(self):
+        if self.encrypted_store is None:
+            self.encrypted_store = EncryptedPatientStore('patients.enc', self.keyring)
+        return self.encrypted_store
+
+    def close_encrypted_store(self):
+        if self.encrypted_store is not None:
+            self.encrypted_store.close()
+            self.encrypted_store = None
+
+    def verify_access(self, access_code, client, provider=None):
+        """Look up a patient for an access code typed by ``client``; None if wrong or rate limited."""
+        if provider is not None:
+            return self.access_guard.verify(client, access_code, provider.access_medical_record, provider.name)
+        return self.access_guard.verify(client, access_code, self.access_medical_record)
+
+    @metrics.timed('search')
+    def find_patients(self, keyword):
+        self.load_all_patients()
+        keyword = keyword.lower()
+        return [patient for patient in self.patients.values() if keyword in patient.name.lower()]
+
+    def add_patient(self, patient, provider=None):
+        self.load_all_patients()
+        self.normalize_terms([patient])
+        if self.current_transaction() is not None:
+            previous = self.patients.get(patient.name)
+            self.record_undo(lambda: self.undo_add_patient(patient, previous))
         self.patients[patient.name] = patient
-        if self.providers:
+        self.index_patient(patient)
+        self.changes.emit('patient_added', access_code=patient.access_code, records=len(patient.medical_records))
+        if self.change_index is not None:
+            now = datetime.now()
+            for record in patient.medical_records:
+                self.change_index.add(now, patient.access_code, record)
+        if provider is not None:
+            provider.add_patient(patient)
+        elif self.providers:
             self.providers[0].add_patient(patient)
         else:
             print("No healthcare providers registered. Cannot add patient.")
 
+    def index_patient(self, patient):
+        # Adds the patient to the directory and to the aggregate counters, replacing any patient with the same code
+        self.access_guard.forget_code(patient.access_code)
+        current = self.directory.get(patient.access_code)
+        if current is not patient:
+            self.timelines.pop(patient.access_code, None)
+            if current is not None:
+                self.stats.remove_patient(current, patient_records(current, self.archive))
+            self.stats.add_patient(patient, patient_records(patient, self.archive))
+            if self.linker is not None:
+                if current is not None:
+                    self.linker.remove(current)
+                self.linker.add(patient)
+        self.directory.add(patient)
+
+    def undo_add_patient(self, patient, previous):
+        self.directory.remove(patient.access_code)
+        if previous is not None:
+            self.patients[previous.name] = previous
+            self.index_patient(previous)
+
+    def delete_patient(self, access_code):
+        self.load_all_patients()
+        if self.current_transaction() is not None:
+            patient = self.directory.get(access_code)
+            if patient is not None:
+                providers = self.directory.providers_of(access_code)
+                reminder = self.appointment_reminders.get(patient.name)
+                self.record_undo(lambda: self.restore_patient(patient, providers, reminder))
+        return self.directory.remove(access_code)
+
+    def restore_patient(self, patient, provider_names, reminder=None):
+        self.patients[patient.name] = patient
+        self.index_patient(patient)
+        for provider_name in provider_names:
+            self.directory.attach(provider_name, patient)
+        if reminder is not None:
+            self.appointment_reminders[patient.name] = reminder
+
+    def forget_patient(self, patient):
+        # Called by the directory after a patient is deleted, to drop every other reference
+        if self.patients.get(patient.name) is patient:
+            del self.patients[patient.name]
+        self.appointment_reminders.pop(patient.name, None)
+        self.release_bed(patient.access_code)
+        self.stats.remove_patient(patient, patient_records(patient, self.archive))
+        if self.linker is not None:
+            self.linker.remove(patient)
+        self.timelines.pop(patient.access_code, None)
+        self.changes.emit('patient_deleted', access_code=patient.access_code)
+        # Kept until commit so a rolled back delete still finds the archived records
+        self.after_commit(lambda: self.archive.forget(patient.access_code))
+
+    def record_linker(self):
+        self.load_all_patients()
+        if self.linker is None:
+            self.linker = RecordLinker(lambda patient: patient_records(patient, self.archive))
+            for patient in self.directory.patients.values():
+                self.linker.add(patient)
+        return self.linker
+
+    @metrics.timed('search')
+    def find_duplicate_patients(self, threshold=DEFAULT_THRESHOLD):
+        return self.record_linker().duplicates(threshold)
+
+    def name_taken(self, name, access_code):
+        # Patients are saved by name, so a second patient with the same name would replace the first
+        self.load_all_patients()
+        existing = self.patients.get(name)
+        return existing is not None and existing.access_code != access_code
+
+    def possible_duplicates(self, patient, threshold=DEFAULT_THRESHOLD):
+        return self.record_linker().matches(patient, threshold)
+
+    def merge_patients(self, keep_code, merge_code):
+        """Fold the patient ``merge_code`` into ``keep_code`` and delete it; returns the kept patient.
+
+        The kept patient gains the other's records, reminders, appointments and
+        provider memberships, and its bed or wait-list place if it has none.
+        Archived records are copied under the kept code once the change commits.
+        """
+        self.load_all_patients()
+        keep = self.directory.get(keep_code)
+        other = self.directory.get(merge_code)
+        if keep is None or other is None or keep is other:
+            return None
+        with self.transaction():
+            first_new = len(keep.medical_records)
+            for record in other.medical_records:
+                keep.add_medical_record_entry(record)
+                index = len(keep.medical_records) - 1
+                version = self.record_history.record_added(keep, index, author=f"merge:{merge_code}")
+                self.stats.add_record(keep, record)
+                self.record_changed(keep, record)
+                self.record_undo(lambda index=index, version=version: self.undo_add_medical_record(keep, index, version))
+            reminder_count, appointment_count, location = (len(keep.medication_reminders),
+                                                           len(keep.appointments), keep.location)
+            keep.medication_reminders.extend(other.medication_reminders)
+            keep.appointments.extend(other.appointments)
+            if keep.location is None:
+                keep.location = other.location
+            new_providers = self.directory.providers_of(merge_code) - self.directory.providers_of(keep_code)
+            for provider_name in new_providers:
+                self.directory.attach(provider_name, keep)
+            moved_bed = self.beds.bed_of(keep_code) is None and not self.beds.is_waiting(keep_code) \
+                and self.beds.reassign(merge_code, keep_code)
+            previous_reminder = self.appointment_reminders.get(keep.name)
+            previous_entry = self.patients.get(keep.name)
+            reminder = previous_reminder or self.appointment_reminders.get(other.name)
+
+            def undo_merge():
+                del keep.medication_reminders[reminder_count:]
+                del keep.appointments[appointment_count:]
+                keep.location = location
+                for provider_name in new_providers:
+                    self.directory.detach(provider_name, keep_code)
+                if moved_bed:
+                    self.beds.reassign(keep_code, merge_code)
+            self.record_undo(undo_merge)
+
+            if self.archive.count(merge_code):
+                # Before forget_patient's hook drops the merged code from the archive index
+                self.after_commit(lambda: self.move_archived_records(other, keep))
+            self.delete_patient(merge_code)
+            # A same-name duplicate shares the name keys with the kept patient
+            self.patients[keep.name] = keep
+            if reminder is not None:
+                self.appointment_reminders[keep.name] = reminder
+
+            def undo_names():
+                if previous_entry is None:
+                    self.patients.pop(keep.name, None)
+                else:
+                    self.patients[keep.name] = previous_entry
+                if previous_reminder is None:
+                    self.appointment_reminders.pop(keep.name, None)
+                else:
+                    self.appointment_reminders[keep.name] = previous_reminder
+            self.record_undo(undo_names)
+            self.changes.emit('patients_merged', access_code=keep_code, merged_access_code=merge_code,
+                              records_added=len(keep.medical_records) - first_new)
+            self.persist()
+        return keep
+
+    def move_archived_records(self, source, target):
+        records = list(self.archive.iter_records(source.access_code, MedicalRecordEntry))
+        # The target's live records now come after the added archived ones
+        archived = self.archive.count(target.access_code)
+        self.record_history.reindex({target.access_code: {archived + index: archived + len(records) + index
+                                                          for index in range(len(target.medical_records))}})
+        self.archive.append(target.access_code, records)
+        self.timelines.pop(target.access_code, None)
+        for record in records:
+            self.stats.add_record(target, record)
+
+    def record_columns(self, changed_since=None):
+        self.load_all_patients()
+        # numpy is only needed for the population reports, so it is imported on first use
+        from analytics import RecordColumns
+        patients = self.directory.patients.values()
+        if changed_since is not None:
+            patients = self.patients_changed_since(changed_since)
+        return RecordColumns.from_patients(patients, lambda patient: patient_records(patient, self.archive))
+
+    @metrics.timed('save')
+    def sync_web_data(self, web_path=websync.DEFAULT_WEB_PATH):
+        """Exchange changed patients with the web app's data.json; returns a websync.SyncReport."""
+        self.load_all_patients()
+        return websync.sync(self, Patient, MedicalRecordEntry, lambda patient: patient_records(patient, self.archive),
+                            web_path)
+
+    def provider_patient_counts(self):
+        return {name: len(members) for name, members in self.directory.members.items()}
+
+    def transfer_patient(self, access_code, from_provider, to_provider):
+        self.load_all_patients()
+        patient = self.directory.transfer(access_code, from_provider.name, to_provider.name)
+        if patient is not None:
+            self.access_guard.forget_code(access_code)
+            self.record_undo(lambda: self.directory.transfer(access_code, to_provider.name, from_provider.name))
+            self.changes.emit('patient_transferred', access_code=access_code,
+                              from_provider=from_provider.name, to_provider=to_provider.name)
+        return patient
+
     def view_current_inventory(self):
         if self.inventory:
             print("Current Inventory:")
@@ -338,45 +973,246 @@ class HealthLinkSystem:
 
     def update_inventory(self):
         item = input("Enter item name: ")
-        quantity = int(input("Enter quantity: "))
+        quantity = input_quantity("Enter quantity: ", low=0)
         self.inventory[item] = quantity
         print("Inventory updated successfully.")
 
     def view_bed_occupancy(self):
-        if self.bed_occupancy:
+        occupancy = self.beds.occupancy()
+        if occupancy:
             print("Current Bed Occupancy:")
-            for ward, occupancy in self.bed_occupancy.items():
-                print(f"{ward}: {occupancy}")
+            for ward, counts in occupancy.items():
+                print(f"{ward}: {counts['occupied']}/{counts['capacity']} occupied, "
+                      f"{counts['free']} free, {counts['waiting']} waiting")
         else:
             print("No bed occupancy data available.")
 
-    def update_bed_availability(self):
-        ward = input("Enter ward name: ")
-        occupancy = int(input("Enter current occupancy: "))
-        self.bed_occupancy[ward] = occupancy
-        print("Bed availability updated successfully.")
-
-    def request_medication_refill(self, patient, medication, quantity):
+    def set_ward_capacity(self, ward, capacity):
+        for entry, bed in self.beds.set_capacity(ward, capacity):
+            self.changes.emit('bed_assigned', access_code=entry[2], ward=ward, bed=bed)
+        self.persist()
+
+    def admit_patient(self, patient, ward, priority=0):
+        """Give ``patient`` the next free bed in ``ward``; returns the bed number, or None if wait-listed."""
+        code = patient.access_code
+        if self.beds.bed_of(code) is not None:
+            return self.beds.bed_of(code)[1]
+        waiting = self.beds.waiting.get(code)
+        placement = self.beds.admit(code, ward, priority)
+        self.record_undo(lambda: self.undo_admit_patient(code, waiting))
+        if placement is None:
+            self.changes.emit('bed_waitlisted', access_code=code, ward=ward, priority=priority)
+        else:
+            self.changes.emit('bed_assigned', access_code=code, ward=ward, bed=placement[1])
+        self.persist()
+        return placement[1] if placement is not None else None
+
+    def undo_admit_patient(self, code, waiting):
+        self.beds.vacate(code)
+        self.beds.dequeue(code)
+        if waiting is not None:
+            self.beds.enqueue(waiting)
+
+    def discharge_patient(self, access_code):
+        """Free a patient's bed or wait-list place; the next waiting patient of that ward gets the bed."""
+        placement, entry = self.release_bed(access_code)
+        if placement is not None or entry is not None:
+            self.persist()
+        return placement
+
+    def release_bed(self, access_code):
+        # (bed, wait-list entry) given up; does not save, so a patient delete can save once at the end
+        placement, entry, admitted = self.beds.discharge(access_code)
+        if placement is None and entry is None:
+            return None, None
+        self.record_undo(lambda: self.undo_discharge_patient(access_code, placement, entry, admitted))
+        if placement is not None:
+            self.changes.emit('bed_released', access_code=access_code, ward=placement[0], bed=placement[1])
+        for next_entry, bed in admitted:
+            self.changes.emit('bed_assigned', access_code=next_entry[2], ward=next_entry[3], bed=bed)
+        return placement, entry
+
+    def undo_discharge_patient(self, access_code, placement, entry, admitted):
+        for next_entry, bed in reversed(admitted):
+            self.beds.vacate(next_entry[2])
+            self.beds.enqueue(next_entry)
+        if placement is not None:
+            self.beds.occupy(access_code, *placement)
+        if entry is not None:
+            self.beds.enqueue(entry)
+
+    def facility_registry(self):
+        if self.facilities is None:
+            self.facilities = FacilityRegistry.load(os.path.join("medilink_data", "facilities.csv"))
+        return self.facilities
+
+    @metrics.timed('search')
+    def nearest_facilities(self, location, count=5, service=None, radius_km=None):
+        """[(distance in km, facility)] closest to ``location`` ("lat, lon" or a city), nearest first."""
+        registry = self.facility_registry()
+        if radius_km is not None:
+            return registry.within(location, radius_km, service)[:count]
+        return registry.nearest(location, count, service)
+
+    def request_medication_refill(self, patient, medication, quantity, source='staff'):
+        try:
+            request, queued = self.refills.request(patient, medication, quantity, source)
+        except ValueError as e:
+            print(e)
+            return None
+        if not queued:
+            print(f"A refill of {request['medication']} for {patient.name} is already pending "
+                  f"(quantity {request['quantity']}).")
+            return request
         print(f"Medication refill request for {patient.name}:")
-        print(f"Medication: {medication}")
+        print(f"Medication: {request['medication']}")
         print(f"Quantity: {quantity}")
         print("Request sent to pharmacy.")
+        return request
+
+    def fulfil_medication_refills(self, medications=None):
+        # Under the system lock so a save never sees the inventory halfway through a batch
+        with self.lock:
+            return self.refills.fulfil(self.inventory, medications)
+
+    def view_refill_backlog(self):
+        backlog = self.refills.backlog()
+        if backlog:
+            stock_of = {term_key(item): stock for item, stock in self.inventory.items()}
+            print("Pending Medication Refills:")
+            for medication, (requests, quantity) in sorted(backlog.items()):
+                stock = stock_of.get(term_key(medication), 0)
+                print(f"{medication}: {requests} requests, {quantity} units (in stock: {stock})")
+        else:
+            print("No pending medication refills.")
 
     def generate_access_code(self):
         return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
 
-    def add_medical_record(self, username, condition, medications, allergies):
-        if username in self.patients:
-            record = MedicalRecordEntry(condition, medications, allergies, datetime.now())
-            self.patients[username].add_medical_record_entry(record)
-            self.save_data()
-            return True
-        return False
+    def add_medical_record(self, access_code, condition, medications, allergies):
+        # By access code: names are not unique, and a sealed patient may not be loaded yet
+        patient = self.access_medical_record(access_code)
+        if patient is None:
+            return False
+        self.add_record_entry(patient, MedicalRecordEntry(condition, medications, allergies, datetime.now()))
+        return True
+
+    def add_record_entry(self, patient, record, author=None):
+        record.medications = MEDICATIONS.normalize(record.medications)
+        record.allergies = ALLERGIES.normalize(record.allergies)
+        patient.add_medical_record_entry(record)
+        index = len(patient.medical_records) - 1
+        version = self.record_history.record_added(patient, index, author=author)
+        self.stats.add_record(patient, record)
+        self.record_changed(patient, record)
+        self.record_undo(lambda: self.undo_add_medical_record(patient, index, version))
+        self.changes.emit('record_added', access_code=patient.access_code, index=index)
+        self.persist()
+
+    def update_medical_record(self, patient, index, author=None, **fields):
+        # Keeps the previous contents of the entry as an earlier version in record_history
+        old = patient.medical_records[index]
+        record = MedicalRecordEntry(
+            fields.get('condition', old.condition),
+            MEDICATIONS.normalize(fields['medications']) if 'medications' in fields else old.medications,
+            ALLERGIES.normalize(fields['allergies']) if 'allergies' in fields else old.allergies,
+            fields.get('timestamp', old.timestamp),
+        )
+        version = self.record_history.replace_record(patient, index, record, author)
+        self.stats.remove_record(patient, old)
+        self.stats.add_record(patient, record)
+        self.record_changed(patient, record, replaced=True)
+        self.record_undo(lambda: self.undo_update_medical_record(patient, index, old, version))
+        changed = [field for field in ('condition', 'medications', 'allergies', 'timestamp')
+                   if getattr(old, field) != getattr(record, field)]
+        self.changes.emit('record_updated', access_code=patient.access_code, index=index, fields=changed, author=author)
+        self.persist()
+        return record
+
+    def undo_add_medical_record(self, patient, index, version):
+        self.stats.remove_record(patient, patient.medical_records.pop(index))
+        self.timelines.pop(patient.access_code, None)
+        if version is not None:
+            self.record_history.discard_version(patient.access_code, index, version)
+
+    def undo_update_medical_record(self, patient, index, old, version):
+        self.stats.remove_record(patient, patient.medical_records[index])
+        self.stats.add_record(patient, old)
+        patient.medical_records[index] = old
+        self.timelines.pop(patient.access_code, None)
+        if version is not None:
+            self.record_history.discard_version(patient.access_code, index, version)
+
+    def medical_records_as_of(self, patient, when):
+        archived = self.archive.iter_records(patient.access_code, MedicalRecordEntry)
+        return self.record_history.records_as_of(patient, when, archived)
+
+    def record_audit_trail(self, patient):
+        return self.record_history.audit_trail(patient.access_code)
+
+    def timeline(self, patient):
+        timeline = self.timelines.get(patient.access_code)
+        if timeline is None:
+            timeline = self.timelines[patient.access_code] = PatientTimeline(patient_records(patient, self.archive))
+        return timeline
+
+    def latest_record(self, patient):
+        return self.timeline(patient).latest()
+
+    def records_between(self, patient, start=None, end=None):
+        return self.timeline(patient).between(start, end)
+
+    def record_changed(self, patient, record, replaced=False):
+        # An edit takes the old entry's place, which a sorted insert cannot do, so the timeline is rebuilt
+        if replaced:
+            self.timelines.pop(patient.access_code, None)
+        elif patient.access_code in self.timelines:
+            self.timelines[patient.access_code].add(record)
+        if self.change_index is not None:
+            self.change_index.add(datetime.now(), patient.access_code, record)
+
+    def record_change_index(self):
+        self.load_all_patients()
+        if self.change_index is None:
+            entries = []
+            for patient in self.directory.patients.values():
+                code = patient.access_code
+                archived = list(self.archive.iter_records(code, MedicalRecordEntry)) if self.archive.count(code) else []
+                for position, record in enumerate(itertools.chain(archived, patient.medical_records)):
+                    # Records never edited since the history began changed when they were written
+                    when = self.record_history.last_edited(code, position) or normalize_timestamp(record.timestamp)
+                    entries.append((when or datetime.min, code, record, position < len(archived)))
+            self.change_index = ChangeIndex(entries)
+        return self.change_index
+
+    def records_changed_since(self, when):
+        """[(time changed, patient, record)] for records added or edited at or after ``when``, oldest first."""
+        found = []
+        live = {}
+        for changed_at, code, record, archived in self.record_change_index().since(when):
+            patient = self.directory.get(code)
+            if patient is None:
+                continue
+            if not archived:
+                # Entries of edited, undone or merged-away records are no longer among the patient's records
+                ids = live.get(code)
+                if ids is None:
+                    ids = live[code] = {id(current) for current in patient.medical_records}
+                if id(record) not in ids:
+                    continue
+            found.append((changed_at, patient, record))
+        return found
+
+    def patients_changed_since(self, when):
+        return list({id(patient): patient for _, patient, _ in self.records_changed_since(when)}.values())
 
     def add_appointment(self, username, appointment):
         if username in self.patients:
-            self.patients[username].appointments.append(appointment)
-            self.save_data()
+            patient = self.patients[username]
+            patient.appointments.append(appointment)
+            self.record_undo(patient.appointments.pop)
+            self.publish_appointment(patient, 'added', appointment)
+            self.persist()
             return True
         return False
 
@@ -386,8 +1222,10 @@ class HealthLinkSystem:
         print("Message sent to healthcare provider.")
 
 
-def main():
-    healthlink_system = HealthLinkSystem()
+def main(healthlink_system=None):
+    if healthlink_system is None:
+        metrics.dump_on_exit()
+        healthlink_system = HealthLinkSystem()
 
     while True:
         print("\nMain Menu:")
@@ -411,7 +1249,7 @@ def main():
         elif choice == '3':
             display_emergency_services_info()
         elif choice == '4':
-            find_nearest_healthcare_facilities()
+            find_nearest_healthcare_facilities(healthlink_system)
         elif choice == '5':
             display_covid19_info()
         elif choice == '6':
@@ -461,11 +1299,14 @@ def create_patient_account(healthlink_system):
     name = input("Enter patient name: ")
     password = input("Enter password: ")
     condition = input("Enter medical condition: ")
-    medications = input("Enter medications (comma-separated): ").split(', ')
-    allergies = input("Enter allergies (comma-separated): ").split(', ')
+    medications = parse_medications(input("Enter medications (comma-separated): "))
+    allergies = parse_allergies(input("Enter allergies (comma-separated): "))
     access_code = healthlink_system.generate_access_code()
     
     new_patient = Patient(name, access_code, condition, medications, allergies, datetime.now())
+    if healthlink_system.name_taken(name, access_code):
+        print(f"A patient named {name} is already registered. Please contact your healthcare provider.")
+        return
     healthlink_system.add_patient(new_patient)
     
     print(f"Patient account created successfully. Your access code is: {access_code}")
@@ -478,6 +1319,8 @@ def hospital_staff_menu(healthlink_system):
 
     for provider in healthlink_system.providers:
         if provider.name == name and provider.password == password:
+            # Staff work across all their patients, so encrypted ones are decrypted now rather than one by one
+            healthlink_system.load_all_patients()
             while True:
                 print("\nHospital Staff Menu:")
                 print("1. Access Patient Medical Records")
@@ -493,49 +1336,56 @@ def hospital_staff_menu(healthlink_system):
                 print("11. View Current Inventory")
                 print("12. Update Inventory")
                 print("13. View Bed Occupancy")
-                print("14. Update Bed Availability")
+                print("14. Manage Beds and Admissions")
                 print("15. Add Medical Reminder for Patient")
                 print("16. Update Medical Reminder for Patient")
                 print("17. Request Medication Refill for Patient")
                 print("18. Contact Healthcare Provider")
                 print("19. View Health Education Resources")
-                print("20. Logout")
+                print("20. Fulfil Medication Refills")
+                print("21. Find and Merge Duplicate Patients")
+                print("22. Generate Batch Patient Reports")
+                print("23. Logout")
 
-                choice = input("Enter your choice (1-20): ")
+                choice = input("Enter your choice (1-23): ")
 
                 if choice.isdigit():
                     choice = int(choice)
                     if choice == 1:
                         access_code = input("Enter patient's access code: ")
-                        patient = provider.access_medical_record(access_code)
+                        patient = verify_access_code(healthlink_system, access_code, provider)
                         if patient:
-                            print_medical_records(patient)
+                            print_medical_records(patient, healthlink_system.archive)
                         else:
                             print("Access denied. Invalid access code.")
 
                     elif choice == 2:
                         name = input("Enter patient's name: ")
                         condition = input("Enter medical condition: ")
-                        medications = input("Enter medications (comma-separated): ").split(', ')
-                        allergies = input("Enter allergies (comma-separated): ").split(', ')
-                        location = input("Enter patient's location (optional): ")
+                        medications = parse_medications(input("Enter medications (comma-separated): "))
+                        allergies = parse_allergies(input("Enter allergies (comma-separated): "))
+                        location = input("Enter patient's location (city or latitude, longitude; optional): ")
                         patient = Patient(name, healthlink_system.generate_access_code(), condition, medications, allergies, datetime.now())
-                        provider.add_patient(patient)
+                        if location:
+                            patient.update_location(location)
+                        if not confirm_not_duplicate(healthlink_system, patient, provider):
+                            continue
+                        healthlink_system.add_patient(patient, provider)
                         print(f"Patient {name} registered with access code: {patient.access_code}")
 
                     elif choice == 3:
                         access_code = input("Enter patient's access code: ")
-                        patient = provider.access_medical_record(access_code)
+                        patient = verify_access_code(healthlink_system, access_code, provider)
                         if patient:
-                            update_patient_medical_info(patient)
+                            update_patient_medical_info(healthlink_system, patient)
                         else:
                             print("Access denied. Invalid access code.")
 
                     elif choice == 4:
                         access_code = input("Enter patient's access code: ")
-                        patient = provider.access_medical_record(access_code)
+                        patient = verify_access_code(healthlink_system, access_code, provider)
                         if patient:
-                            print_medical_records(patient)
+                            print_medical_records(patient, healthlink_system.archive)
                         else:
                             print("Access denied. Invalid access code.")
 
@@ -552,7 +1402,7 @@ def hospital_staff_menu(healthlink_system):
                     elif choice == 7:
                         access_code = input("Enter patient's access code: ")
                         appointment_date = input("Enter appointment date (YYYY-MM-DD): ")
-                        patient = provider.access_medical_record(access_code)
+                        patient = verify_access_code(healthlink_system, access_code, provider)
                         if patient:
                             healthlink_system.schedule_appointment(patient, appointment_date)
                         else:
@@ -561,7 +1411,7 @@ def hospital_staff_menu(healthlink_system):
                     elif choice == 8:
                         access_code = input("Enter patient's access code: ")
                         new_appointment_date = input("Enter new appointment date (YYYY-MM-DD): ")
-                        patient = provider.access_medical_record(access_code)
+                        patient = verify_access_code(healthlink_system, access_code, provider)
                         if patient:
                             healthlink_system.reschedule_appointment(patient, new_appointment_date)
                         else:
@@ -569,7 +1419,7 @@ def hospital_staff_menu(healthlink_system):
 
                     elif choice == 9:
                         access_code = input("Enter patient's access code: ")
-                        patient = provider.access_medical_record(access_code)
+                        patient = verify_access_code(healthlink_system, access_code, provider)
                         if patient:
                             healthlink_system.cancel_appointment(patient)
                         else:
@@ -588,11 +1438,11 @@ def hospital_staff_menu(healthlink_system):
                         healthlink_system.view_bed_occupancy()
 
                     elif choice == 14:
-                        healthlink_system.update_bed_availability()
+                        manage_beds(healthlink_system, provider)
 
                     elif choice == 15:
                         access_code = input("Enter patient's access code: ")
-                        patient = provider.access_medical_record(access_code)
+                        patient = verify_access_code(healthlink_system, access_code, provider)
                         if patient:
                             medication = input("Enter medication name: ")
                             frequency = input("Enter medication reminder frequency: ")
@@ -603,13 +1453,14 @@ def hospital_staff_menu(healthlink_system):
 
                     elif choice == 16:
                         access_code = input("Enter patient's access code: ")
-                        patient = provider.access_medical_record(access_code)
+                        patient = verify_access_code(healthlink_system, access_code, provider)
                         if patient:
                             if patient.medication_reminders:
                                 print("Current Medication Reminders:")
                                 for i, reminder in enumerate(patient.medication_reminders):
                                     print(f"{i+1}. Medication: {reminder['medication']}, Frequency: {reminder['frequency']}")
-                                index = int(input("Enter the index of the reminder to update: "))
+                                index = input_quantity("Enter the index of the reminder to update: ",
+                                                       low=1, high=len(patient.medication_reminders))
                                 medication = input("Enter updated medication name: ")
                                 frequency = input("Enter updated medication reminder frequency: ")
                                 patient.medication_reminders[index - 1] = {'medication': medication, 'frequency': frequency}
@@ -621,17 +1472,18 @@ def hospital_staff_menu(healthlink_system):
 
                     elif choice == 17:
                         access_code = input("Enter patient's access code: ")
-                        patient = provider.access_medical_record(access_code)
+                        patient = verify_access_code(healthlink_system, access_code, provider)
                         if patient:
                             medication = input("Enter medication name: ")
-                            quantity = int(input("Enter quantity: "))
-                            healthlink_system.request_medication_refill(patient, medication, quantity)
+                            quantity = input_quantity("Enter quantity: ")
+                            healthlink_system.request_medication_refill(patient, medication, quantity,
+                                                                        f"staff:{provider.name}")
                         else:
                             print("Access denied. Invalid access code.")
 
                     elif choice == 18:
                         access_code = input("Enter patient's access code: ")
-                        patient = provider.access_medical_record(access_code)
+                        patient = verify_access_code(healthlink_system, access_code, provider)
                         if patient:
                             provider_contact = input("Enter provider's contact information: ")
                             patient_contact = input("Enter patient's contact information: ")
@@ -643,10 +1495,24 @@ def hospital_staff_menu(healthlink_system):
                         healthlink_system.view_health_education_resources()
 
                     elif choice == 20:
+                        healthlink_system.view_refill_backlog()
+                        if healthlink_system.refills.pending:
+                            medication = input("Enter medication to fulfil (blank for all): ").strip()
+                            fulfilled = healthlink_system.fulfil_medication_refills([medication] if medication else None)
+                            print(f"{len(fulfilled)} refill requests fulfilled.")
+                            healthlink_system.view_refill_backlog()
+
+                    elif choice == 21:
+                        merge_duplicate_patients(healthlink_system, provider)
+
+                    elif choice == 22:
+                        generate_batch_reports(healthlink_system, provider)
+
+                    elif choice == 23:
                         print("Logging out...")
                         break
                     else:
-                        print("Invalid choice. Please enter a number between 1 and 20.")
+                        print("Invalid choice. Please enter a number between 1 and 23.")
                 else:
                     print("Invalid input. Please enter a number.")
             break
@@ -654,10 +1520,66 @@ def hospital_staff_menu(healthlink_system):
         print("Invalid credentials. Please try again.")
 
 
-def print_medical_records(patient):
-    if patient.medical_records:
+def portal_client():
+    # One bucket per portal terminal that outlives each login, so logging out and in again does not reset it
+    return f"patient-portal:{os.getenv('MEDILINK_TERMINAL_ID', 'console')}"
+
+
+def verify_access_code(healthlink_system, access_code, provider=None):
+    # Staff are limited per provider account, the patient portal per terminal
+    client = f"staff:{provider.name}" if provider is not None else portal_client()
+    wait = healthlink_system.access_guard.retry_after(client)
+    if wait:
+        print(f"Too many access attempts. Please try again in {wait:.0f} seconds.")
+        return None
+    return healthlink_system.verify_access(access_code, client, provider)
+
+
+def input_quantity(prompt, default=None, low=None, high=None):
+    # Asks again until a whole number in low..high is typed; a blank answer gives ``default`` when there is one
+    while True:
+        text = input(prompt).strip()
+        if not text and default is not None:
+            return default
+        try:
+            value = int(text)
+        except ValueError:
+            print("Invalid input. Please enter a number.")
+            continue
+        if (low is None or value >= low) and (high is None or value <= high):
+            return value
+        if high is None:
+            print(f"Invalid input. Please enter a number of at least {low}.")
+        else:
+            print(f"Invalid input. Please enter a number from {low} to {high}.")
+
+
+def input_radius(prompt):
+    # A distance in km, or None for a blank answer; asks again for anything else
+    while True:
+        text = input(prompt).strip()
+        if not text:
+            return None
+        try:
+            radius = float(text)
+        except ValueError:
+            radius = 0.0
+        if 0 < radius < float('inf'):
+            return radius
+        print("Invalid input. Please enter a distance in km, e.g. 10.")
+
+
+def patient_records(patient, archive=None):
+    # Archived entries are read lazily from the memory-mapped file, ahead of the in-memory ones
+    if archive is not None and archive.count(patient.access_code):
+        return itertools.chain(archive.iter_records(patient.access_code, MedicalRecordEntry), patient.medical_records)
+    return patient.medical_records
+
+
+def print_medical_records(patient, archive=None):
+    if patient.medical_records or (archive is not None and archive.count(patient.access_code)):
         print(f"Medical Records for {patient.name}:")
-        for record in patient.medical_records:
+        for record in patient_records(patient, archive):
             print(f"Condition: {record.condition}")
             print(f"Medications: {', '.join(record.medications)}")
             print(f"Allergies: {', '.join(record.allergies)}")
@@ -667,13 +1589,142 @@ def print_medical_records(patient):
         print("No medical records found for this patient.")
 
 
-def update_patient_medical_info(patient):
+def update_patient_medical_info(healthlink_system, patient):
     condition = input("Enter updated medical condition: ")
-    medications = input("Enter updated medications (comma-separated): ").split(', ')
-    allergies = input("Enter updated allergies (comma-separated): ").split(', ')
-    timestamp = datetime.now()
-    patient.add_medical_record_entry(MedicalRecordEntry(condition, medications, allergies, timestamp))
-    print("Patient medical information updated successfully.")
+    medications = parse_medications(input("Enter updated medications (comma-separated): "))
+    allergies = parse_allergies(input("Enter updated allergies (comma-separated): "))
+    # Goes through the system so the record history and aggregate counters see the new entry
+    if healthlink_system.add_medical_record(patient.access_code, condition, medications, allergies):
+        print("Patient medical information updated successfully.")
+    else:
+        print("Patient not found. The medical information was not updated.")
+
+
+def generate_batch_reports(healthlink_system, provider):
+    condition = input("Only patients with condition (blank for all your patients): ").strip()
+    since = input("Only patients with records changed since (YYYY-MM-DD, blank for any time): ").strip()
+    changed_since = normalize_timestamp(since) if since else None
+    if since and changed_since is None:
+        print("Invalid date. Please use YYYY-MM-DD.")
+        return
+    patients = healthlink_system.select_report_patients(provider.name, condition or None, changed_since)
+    if not patients:
+        print("No patients match.")
+        return
+    formats = input("Formats (text, html, csv; blank for text): ").replace(',', ' ').split() or ['text']
+    if not set(formats) <= set(reports.FORMATS):
+        print("Unknown format. Choose from text, html and csv.")
+        return
+    output_dir = input("Output folder (blank for 'reports'): ").strip() or 'reports'
+    paths = healthlink_system.generate_batch_reports(patients, output_dir, formats, progress=reports.print_progress)
+    for path in paths.values():
+        print(f"Report written to {path}")
+
+
+def describe_match(patient, provider):
+    # Access codes are only shown for the staff member's own patients
+    where = f"access code {patient.access_code}" if patient in provider.patients else "another provider"
+    return f"{patient.name} ({patient.location or 'no location'}, {where})"
+
+
+def confirm_not_duplicate(healthlink_system, patient, provider):
+    if healthlink_system.name_taken(patient.name, patient.access_code):
+        print(f"A patient named {patient.name} is already registered. Use that record, "
+              "or register with a distinguishing name (e.g. a middle name).")
+        return False
+    matches = healthlink_system.possible_duplicates(patient)
+    if not matches:
+        return True
+    print("This patient may already be registered:")
+    for score, other in matches[:3]:
+        print(f"  {describe_match(other, provider)} - similarity {score:.2f}")
+    return input("Register anyway? (y/n): ").strip().lower() == 'y'
+
+
+def merge_duplicate_patients(healthlink_system, provider):
+    pairs = [(score, a, b) for score, a, b in healthlink_system.find_duplicate_patients()
+             if a in provider.patients or b in provider.patients]
+    if not pairs:
+        print("No probable duplicates found.")
+        return
+    print("Probable duplicate patients:")
+    for i, (score, a, b) in enumerate(pairs[:10], 1):
+        print(f"{i}. {describe_match(a, provider)} and {describe_match(b, provider)} - similarity {score:.2f}")
+    keep_code = input("Enter the access code of the record to keep (blank to cancel): ").strip()
+    if not keep_code:
+        return
+    merge_code = input("Enter the access code of the duplicate to merge into it: ").strip()
+    client = f"staff:{provider.name}"
+    keep = healthlink_system.verify_access(keep_code, client)
+    other = healthlink_system.verify_access(merge_code, client)
+    if keep is None or other is None or keep is other:
+        print("Access denied. Invalid access code.")
+        return
+    healthlink_system.merge_patients(keep.access_code, other.access_code)
+    print(f"Merged {other.name} into {keep.name}. Access code {other.access_code} is no longer valid; "
+          f"use {keep.access_code}.")
+
+
+def manage_beds(healthlink_system, provider):
+    print("\nBed Management")
+    print("1. Set Ward Capacity")
+    print("2. Admit Patient")
+    print("3. Discharge Patient")
+    print("4. Show Next Free Bed")
+    print("5. Show Wait-List")
+    choice = input("Enter your choice: ")
+    beds = healthlink_system.beds
+    if choice == '1':
+        ward = input("Enter ward name: ")
+        capacity = input_quantity("Enter number of beds: ", low=0)
+        healthlink_system.set_ward_capacity(ward, capacity)
+        print("Ward capacity updated successfully.")
+    elif choice in ('2', '3'):
+        access_code = input("Enter patient's access code: ")
+        patient = verify_access_code(healthlink_system, access_code, provider)
+        if not patient:
+            print("Access denied. Invalid access code.")
+        elif choice == '2':
+            ward = input("Enter ward name: ")
+            if ward not in beds.wards:
+                print("Unknown ward. Set its capacity first.")
+                return
+            priority = input_quantity("Enter priority (lower is more urgent) [0]: ", default=0)
+            bed = healthlink_system.admit_patient(patient, ward, priority)
+            if bed is None:
+                print(f"No free bed in {ward}. {patient.name} is on the wait-list.")
+            else:
+                print(f"{patient.name} admitted to {ward}, bed {bed}.")
+        else:
+            placement = healthlink_system.discharge_patient(patient.access_code)
+            if placement is None:
+                print(f"{patient.name} is not admitted.")
+            else:
+                print(f"{patient.name} discharged from {placement[0]}, bed {placement[1]}.")
+    elif choice in ('4', '5'):
+        ward = input("Enter ward name: ")
+        if ward not in beds.wards:
+            print("Unknown ward.")
+        elif choice == '4':
+            bed = beds.next_free_bed(ward)
+            print(f"Next free bed in {ward}: {bed}" if bed is not None else f"No free bed in {ward}.")
+        else:
+            waiting = beds.waiting_list(ward)
+            for position, code in enumerate(waiting, 1):
+                patient = healthlink_system.access_medical_record(code)
+                print(f"{position}. {patient.name if patient else code}")
+            if not waiting:
+                print("Nobody is waiting.")
+    else:
+        print("Invalid choice.")
+
+
+def print_patient_education_resources(patient, catalog):
+    resources = catalog.resources_for_patient(patient)
+    if resources:
+        print("Health Education Resources for your conditions:")
+        for condition, url in resources.items():
+            print(f"{condition}: {url}")
 
 
 def view_health_education_resources(healthlink_system):
@@ -689,13 +1740,11 @@ def view_health_education_resources(healthlink_system):
         choice = input("Enter your choice (1-2): ")
         
         if choice == '1':
-            search_term = input("Enter the condition you're looking for: ").lower()
-            found = False
-            for condition, url in healthlink_system.education_resources.items():
-                if search_term in condition.lower():
-                    print(f"{condition}: {url}")
-                    found = True
-            if not found:
+            search_term = input("Enter the condition you're looking for: ")
+            matches = healthlink_system.education_catalog.search(search_term)
+            for condition, url in matches.items():
+                print(f"{condition}: {url}")
+            if not matches:
                 print("No matching conditions found.")
         elif choice == '2':
             break
@@ -710,21 +1759,23 @@ def patient_portal_menu(healthlink_system):
         print("2. Add Medication Reminder")
         print("3. Request Medication Refill")
         print("4. View Health Education Resources")
-        print("5. Logout")
+        print("5. Find Nearby Healthcare Facilities")
+        print("6. Logout")
 
-        choice = input("Enter your choice (1-5): ")
+        choice = input("Enter your choice (1-6): ")
 
         if choice == '1':
             access_code = input("Enter your access code: ")
-            patient = healthlink_system.access_medical_record(access_code)
+            patient = verify_access_code(healthlink_system, access_code)
             if patient:
-                print_medical_records(patient)
+                print_medical_records(patient, healthlink_system.archive)
+                print_patient_education_resources(patient, healthlink_system.education_catalog)
             else:
                 print("Invalid access code.")
 
         elif choice == '2':
             access_code = input("Enter your access code: ")
-            patient = healthlink_system.access_medical_record(access_code)
+            patient = verify_access_code(healthlink_system, access_code)
             if patient:
                 medication = input("Enter the medication name: ")
                 frequency = input("Enter the frequency of the reminder: ")
@@ -735,11 +1786,11 @@ def patient_portal_menu(healthlink_system):
 
         elif choice == '3':
             access_code = input("Enter your access code: ")
-            patient = healthlink_system.access_medical_record(access_code)
+            patient = verify_access_code(healthlink_system, access_code)
             if patient:
                 medication = input("Enter the medication name: ")
-                quantity = input("Enter the quantity to refill: ")
-                healthlink_system.request_medication_refill(patient, medication, quantity)
+                quantity = input_quantity("Enter the quantity to refill: ")
+                healthlink_system.request_medication_refill(patient, medication, quantity, 'patient-portal')
             else:
                 print("Invalid access code.")
 
@@ -747,10 +1798,19 @@ def patient_portal_menu(healthlink_system):
             healthlink_system.view_health_education_resources()
 
         elif choice == '5':
+            access_code = input("Enter your access code: ")
+            patient = verify_access_code(healthlink_system, access_code)
+            if patient:
+                # Uses the location given at registration, if there was one
+                find_nearest_healthcare_facilities(healthlink_system, patient.location)
+            else:
+                print("Invalid access code.")
+
+        elif choice == '6':
             print("Logging out...")
             break
         else:
-            print("Invalid choice. Please enter a number between 1 and 5.")
+            print("Invalid choice. Please enter a number between 1 and 6.")
 
 
 def list_hospital_staff(staff_profiles):
@@ -770,11 +1830,24 @@ def display_emergency_services_info():
     print("- 24/7 Nurse Hotline: [Phone Number]")
     input("Press Enter to return to the main menu.")
 
-def find_nearest_healthcare_facilities():
+def find_nearest_healthcare_facilities(healthlink_system, location=None):
     print("\nFind Nearest Healthcare Facilities:")
-    print("To find the nearest healthcare facilities, please visit:")
-    print("https://www.healthcarefacilityfinder.com")
-    print("Enter your location to see a list of nearby hospitals, clinics, and pharmacies.")
+    if not len(healthlink_system.facility_registry()):
+        print("No facility list is installed. Place it in medilink_data/facilities.csv.")
+        input("Press Enter to return to the main menu.")
+        return
+    if location is None:
+        location = input("Enter your city or coordinates (latitude, longitude): ")
+    service = input("Service needed (e.g. Emergency, Pharmacy; blank for any): ").strip() or None
+    radius = input_radius("Search radius in km (blank for the 5 nearest): ")
+    facilities = healthlink_system.nearest_facilities(location, 5 if radius is None else 20, service, radius)
+    if healthlink_system.facility_registry().resolve(location) is None:
+        print("Location not recognised. Enter a city from the facility list or 'latitude, longitude'.")
+    elif not facilities:
+        print("No matching facilities found.")
+    for distance, facility in facilities:
+        print(f"{facility.name} ({facility.kind}) - {distance:.1f} km")
+        print(f"  Services: {', '.join(facility.services)}  Phone: {facility.phone}")
     input("Press Enter to return to the main menu.")
 
 def display_covid19_info():
@@ -0,0 +1,102 @@
+"""Access-code verification that stays cheap under guessing attacks.
+
+Every failed attempt takes a token from its client's bucket, so a client that
+keeps guessing wrong is slowed down while correct codes cost nothing; an empty
+bucket is refused before any lookup happens. Codes that recently failed are kept in a
+bounded negative cache, so repeating them skips the lookup as well.
+"""
+import time
+from collections import OrderedDict
+
+import metrics
+
+BUCKET_CAPACITY = 10
+REFILL_PER_SECOND = 10 / 60.0
+NEGATIVE_TTL = 60.0
+MAX_CLIENTS = 10000
+MAX_NEGATIVE_CODES = 10000
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_per_second, now):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def has_token(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self, now):
+        if self.has_token(now):
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_after(self, now):
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.refill_per_second
+
+
+class AccessGuard:
+    def __init__(self, capacity=BUCKET_CAPACITY, refill_per_second=REFILL_PER_SECOND,
+                 negative_ttl=NEGATIVE_TTL, clock=time.monotonic):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.buckets = OrderedDict()
+        # scope (None or a provider name) -> OrderedDict of access code -> expiry time
+        self.negative = {}
+
+    def bucket(self, client, now):
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.capacity, self.refill_per_second, now)
+            if len(self.buckets) > MAX_CLIENTS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(client)
+        return bucket
+
+    def verify(self, client, access_code, lookup, scope=None):
+        """Return the patient ``lookup(access_code)`` finds, or None if the code is wrong or ``client`` is limited."""
+        now = self.clock()
+        bucket = self.bucket(client, now)
+        if not bucket.has_token(now):
+            metrics.increment('access_rate_limited')
+            return None
+        access_code = (access_code or '').strip()
+        failed = self.negative.setdefault(scope, OrderedDict())
+        expiry = failed.get(access_code)
+        if expiry is not None and expiry > now:
+            bucket.take(now)
+            metrics.increment('access_negative_cache_hits')
+            metrics.increment('access_denied')
+            return None
+        patient = lookup(access_code)
+        if patient is None:
+            bucket.take(now)
+            failed[access_code] = now + self.negative_ttl
+            failed.move_to_end(access_code)
+            if len(failed) > MAX_NEGATIVE_CODES:
+                failed.popitem(last=False)
+            metrics.increment('access_denied')
+            return None
+        failed.pop(access_code, None)
+        return patient
+
+    def retry_after(self, client):
+        """Seconds until ``client`` may try again; 0 if it is not limited."""
+        bucket = self.buckets.get(client)
+        return bucket.retry_after(self.clock()) if bucket else 0.0
+
+    def forget_code(self, access_code):
+        # A code that now exists (new patient, transfer) must not keep failing from the cache.
+        for failed in self.negative.values():
+            failed.pop(access_code, None)
@@ -0,0 +1,109 @@
+"""Running totals over every medical record, including archived ones.
+
+AggregateStats keeps Counters per condition, medication, allergy and record
+day, plus how many distinct patients have each condition. HealthLinkSystem
+updates them as records are added, edited or deleted, so a question like "how
+many patients have diabetes" is a dictionary lookup instead of a scan. On
+startup the totals are rebuilt from the loaded data in one serial pass.
+"""
+import json
+import os
+from collections import Counter
+from datetime import datetime
+
+
+def record_row(access_code, record):
+    timestamp = record.timestamp
+    day = timestamp.date().isoformat() if isinstance(timestamp, datetime) else None
+    return (access_code, record.condition, tuple(record.medications), tuple(record.allergies), day)
+
+
+class AggregateStats:
+    def __init__(self):
+        self.conditions = Counter()
+        self.medications = Counter()
+        self.allergies = Counter()
+        self.daily_records = Counter()
+        self.condition_patients = Counter()
+        # access code -> Counter of that patient's conditions, to keep condition_patients distinct
+        self.patient_conditions = {}
+        self.total_records = 0
+
+    def add_row(self, row, sign):
+        access_code, condition, medications, allergies, day = row
+        self.total_records += sign
+        if condition:
+            self.conditions[condition] += sign
+            own = self.patient_conditions.setdefault(access_code, Counter())
+            own[condition] += sign
+            if sign > 0 and own[condition] == 1:
+                self.condition_patients[condition] += 1
+            elif sign < 0 and own[condition] <= 0:
+                self.condition_patients[condition] -= 1
+                del own[condition]
+                if not own:
+                    del self.patient_conditions[access_code]
+        for medication in medications:
+            self.medications[medication] += sign
+        for allergy in allergies:
+            self.allergies[allergy] += sign
+        if day:
+            self.daily_records[day] += sign
+
+    def add_record(self, patient, record):
+        self.add_row(record_row(patient.access_code, record), 1)
+
+    def remove_record(self, patient, record):
+        self.add_row(record_row(patient.access_code, record), -1)
+
+    def add_patient(self, patient, records):
+        for record in records:
+            self.add_record(patient, record)
+
+    def remove_patient(self, patient, records):
+        for record in records:
+            self.remove_record(patient, record)
+
+    @classmethod
+    def build(cls, patient_records):
+        """Count ``(patient, records)`` pairs."""
+        stats = cls()
+        for patient, records in patient_records:
+            stats.add_patient(patient, records)
+        return stats
+
+    def patients_with_condition(self, condition):
+        return self.condition_patients.get(condition, 0)
+
+    def condition_count(self, condition):
+        return self.conditions.get(condition, 0)
+
+    def medication_count(self, medication):
+        return self.medications.get(medication, 0)
+
+    def allergy_count(self, allergy):
+        return self.allergies.get(allergy, 0)
+
+    def records_on(self, day):
+        """Number of records dated ``day`` (a date or 'YYYY-MM-DD')."""
+        return self.daily_records.get(day if isinstance(day, str) else day.isoformat(), 0)
+
+    def to_dict(self, provider_patients=None):
+        data = {
+            'total_records': self.total_records,
+            'conditions': dict(+self.conditions),
+            'patients_by_condition': dict(+self.condition_patients),
+            'medications': dict(+self.medications),
+            'allergies': dict(+self.allergies),
+            'daily_records': dict(sorted((+self.daily_records).items())),
+        }
+        if provider_patients is not None:
+            data['patients_by_provider'] = provider_patients
+        return data
+
+    def dump(self, path, provider_patients=None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(provider_patients), f, indent=2)
@@ -0,0 +1,214 @@
+"""Vectorized population analytics over medical records (needs numpy).
+
+RecordColumns holds every record as NumPy columns: the patient it belongs to, a
+dictionary-encoded condition code and the timestamp in microseconds since the
+epoch. Medications and allergies are flattened into code columns with the index
+of their record alongside. Reports such as condition trends per month,
+medication co-occurrence and per-provider load are then bincount/unique calls
+over those arrays instead of loops over MedicalRecordEntry objects. Pairs of
+medications are returned sparsely, since most possible pairs never occur.
+"""
+from array import array
+from datetime import datetime
+
+import numpy as np
+
+import codec
+from codec import EPOCH, NO_STRING, NO_TIMESTAMP, StringTable
+from timeline import normalize_timestamp
+
+
+def timestamp_micros(value):
+    """Microseconds since the epoch for a record timestamp; the one parser both encoders use."""
+    if not isinstance(value, datetime):
+        # Typed dates such as "12/03/2024" count in the monthly trends too
+        value = normalize_timestamp(value)
+    if value is not None:
+        delta = value - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return NO_TIMESTAMP
+
+
+def text_timestamps(timestamps, text_ids, strings):
+    # The binary file keeps typed dates as text; parse each distinct one as from_patients would
+    text = (timestamps == NO_TIMESTAMP) & (text_ids != NO_STRING)
+    if not text.any():
+        return timestamps
+    unique, inverse = np.unique(text_ids[text], return_inverse=True)
+    parsed = np.array([timestamp_micros(strings[i]) for i in unique.tolist()], dtype=np.int64)
+    timestamps = timestamps.copy()
+    timestamps[text] = parsed[inverse]
+    return timestamps
+
+
+def as_numpy(column):
+    return np.frombuffer(column, dtype=np.int64) if len(column) else np.zeros(0, dtype=np.int64)
+
+
+def recode(ids, strings):
+    """Turn string-table ids into dense codes 0..n-1 plus their names; missing strings become NO_STRING."""
+    unique, codes = np.unique(ids, return_inverse=True)
+    names = [strings[i] for i in unique.tolist()]
+    if len(unique) and unique[0] == NO_STRING:
+        return codes - 1, names[1:]
+    return codes, names
+
+
+class RecordColumns:
+    def __init__(self, patient_codes, record_patient, record_condition, record_time,
+                 medication_record, medication_code, allergy_record, allergy_code,
+                 condition_names, medication_names, allergy_names):
+        self.patient_codes = patient_codes
+        self.record_patient = record_patient
+        self.record_condition = record_condition
+        self.record_time = record_time
+        self.medication_record = medication_record
+        self.medication_code = medication_code
+        self.allergy_record = allergy_record
+        self.allergy_code = allergy_code
+        self.condition_names = condition_names
+        self.medication_names = medication_names
+        self.allergy_names = allergy_names
+
+    def __len__(self):
+        return len(self.record_condition)
+
+    @classmethod
+    def from_patients(cls, patients, records_of=None):
+        """Encode ``patients``; ``records_of(patient)`` may add archived records to the live ones."""
+        conditions, medications, allergies = StringTable(), StringTable(), StringTable()
+        patient_codes = []
+        record_patient, record_condition, record_time = array('q'), array('q'), array('q')
+        medication_record, medication_code = array('q'), array('q')
+        allergy_record, allergy_code = array('q'), array('q')
+        for patient_index, patient in enumerate(patients):
+            patient_codes.append(patient.access_code)
+            records = records_of(patient) if records_of else patient.medical_records
+            for record in records:
+                record_index = len(record_condition)
+                record_patient.append(patient_index)
+                record_condition.append(conditions.add(record.condition))
+                record_time.append(timestamp_micros(record.timestamp))
+                for medication in record.medications:
+                    medication_record.append(record_index)
+                    medication_code.append(medications.add(medication))
+                for allergy in record.allergies:
+                    allergy_record.append(record_index)
+                    allergy_code.append(allergies.add(allergy))
+        return cls(patient_codes, as_numpy(record_patient), as_numpy(record_condition), as_numpy(record_time),
+                   as_numpy(medication_record), as_numpy(medication_code),
+                   as_numpy(allergy_record), as_numpy(allergy_code),
+                   conditions.strings, medications.strings, allergies.strings)
+
+    @classmethod
+    def from_binary(cls, path):
+        """Encode the live records of a binary patients file without building any Patient objects."""
+        with open(path, 'rb') as f:
+            strings, columns = codec.read_binary_columns(f.read())
+        (name_ids, code_ids, location_ids, email_ids, record_counts, reminder_counts, appointment_counts,
+         condition_ids, timestamps, timestamp_text_ids, url_ids, medication_counts, allergy_counts,
+         medication_ids, allergy_ids, reminder_ids, appointment_ids) = [as_numpy(column) for column in columns]
+        record_patient = np.repeat(np.arange(len(code_ids)), record_counts)
+        timestamps = text_timestamps(timestamps, timestamp_text_ids, strings)
+        record_index = np.arange(len(condition_ids))
+        record_condition, condition_names = recode(condition_ids, strings)
+        medication_code, medication_names = recode(medication_ids, strings)
+        allergy_code, allergy_names = recode(allergy_ids, strings)
+        return cls([strings[i] for i in code_ids.tolist()], record_patient, record_condition, timestamps,
+                   np.repeat(record_index, medication_counts), medication_code,
+                   np.repeat(record_index, allergy_counts), allergy_code,
+                   condition_names, medication_names, allergy_names)
+
+    def condition_counts(self):
+        """Records per condition."""
+        codes = self.record_condition[self.record_condition >= 0]
+        counts = np.bincount(codes, minlength=len(self.condition_names))
+        return dict(zip(self.condition_names, counts.tolist()))
+
+    def patients_per_condition(self):
+        """Distinct patients per condition."""
+        size = len(self.condition_names)
+        valid = self.record_condition >= 0
+        pairs = np.unique(self.record_patient[valid] * size + self.record_condition[valid])
+        counts = np.bincount(pairs % size, minlength=size) if size else np.zeros(0, dtype=np.int64)
+        return dict(zip(self.condition_names, counts.tolist()))
+
+    def medication_counts(self):
+        counts = np.bincount(self.medication_code, minlength=len(self.medication_names))
+        return dict(zip(self.medication_names, counts.tolist()))
+
+    def allergy_counts(self):
+        counts = np.bincount(self.allergy_code, minlength=len(self.allergy_names))
+        return dict(zip(self.allergy_names, counts.tolist()))
+
+    def record_months(self, mask=None):
+        """Return (month labels, month index per selected record) for records with a datetime timestamp."""
+        valid = self.record_time != NO_TIMESTAMP
+        if mask is not None:
+            valid &= mask
+        months = self.record_time[valid].astype('datetime64[us]').astype('datetime64[M]')
+        labels, month_index = np.unique(months, return_inverse=True)
+        return [str(label) for label in labels], month_index, valid
+
+    def records_per_month(self):
+        labels, month_index, _ = self.record_months()
+        return dict(zip(labels, np.bincount(month_index, minlength=len(labels)).tolist()))
+
+    def condition_trends(self):
+        """Return (month labels, condition names, matrix) where matrix[m, c] counts records of c in month m."""
+        size = len(self.condition_names)
+        labels, month_index, valid = self.record_months(self.record_condition >= 0)
+        keys = month_index * size + self.record_condition[valid]
+        matrix = np.bincount(keys, minlength=len(labels) * size).reshape(len(labels), size)
+        return labels, list(self.condition_names), matrix
+
+    def medication_cooccurrence(self):
+        """Return (medication names, first, second, counts) for every pair of medications listed together.
+
+        ``first`` < ``second`` are codes into the names and ``counts[i]`` is the
+        number of records listing both; pairs that never occur are left out.
+        medication_counts() gives the records per single medication.
+        """
+        size = len(self.medication_names)
+        # One entry per (record, medication), sorted by record and then medication code.
+        keys = np.unique(self.medication_record * size + self.medication_code)
+        records, codes = keys // size, keys % size
+        pair_keys = []
+        distance = 1
+        # Entries ``distance`` apart in the same record are pairs; stop once no record is that long.
+        while distance < len(records):
+            same = records[distance:] == records[:-distance]
+            if not same.any():
+                break
+            pair_keys.append(codes[:-distance][same] * size + codes[distance:][same])
+            distance += 1
+        pairs = np.concatenate(pair_keys) if pair_keys else np.zeros(0, dtype=np.int64)
+        pairs, counts = np.unique(pairs, return_counts=True)
+        return list(self.medication_names), pairs // size, pairs % size, counts
+
+    def top_medication_pairs(self, count=10):
+        names, first, second, counts = self.medication_cooccurrence()
+        # Stable, so pairs with the same count keep their code order
+        top = np.argsort(-counts, kind='stable')[:count]
+        return [(names[a], names[b], int(n)) for a, b, n in
+                zip(first[top].tolist(), second[top].tolist(), counts[top].tolist())]
+
+    def provider_load(self, memberships):
+        """Patients and records per provider; ``memberships`` maps access code -> provider names."""
+        index = {code: i for i, code in enumerate(self.patient_codes)}
+        providers = StringTable()
+        pair_patient, pair_provider = array('q'), array('q')
+        for code, names in memberships.items():
+            patient_index = index.get(code)
+            if patient_index is None:
+                continue
+            for name in names:
+                pair_patient.append(patient_index)
+                pair_provider.append(providers.add(name))
+        pair_patient, pair_provider = as_numpy(pair_patient), as_numpy(pair_provider)
+        records_per_patient = np.bincount(self.record_patient, minlength=len(self.patient_codes))
+        size = len(providers.strings)
+        patients = np.bincount(pair_provider, minlength=size)
+        records = np.bincount(pair_provider, weights=records_per_patient[pair_patient], minlength=size)
+        return {name: {'patients': int(patients[i]), 'records': int(records[i])}
+                for i, name in enumerate(providers.strings)}
@@ -0,0 +1,346 @@
+"""Compressed, chunked backups of all HealthLinkSystem state, with restore to a point in time.
+
+A backup is one file, medilink_data/backups/backup-<YYYYmmddTHHMMSS.ffffff>.mlbk::
+
+    MAGIC, then chunks of: <16sQ32s section name, payload length, sha256 of payload> payload
+
+Patients are written in chunks of CHUNK_PATIENTS, the record archive and the
+logs (record history, change feed, refills) in raw CHUNK_BYTES pieces, and
+everything else (memberships, users, staff, reminders, inventory, beds) as one
+chunk each; a 'manifest' chunk closes the file. The state is serialized under
+the system lock, which is released before anything is compressed. Chunks
+are zlib-compressed on a thread pool (zlib releases the GIL) while earlier
+chunks are written, and in encrypted storage mode each compressed chunk is also
+sealed. Restoring verifies every checksum and streams patients back into the
+live patient file one chunk at a time; all restored files are swapped in
+together as one FileGroup.
+
+    python backup.py create
+    python backup.py list
+    python backup.py verify medilink_data/backups/backup-20240101T120000.000000.mlbk
+    python backup.py restore --to "2024-01-01 12:30"
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import struct
+import sys
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+
+import codec
+import encryption
+import metrics
+from transaction import FileGroup, atomic_write, recover_file_group
+
+MAGIC = b'MLNKBAK\x01'
+CHUNK_HEADER = struct.Struct('<16sQ32s')
+BACKUP_DIR = os.path.join("medilink_data", "backups")
+NAME_FORMAT = "backup-%Y%m%dT%H%M%S.%f.mlbk"
+# Backups written before names carried microseconds
+OLD_NAME_FORMAT = "backup-%Y%m%dT%H%M%S.mlbk"
+LOG_PATHS = {
+    'record_history': os.path.join("medilink_data", "record_history.jsonl"),
+    'changes': os.path.join("medilink_data", "changes.jsonl"),
+    'refills': os.path.join("medilink_data", "refills.jsonl"),
+}
+CHUNK_PATIENTS = 1000
+CHUNK_BYTES = 4 * 1024 * 1024
+COMPRESSION_LEVEL = 6
+# HealthLinkSystem's save journal, so load_data also finishes a restore interrupted after its commit
+RESTORE_JOURNAL = os.path.join("medilink_data", "save.journal")
+
+
+class BackupError(Exception):
+    pass
+
+
+def backup_time(path):
+    name = os.path.basename(path)
+    try:
+        return datetime.strptime(name, NAME_FORMAT)
+    except ValueError:
+        return datetime.strptime(name, OLD_NAME_FORMAT)
+
+
+def list_backups(directory=BACKUP_DIR):
+    """Backup paths, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    paths = []
+    for name in os.listdir(directory):
+        try:
+            backup_time(name)
+        except ValueError:
+            continue
+        paths.append(os.path.join(directory, name))
+    return sorted(paths, key=backup_time)
+
+
+def new_backup_path(directory):
+    when = datetime.now()
+    # Names must stay unique and in time order even when the clock has not moved on
+    while True:
+        path = os.path.join(directory, when.strftime(NAME_FORMAT))
+        if not os.path.exists(path):
+            return path
+        when += timedelta(microseconds=1)
+
+
+def backup_at(when, directory=BACKUP_DIR):
+    """The newest backup taken at or before ``when``, or None."""
+    chosen = None
+    for path in list_backups(directory):
+        if backup_time(path) <= when:
+            chosen = path
+    return chosen
+
+
+def pack_chunk(data, keyring, section):
+    payload = zlib.compress(data, COMPRESSION_LEVEL)
+    if keyring is not None:
+        payload = keyring.seal(payload, section.encode('utf-8'))
+    return payload, hashlib.sha256(payload).digest()
+
+
+def unpack_chunk(payload, keyring, section):
+    if keyring is not None:
+        payload = keyring.open(payload, section.encode('utf-8'))
+    return zlib.decompress(payload)
+
+
+def state_chunks(system):
+    """Yield (section, bytes) for everything a backup holds, patients streamed in chunks."""
+    system.load_all_patients()
+    patients = list(system.patients.values())
+    for start in range(0, len(patients), CHUNK_PATIENTS):
+        chunk = [codec.patient_to_dict(patient) for patient in patients[start:start + CHUNK_PATIENTS]]
+        yield 'patients', json.dumps(chunk).encode('utf-8')
+    yield 'memberships', json.dumps(system.directory.memberships_to_dict()).encode('utf-8')
+    yield 'users', json.dumps({name: user.to_dict() for name, user in system.users.items()}).encode('utf-8')
+    yield 'staff_profiles', pickle.dumps(system.staff_profiles)
+    yield 'state', json.dumps(system.state_to_dict(), default=str).encode('utf-8')
+    yield from file_chunks('record_archive', system.archive.path)
+    for section, log in (('record_history', system.record_history), ('changes', system.changes),
+                         ('refills', system.refills)):
+        # Always at least one chunk, so restoring replaces the log even when it was empty
+        yield from file_chunks(section, log.path, empty=b'')
+
+
+def file_chunks(section, path, empty=None):
+    """Yield (section, bytes) for the raw contents of ``path``; ``empty`` is yielded if it has none."""
+    found = False
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(CHUNK_BYTES), b''):
+                found = True
+                yield section, data
+    if not found and empty is not None:
+        yield section, empty
+
+
+@metrics.timed('save', 'create_backup')
+def create_backup(system, directory=BACKUP_DIR, workers=None, keep=None):
+    """Write a backup of ``system`` and return its path; keeps only the newest ``keep`` backups if given."""
+    os.makedirs(directory, exist_ok=True)
+    path = new_backup_path(directory)
+    keyring = system.keyring
+    counts = {}
+    # The same default as ThreadPoolExecutor, which is needed here to bound the chunks in flight.
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    # Only taking the snapshot holds up other threads; compressing and writing it do not
+    with system.lock:
+        chunks = deque(state_chunks(system))
+        change_sequence = system.changes.sequence
+    with atomic_write(path, 'wb') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        f.write(MAGIC)
+        in_flight = deque()
+        limit = 2 * workers
+
+        def write_next():
+            section, future = in_flight.popleft()
+            payload, checksum = future.result()
+            f.write(CHUNK_HEADER.pack(section.encode('utf-8'), len(payload), checksum))
+            f.write(payload)
+
+        while chunks:
+            # Taken off the snapshot as they are submitted, so each chunk is freed once it is written
+            section, data = chunks.popleft()
+            counts[section] = counts.get(section, 0) + 1
+            in_flight.append((section, executor.submit(pack_chunk, data, keyring, section)))
+            # Bounded, so the compressed chunks are never all held in memory at once.
+            if len(in_flight) >= limit:
+                write_next()
+        while in_flight:
+            write_next()
+        manifest = {
+            'created': datetime.now().isoformat(),
+            'schema_version': codec.SCHEMA_VERSION,
+            'chunks': counts,
+            'change_sequence': change_sequence,
+        }
+        payload, checksum = pack_chunk(json.dumps(manifest).encode('utf-8'), keyring, 'manifest')
+        f.write(CHUNK_HEADER.pack(b'manifest', len(payload), checksum))
+        f.write(payload)
+    if keep:
+        for old in list_backups(directory)[:-keep]:
+            os.remove(old)
+    metrics.increment('backups_created')
+    return path
+
+
+def iter_chunks(path, keyring=None):
+    """Yield (section, data) from a backup, verifying each checksum; reads one chunk at a time."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise BackupError(f"{path} is not a MediLink backup")
+        index = 0
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if not header:
+                raise BackupError(f"{path} ends before its manifest")
+            if len(header) < CHUNK_HEADER.size:
+                raise BackupError(f"{path} is truncated in chunk {index}")
+            section, length, checksum = CHUNK_HEADER.unpack(header)
+            section = section.rstrip(b'\0').decode('utf-8')
+            payload = f.read(length)
+            if len(payload) < length or hashlib.sha256(payload).digest() != checksum:
+                raise BackupError(f"Checksum mismatch in chunk {index} ({section}) of {path}")
+            try:
+                data = unpack_chunk(payload, keyring, section)
+            except Exception as e:
+                # A wrong or missing key, or a sealed backup read in plain mode.
+                raise BackupError(f"Cannot unpack chunk {index} ({section}) of {path}: {e!r}")
+            yield section, data
+            if section == 'manifest':
+                return
+            index += 1
+
+
+def verify_backup(path, keyring=None):
+    """Check every chunk of ``path`` and return its manifest."""
+    manifest = None
+    for section, data in iter_chunks(path, keyring):
+        if section == 'manifest':
+            manifest = json.loads(data)
+    return manifest
+
+
+def write_patient(f, patient, first, keyring=None):
+    """Append one patient dict to a patients.json (or, with ``keyring``, patients.enc) being streamed."""
+    if keyring is not None:
+        lookup_key, blob = encryption.seal_patient_dict(keyring, patient)
+        f.write(encryption.ENTRY_HEADER.pack(lookup_key, len(blob)))
+        f.write(blob)
+    else:
+        f.write(('' if first else ', ') + json.dumps(patient['name']) + ': ' + json.dumps(patient))
+
+
+@metrics.timed('load', 'restore_backup')
+def restore_backup(path, keyring=None):
+    """Replace the live data files in the working directory with the contents of ``path``.
+
+    Patients are streamed chunk by chunk into patients.json, or patients.enc
+    when ``keyring`` is given; a system in binary mode reads the JSON file and
+    writes its own format again on the next save.
+    """
+    os.makedirs("medilink_data", exist_ok=True)
+    recover_file_group(RESTORE_JOURNAL)
+    archive_path = os.path.join("medilink_data", "record_archive.enc" if keyring is not None else "record_archive.bin")
+    restored = []
+    patients_path = 'patients.enc' if keyring is not None else 'patients.json'
+    # Every file is replaced in one FileGroup, so an interrupted restore leaves the old data or the new, never a mix
+    with FileGroup(RESTORE_JOURNAL) as group:
+        with ExitStack() as stack:
+            f = stack.enter_context(group.write(patients_path, 'wb' if keyring is not None else 'w'))
+            archive_file = stack.enter_context(group.write(archive_path, 'wb'))
+            # Log lines are copied as they are; in encrypted mode they are already sealed
+            logs = {}
+            if keyring is not None:
+                f.write(encryption.MAGIC)
+            else:
+                f.write('{"schema_version": %d, "patients": {' % codec.SCHEMA_VERSION)
+            first = True
+            for section, data in iter_chunks(path, keyring):
+                if section == 'patients':
+                    for patient in json.loads(data):
+                        write_patient(f, patient, first, keyring)
+                        first = False
+                elif section == 'record_archive':
+                    # Without any chunks the archive is left empty, which reads as having no records
+                    archive_file.write(data)
+                elif section in LOG_PATHS:
+                    if section not in logs:
+                        logs[section] = stack.enter_context(group.write(LOG_PATHS[section], 'wb'))
+                    logs[section].write(data)
+                elif section != 'manifest':
+                    restored.append((section, data))
+            if keyring is None:
+                f.write('}}')
+
+        if keyring is None and os.path.exists('patients.bin'):
+            # It would be read instead of the restored patients.json.
+            group.remove('patients.bin')
+        for section, data in restored:
+            if section == 'staff_profiles':
+                name = os.path.join("medilink_data",
+                                    "staff_profiles.enc" if keyring is not None else "staff_profiles.pkl")
+            else:
+                name = f'{section}.enc' if keyring is not None else f'{section}.json'
+            if keyring is not None:
+                data = encryption.seal_file(keyring, name, data)
+            with group.write(name, 'wb') as section_file:
+                section_file.write(data)
+    metrics.increment('backups_restored')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Back up and restore MediLink data.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    create = subparsers.add_parser('create', help="write a new backup")
+    create.add_argument('--workers', type=int, default=None)
+    create.add_argument('--keep', type=int, default=None, help="delete all but the newest KEEP backups")
+    subparsers.add_parser('list', help="list backups")
+    verify = subparsers.add_parser('verify', help="check every chunk of a backup")
+    verify.add_argument('path')
+    restore = subparsers.add_parser('restore', help="restore the newest backup taken at or before a time")
+    restore.add_argument('--to', help="'YYYY-MM-DD HH:MM[:SS]'; defaults to the newest backup")
+    restore.add_argument('--path', help="restore this backup file instead")
+    args = parser.parse_args(argv)
+
+    keyring = encryption.Keyring.load() if os.getenv('MEDILINK_STORAGE_FORMAT') == 'encrypted' else None
+
+    if args.command == 'create':
+        from MediLink1 import HealthLinkSystem
+        system = HealthLinkSystem(start_backup=False)
+        print(create_backup(system, workers=args.workers, keep=args.keep))
+    elif args.command == 'list':
+        for path in list_backups():
+            print(f"{backup_time(path)}  {path}  {os.path.getsize(path)} bytes")
+    elif args.command == 'verify':
+        try:
+            manifest = verify_backup(args.path, keyring)
+        except BackupError as e:
+            print(e)
+            return 1
+        print(json.dumps(manifest, indent=2))
+    elif args.command == 'restore':
+        path = args.path
+        if path is None:
+            when = datetime.fromisoformat(args.to) if args.to else datetime.now()
+            path = backup_at(when)
+        if path is None:
+            print("No backup was taken at or before that time.")
+            return 1
+        restore_backup(path, keyring)
+        print(f"Restored {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""Ward capacities, bed assignment and the admission wait-list.
+
+Beds are numbered 1..capacity per ward and hold a patient's access code. Each
+ward keeps its free beds in a min-heap and its wait-list in a heap ordered by
+(priority, arrival), so admitting, discharging and finding the next free bed
+are O(log n). Heap entries are deleted lazily: a popped entry that is no longer
+free (or no longer waiting) is skipped. Occupancy counts follow every change,
+so they never have to be entered by hand.
+"""
+import heapq
+import itertools
+
+
+class Ward:
+    def __init__(self, name, capacity=0):
+        self.name = name
+        self.capacity = 0
+        self.free = set()
+        self.free_heap = []
+        self.occupants = {}
+        self.waiting_heap = []
+        self.waiting = 0
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        if capacity < 0:
+            raise ValueError("Ward capacity cannot be negative")
+        for bed in range(capacity + 1, self.capacity + 1):
+            self.free.discard(bed)
+        for bed in range(self.capacity + 1, capacity + 1):
+            if bed not in self.occupants:
+                self.release(bed)
+        self.capacity = capacity
+
+    def release(self, bed):
+        if bed not in self.free:
+            self.free.add(bed)
+            heapq.heappush(self.free_heap, bed)
+
+    def next_free_bed(self):
+        heap = self.free_heap
+        while heap and heap[0] not in self.free:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def occupancy(self):
+        return {
+            'capacity': self.capacity,
+            'occupied': len(self.occupants),
+            'free': len(self.free),
+            'waiting': self.waiting,
+        }
+
+
+class BedManager:
+    def __init__(self):
+        self.wards = {}
+        # access code -> (ward name, bed number)
+        self.placements = {}
+        # access code -> wait-list entry (priority, arrival, access code, ward name)
+        self.waiting = {}
+        self.arrivals = itertools.count()
+
+    def ward(self, name):
+        ward = self.wards.get(name)
+        if ward is None:
+            raise KeyError(f"Unknown ward: {name}")
+        return ward
+
+    def set_capacity(self, name, capacity):
+        """Create or resize a ward; new beds go to waiting patients first. Returns [(code, bed)] admitted."""
+        ward = self.wards.get(name)
+        if ward is None:
+            ward = self.wards[name] = Ward(name, capacity)
+        else:
+            # Occupied beds above a reduced capacity stay until their patient is discharged.
+            ward.resize(capacity)
+        return self.admit_waiting(ward)
+
+    def bed_of(self, access_code):
+        return self.placements.get(access_code)
+
+    def is_waiting(self, access_code):
+        return access_code in self.waiting
+
+    def next_free_bed(self, name):
+        return self.ward(name).next_free_bed()
+
+    def occupy(self, access_code, name, bed):
+        ward = self.ward(name)
+        ward.free.discard(bed)
+        ward.occupants[bed] = access_code
+        self.placements[access_code] = (name, bed)
+
+    def vacate(self, access_code):
+        """Take a patient out of their bed without admitting anyone; returns (ward, bed) or None."""
+        placement = self.placements.pop(access_code, None)
+        if placement is not None:
+            name, bed = placement
+            ward = self.wards[name]
+            del ward.occupants[bed]
+            if bed <= ward.capacity:
+                ward.release(bed)
+        return placement
+
+    def enqueue(self, entry):
+        self.waiting[entry[2]] = entry
+        ward = self.ward(entry[3])
+        heapq.heappush(ward.waiting_heap, entry)
+        ward.waiting += 1
+
+    def dequeue(self, access_code):
+        """Drop a patient from the wait-list; returns their entry or None."""
+        entry = self.waiting.pop(access_code, None)
+        if entry is not None:
+            self.wards[entry[3]].waiting -= 1
+        return entry
+
+    def admit(self, access_code, name, priority=0):
+        """Put a patient in the lowest free bed of a ward, or on its wait-list (lower priority goes first).
+
+        Returns (ward, bed), or None if the patient is waiting.
+        """
+        if access_code in self.placements:
+            return self.placements[access_code]
+        ward = self.ward(name)
+        self.dequeue(access_code)
+        bed = ward.next_free_bed()
+        if bed is None:
+            self.enqueue((priority, next(self.arrivals), access_code, name))
+            return None
+        self.occupy(access_code, name, bed)
+        return name, bed
+
+    def admit_waiting(self, ward):
+        admitted = []
+        while ward.waiting:
+            bed = ward.next_free_bed()
+            if bed is None:
+                break
+            entry = heapq.heappop(ward.waiting_heap)
+            if self.waiting.get(entry[2]) is not entry:
+                continue
+            self.dequeue(entry[2])
+            self.occupy(entry[2], ward.name, bed)
+            admitted.append((entry, bed))
+        return admitted
+
+    def discharge(self, access_code):
+        """Free a patient's bed (or wait-list place) and admit whoever is next for that ward.
+
+        Returns (placement, wait-list entry, [(entry, bed)] admitted); placement
+        and entry are None if the patient had neither.
+        """
+        placement = self.vacate(access_code)
+        entry = self.dequeue(access_code)
+        admitted = self.admit_waiting(self.wards[placement[0]]) if placement else []
+        return placement, entry, admitted
+
+    def reassign(self, from_code, to_code):
+        """Hand a bed or wait-list place to another access code (used when patients are merged)."""
+        placement = self.vacate(from_code)
+        if placement is not None:
+            self.occupy(to_code, *placement)
+            return True
+        entry = self.dequeue(from_code)
+        if entry is not None:
+            self.enqueue((entry[0], entry[1], to_code, entry[3]))
+            return True
+        return False
+
+    def occupancy(self):
+        return {name: ward.occupancy() for name, ward in self.wards.items()}
+
+    def waiting_list(self, name):
+        """Waiting access codes of a ward in admission order."""
+        entries = [entry for entry in self.waiting.values() if entry[3] == name]
+        return [entry[2] for entry in sorted(entries)]
+
+    def to_dict(self):
+        return {
+            'wards': {name: {'capacity': ward.capacity,
+                             'beds': {str(bed): code for bed, code in ward.occupants.items()}}
+                      for name, ward in self.wards.items()},
+            'waiting': [[priority, code, name] for priority, _, code, name in sorted(self.waiting.values())],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        manager = cls()
+        data = data or {}
+        for name, ward_data in data.get('wards', {}).items():
+            ward = manager.wards[name] = Ward(name, ward_data.get('capacity', 0))
+            for bed, code in ward_data.get('beds', {}).items():
+                manager.occupy(code, name, int(bed))
+        for priority, code, name in data.get('waiting', []):
+            manager.enqueue((priority, next(manager.arrivals), code, name))
+        return manager
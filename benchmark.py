@@ -0,0 +1,337 @@
+"""Benchmark suite for the HealthLinkSystem hot paths.
+
+Run a scale and save the results:
+    python benchmark.py run --scale 1k --output bench-1k.json
+
+Compare two result files; the exit status is 1 when an operation regressed:
+    python benchmark.py compare bench-base.json bench-1k.json --threshold 1.25
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import backup
+from beds import BedManager
+from refills import RefillQueue
+import reports
+import synthetic_data
+
+try:
+    import analytics
+except ImportError:  # numpy is optional
+    analytics = None
+
+import encryption
+
+DEFAULT_THRESHOLD = 1.25
+LOOKUP_CALLS = 200
+FACILITY_COUNT = 20000
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def time_operation(func, repeat, calls=1, setup=None):
+    """Time ``func`` ``repeat`` times and return per-call statistics in seconds."""
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        # The menus print as they go; keep that I/O out of the measurement.
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        samples.append(elapsed / calls)
+    samples.sort()
+    return {
+        'status': 'ok',
+        'repeat': repeat,
+        'calls': calls,
+        'min_s': samples[0],
+        'median_s': percentile(samples, 0.5),
+        'mean_s': sum(samples) / len(samples),
+        'p95_s': percentile(samples, 0.95),
+        'max_s': samples[-1],
+    }
+
+
+def run_operation(results, name, func, repeat, calls=1, setup=None):
+    try:
+        results[name] = time_operation(func, repeat, calls, setup)
+    except Exception as e:
+        results[name] = {'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+    print(f"{name}: {format_result(results[name])}", file=sys.stderr)
+
+
+def format_result(result):
+    if result['status'] != 'ok':
+        return result.get('error') or result.get('reason', result['status'])
+    return f"median {result['median_s'] * 1000:.3f} ms/call over {result['repeat']}x{result['calls']}"
+
+
+def lookup_codes(system, rng, calls):
+    codes = [patient.access_code for patient in system.patients.values()]
+    hits = [rng.choice(codes) for _ in range(calls // 2)]
+    # Half the lookups use codes that do not exist, which is the worst case for a scan.
+    misses = [f"MISS{i:04d}" for i in range(calls - len(hits))]
+    return hits + misses
+
+
+def admit_and_discharge(patients, wards=10):
+    # Half the patients fit in a bed, the rest wait; then every other patient is discharged
+    beds = BedManager()
+    for ward in range(wards):
+        beds.set_capacity(ward, len(patients) // (2 * wards) + 1)
+    for i, patient in enumerate(patients):
+        beds.admit(patient.access_code, i % wards, i % 5)
+    for patient in patients[::2]:
+        beds.discharge(patient.access_code)
+    return beds
+
+
+def request_and_fulfil_refills(patients, path):
+    # Every patient asks for one medication, then each medication is fulfilled in one batch
+    if os.path.exists(path):
+        os.remove(path)
+    queue = RefillQueue(path)
+    medications = synthetic_data.MEDICATIONS
+    for i, patient in enumerate(patients):
+        queue.request(patient, medications[i % len(medications)], 1, 'benchmark')
+    queue.fulfil({medication: len(patients) for medication in medications})
+    return queue
+
+
+def run_benchmarks(scale, repeat=5, seed=0, snapshot_limit=10000):
+    count = synthetic_data.parse_scale(scale)
+    rng = random.Random(seed)
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='medilink-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        os.makedirs(os.path.join("medilink_data", "Patient_Records"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            system = synthetic_data.build_system(count, seed)
+        patients = list(system.patients.values())
+        provider = system.providers[0]
+
+        codes = lookup_codes(system, rng, LOOKUP_CALLS)
+        run_operation(results, 'access_medical_record',
+                      lambda: [system.access_medical_record(code) for code in codes],
+                      repeat, calls=len(codes))
+
+        healthlink = synthetic_data.build_healthlink_system(patients)
+        run_operation(results, 'share_medical_record',
+                      lambda: [healthlink.share_medical_record(code, healthlink.providers[0]) for code in codes],
+                      repeat, calls=len(codes))
+
+        keywords = [rng.choice(synthetic_data.LAST_NAMES) for _ in range(10)]
+        run_operation(results, 'search_patient',
+                      lambda: [provider.search_patient(keyword) for keyword in keywords],
+                      repeat, calls=len(keywords))
+
+        staff = system.staff_profiles
+        logins = [(profile['name'], profile['password']) for profile in rng.sample(staff, min(50, len(staff)))]
+        logins += [('nobody', 'wrong')] * len(logins)
+        run_operation(results, 'authenticate_provider',
+                      lambda: [system.authenticate_provider(name, password) for name, password in logins],
+                      repeat, calls=len(logins))
+
+        synthetic_data.write_patients_json(patients)
+        run_operation(results, 'load_data', system.load_data, repeat)
+        run_operation(results, 'save_data', system.save_data, repeat)
+        run_operation(results, 'export_patient_data', system.export_patient_data, repeat)
+        run_operation(results, 'generate_batch_reports',
+                      lambda: system.generate_batch_reports(patients, 'reports', reports.FORMATS), repeat)
+        # The first sync writes every patient; the timed ones find nothing changed
+        system.sync_web_data()
+        run_operation(results, 'sync_web_data', system.sync_web_data, repeat)
+        run_operation(results, 'create_backup', lambda: backup.create_backup(system, keep=1), repeat)
+        run_operation(results, 'admit_and_discharge', lambda: admit_and_discharge(patients),
+                      repeat, calls=len(patients) + len(patients[::2]))
+        system.linker = None
+        run_operation(results, 'find_duplicate_patients', system.find_duplicate_patients, repeat)
+        sample = rng.sample(patients, min(LOOKUP_CALLS, len(patients)))
+        system.timelines = {}
+        run_operation(results, 'records_last_90_days',
+                      lambda: [system.timeline(patient).last_days(90) for patient in sample],
+                      repeat, calls=len(sample))
+        system.change_index = None
+        run_operation(results, 'records_changed_since',
+                      lambda: system.records_changed_since(datetime.now() - timedelta(days=30)), repeat)
+        synthetic_data.write_facilities_csv(FACILITY_COUNT, seed)
+        system.facilities = None
+        locations = [patient.location for patient in rng.sample(patients, min(LOOKUP_CALLS, len(patients)))]
+        run_operation(results, 'nearest_facilities',
+                      lambda: [system.nearest_facilities(location) for location in locations],
+                      repeat, calls=len(locations))
+        run_operation(results, 'facilities_within_radius',
+                      lambda: [system.nearest_facilities(location, 20, radius_km=10) for location in locations],
+                      repeat, calls=len(locations))
+        run_operation(results, 'request_refills',
+                      lambda: request_and_fulfil_refills(patients, os.path.join("medilink_data", "bench-refills.jsonl")),
+                      repeat, calls=len(patients))
+
+        system.storage_format = 'binary'
+        run_operation(results, 'save_data_binary', system.save_data, repeat)
+        run_operation(results, 'load_data_binary', system.load_data, repeat)
+        system.storage_format = 'json'
+
+        if encryption.AESGCM is not None:
+            system.keyring = encryption.Keyring(os.urandom(32))
+            system.storage_format = 'encrypted'
+            run_operation(results, 'save_data_encrypted', system.save_data, repeat)
+            run_operation(results, 'load_data_encrypted_deferred', system.load_data, repeat)
+            run_operation(results, 'load_data_encrypted',
+                          lambda: (system.load_data(), system.load_all_patients()), repeat)
+            run_operation(results, 'read_stored_patient',
+                          lambda: [system.read_stored_patient(code) for code in codes],
+                          repeat, calls=len(codes))
+            system.keyring = None
+            system.storage_format = 'json'
+        else:
+            for name in ('save_data_encrypted', 'load_data_encrypted_deferred', 'load_data_encrypted',
+                         'read_stored_patient'):
+                results[name] = {'status': 'skipped', 'reason': 'cryptography is not installed'}
+
+        if analytics is not None:
+            run_operation(results, 'record_columns', system.record_columns, repeat)
+            run_operation(results, 'record_columns_binary',
+                          lambda: analytics.RecordColumns.from_binary('patients.bin'), repeat)
+            columns = system.record_columns()
+            run_operation(results, 'condition_trends', columns.condition_trends, repeat)
+            run_operation(results, 'medication_cooccurrence', columns.medication_cooccurrence, repeat)
+        else:
+            for name in ('record_columns', 'record_columns_binary', 'condition_trends', 'medication_cooccurrence'):
+                results[name] = {'status': 'skipped', 'reason': 'numpy is not installed'}
+
+        snapshot_patients = patients[:snapshot_limit]
+        synthetic_data.write_patient_record_files(snapshot_patients)
+        run_operation(results, 'load_patient_records', system.load_patient_records, repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scale': scale,
+            'patients': count,
+            'records': sum(len(patient.medical_records) for patient in patients),
+            'snapshot_files': len(snapshot_patients),
+            'seed': seed,
+        },
+        'results': results,
+    }
+
+
+def parse_thresholds(values):
+    default = DEFAULT_THRESHOLD
+    per_operation = {}
+    for value in values or []:
+        if '=' in value:
+            name, ratio = value.split('=', 1)
+            per_operation[name] = float(ratio)
+        else:
+            default = float(value)
+    return default, per_operation
+
+
+def compare_results(baseline, current, default_threshold=DEFAULT_THRESHOLD, per_operation=None):
+    """Return a list of (operation, ratio, threshold, regressed) for operations present in both runs.
+
+    An operation that ran in the baseline but fails now is a regression with a
+    ratio of None; one skipped in either run (a missing dependency) is left out.
+    """
+    per_operation = per_operation or {}
+    rows = []
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base or base['status'] != 'ok':
+            continue
+        threshold = per_operation.get(name, default_threshold)
+        if result['status'] == 'error':
+            rows.append((name, None, threshold, True))
+            continue
+        if result['status'] != 'ok':
+            continue
+        ratio = result['median_s'] / base['median_s'] if base['median_s'] else float('inf')
+        rows.append((name, ratio, threshold, ratio > threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark HealthLinkSystem hot paths.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="run the benchmarks at one scale")
+    run_parser.add_argument('--scale', default='1k', help="1k, 100k, 1m or a patient count")
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--snapshot-limit', type=int, default=10000,
+                            help="maximum Patient_Records files written for load_patient_records")
+    run_parser.add_argument('--output', help="write the JSON results here instead of stdout")
+
+    compare_parser = subparsers.add_parser('compare', help="compare two result files")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', action='append',
+                                help="allowed slowdown ratio, either global (1.25) or per operation (save_data=1.5)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        report = run_benchmarks(args.scale, args.repeat, args.seed, args.snapshot_limit)
+        text = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text)
+        else:
+            print(text)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    default, per_operation = parse_thresholds(args.threshold)
+    regressed = False
+    for name, ratio, threshold, is_regression in compare_results(baseline, current, default, per_operation):
+        if ratio is None:
+            print(f"{name:24} REGRESSION, now fails: {format_result(current['results'][name])}")
+        else:
+            status = "REGRESSION" if is_regression else "ok"
+            print(f"{name:24} {ratio:6.2f}x (limit {threshold:.2f}x) {status}")
+        regressed = regressed or is_regression
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""Append-only change feed for systems that follow MediLink data.
+
+HealthLinkSystem appends one JSON line per change to medilink_data/changes.jsonl:
+patient_added, patient_deleted, patient_transferred, record_added,
+record_updated, appointment_changed, bed_assigned, bed_released,
+bed_waitlisted and patients_merged. Every event carries a sequence number,
+given when it is written, so the numbers in the file always go up. Inside a
+transaction the events are buffered in it and written together at commit; a
+rolled back transaction writes none, not even the events its undo steps raise.
+
+Events hold identifiers and bookkeeping only: access codes, record indexes,
+the names of changed fields, wards, beds, providers and counts. Patient names
+and record contents are never in the feed; a follower that needs them reads the
+patient by access code.
+
+In encrypted storage mode every line is sealed (see encryption.log_codec) and
+the reader needs the same master key.
+
+A consumer remembers the byte offset after the last line it handled and
+resumes from there:
+    python changefeed.py --offset-file orders.offset --follow
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+import encryption
+from transaction import atomic_write
+
+DEFAULT_PATH = os.path.join("medilink_data", "changes.jsonl")
+TAIL_BYTES = 65536
+
+
+def last_sequence(path, loads=json.loads):
+    """Sequence number of the last complete event in ``path``, or 0."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - TAIL_BYTES))
+        lines = f.read().split(b'\n')
+    # The last element is empty after a complete line, or a torn write otherwise.
+    for line in reversed(lines[:-1]):
+        try:
+            return loads(line)['seq']
+        except (ValueError, KeyError):
+            continue
+    return 0
+
+
+def truncate_torn_tail(path):
+    """Cut off a last line left incomplete by a crash, so new events start on a fresh line."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if not size:
+            return
+        f.seek(max(0, size - TAIL_BYTES))
+        tail = f.read()
+        if tail.endswith(b'\n'):
+            return
+        end = tail.rfind(b'\n')
+        f.truncate(size - len(tail) + end + 1 if end >= 0 else max(0, size - len(tail)))
+
+
+class ChangeFeed:
+    def __init__(self, path=DEFAULT_PATH, keyring=None):
+        self.path = path
+        truncate_torn_tail(path)
+        encryption.seal_plain_lines(keyring, path)
+        self.dumps, loads = encryption.log_codec(keyring, path)
+        self.sequence = last_sequence(path, loads)
+        # Threads that do not share the system lock (e.g. request handlers) may emit at once
+        self.lock = threading.Lock()
+        # Returns the list to hold events in until commit (the caller's transaction), or None
+        self.buffer = lambda: None
+
+    def emit(self, event_type, **data):
+        event = {'time': datetime.now().isoformat(), 'type': event_type}
+        event.update(data)
+        pending = self.buffer()
+        if pending is not None:
+            with self.lock:
+                pending.append(event)
+        else:
+            self.write_events([event])
+        return event
+
+    def write_events(self, events):
+        if not events:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Numbering and appending under one lock keeps the file in sequence order
+        with self.lock:
+            numbered = []
+            for event in events:
+                self.sequence += 1
+                numbered.append(dict({'seq': self.sequence}, **event))
+            with open(self.path, 'a') as f:
+                f.write(''.join(self.dumps(event) + "\n" for event in numbered))
+
+
+class FeedReader:
+    """Reads a change feed from a byte offset; the offset can be saved to resume later."""
+
+    def __init__(self, path=DEFAULT_PATH, offset_path=None, offset=0, keyring=None):
+        self.path = path
+        _, self.loads = encryption.log_codec(keyring, path)
+        self.offset_path = offset_path
+        self.offset = offset
+        if offset_path and os.path.exists(offset_path):
+            with open(offset_path, 'r') as f:
+                self.offset = int(f.read().strip() or 0)
+
+    def read(self, limit=None):
+        """Return the events after the current offset and move past them."""
+        if not os.path.exists(self.path):
+            return []
+        events = []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Still being written; picked up by the next read.
+                    break
+                self.offset += len(line)
+                events.append(self.loads(line))
+                if limit is not None and len(events) >= limit:
+                    break
+        return events
+
+    def commit(self):
+        if self.offset_path:
+            with atomic_write(self.offset_path) as f:
+                f.write(str(self.offset))
+
+    def follow(self, poll_interval=1.0):
+        while True:
+            events = self.read()
+            for event in events:
+                yield event
+            self.commit()
+            if not events:
+                time.sleep(poll_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print MediLink change events as JSON lines.")
+    parser.add_argument('--path', default=DEFAULT_PATH)
+    parser.add_argument('--offset', type=int, default=0, help="byte offset to start from")
+    parser.add_argument('--offset-file', help="load the start offset from, and save progress to, this file")
+    parser.add_argument('--follow', action='store_true', help="keep polling for new events")
+    args = parser.parse_args(argv)
+
+    keyring = encryption.Keyring.load() if os.getenv('MEDILINK_STORAGE_FORMAT') == 'encrypted' else None
+    reader = FeedReader(args.path, args.offset_file, args.offset, keyring)
+    events = reader.follow() if args.follow else reader.read()
+    try:
+        for event in events:
+            print(json.dumps(event))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    reader.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""Serialization for patients, medical records, reminders and appointments.
+
+Two formats share one schema version:
+
+* JSON: ``{"schema_version": 2, "patients": {name: patient_dict}}``. Files written
+  before the schema existed (a bare ``{name: patient_dict}`` mapping with
+  ``"%Y-%m-%d %H:%M:%S"`` timestamps) still load.
+* Binary: a column-oriented file. All strings go into one table and are referenced
+  by index; numbers are packed into ``array`` columns; timestamps are stored as
+  microseconds since the epoch. Loading it skips JSON parsing and timestamp string
+  parsing entirely.
+
+Only the binary format loads faster than the original loader: JSON files cost
+about what they did before, and the rest of startup (aggregates, search index)
+is the same for both formats.
+"""
+import json
+import struct
+from array import array
+from datetime import datetime, timedelta
+
+SCHEMA_VERSION = 2
+LEGACY_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+BINARY_MAGIC = b'MLNKBIN\x01'
+EPOCH = datetime(1970, 1, 1)
+NO_TIMESTAMP = -(2 ** 63)
+NO_STRING = -1
+
+
+def parse_timestamp(value):
+    """Turn a stored timestamp string into a datetime; free-text values are returned unchanged."""
+    if not value:
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value, LEGACY_TIMESTAMP_FORMAT)
+    except ValueError:
+        return value
+
+
+def format_timestamp(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return value
+
+
+def record_to_dict(record):
+    data = {
+        'condition': record.condition,
+        'medications': record.medications,
+        'allergies': record.allergies,
+        'timestamp': format_timestamp(record.timestamp),
+    }
+    url = getattr(record, 'url', None)
+    if url:
+        data['url'] = url
+    return data
+
+
+def record_from_dict(data, record_cls):
+    timestamp = data.get('timestamp')
+    record = record_cls(data['condition'], data['medications'], data['allergies'],
+                        parse_timestamp(timestamp) if isinstance(timestamp, str) else timestamp)
+    if data.get('url'):
+        record.url = data['url']
+    return record
+
+
+def patient_to_dict(patient):
+    data = {
+        'name': patient.name,
+        'access_code': patient.access_code,
+        'medical_records': [record_to_dict(record) for record in patient.medical_records],
+        'location': getattr(patient, 'location', None),
+        'medication_reminders': getattr(patient, 'medication_reminders', []),
+        'appointments': getattr(patient, 'appointments', []),
+    }
+    email = getattr(patient, 'email', None)
+    if email:
+        data['email'] = email
+    return data
+
+
+def patient_from_dict(data, patient_cls, record_cls):
+    records = [record_from_dict(record, record_cls) for record in data.get('medical_records', [])]
+    first = records[0] if records else record_cls(None, [], [], None)
+    patient = patient_cls(data['name'], data['access_code'], first.condition, first.medications,
+                          first.allergies, first.timestamp)
+    patient.medical_records = records
+    patient.location = data.get('location')
+    patient.medication_reminders = list(data.get('medication_reminders', []))
+    patient.appointments = list(data.get('appointments', []))
+    if data.get('email'):
+        patient.email = data['email']
+    return patient
+
+
+def patients_to_json(patients):
+    return {
+        'schema_version': SCHEMA_VERSION,
+        'patients': {patient.name: patient_to_dict(patient) for patient in patients},
+    }
+
+
+def patients_from_json(data, patient_cls, record_cls):
+    # Files from before the schema version are a bare name -> patient mapping.
+    if isinstance(data.get('schema_version'), int):
+        if data['schema_version'] > SCHEMA_VERSION:
+            raise ValueError(f"Unsupported patient data schema version {data['schema_version']}")
+        data = data['patients']
+    return {name: patient_from_dict(patient_data, patient_cls, record_cls) for name, patient_data in data.items()}
+
+
+def dump_json(patients, f):
+    json.dump(patients_to_json(patients), f)
+
+
+def load_json(f, patient_cls, record_cls):
+    return patients_from_json(json.load(f), patient_cls, record_cls)
+
+
+class StringTable:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def add(self, value):
+        if value is None:
+            return NO_STRING
+        string_id = self.ids.get(value)
+        if string_id is None:
+            string_id = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+
+
+def write_column(f, column):
+    f.write(struct.pack('<cQ', column.typecode.encode(), len(column)))
+    f.write(column.tobytes())
+
+
+def read_column(data, offset):
+    typecode, length = struct.unpack_from('<cQ', data, offset)
+    offset += struct.calcsize('<cQ')
+    column = array(typecode.decode())
+    size = length * column.itemsize
+    column.frombytes(data[offset:offset + size])
+    return column, offset + size
+
+
+def dump_binary(patients, f):
+    strings = StringTable()
+    add = strings.add
+    patient_columns = [array('q') for _ in range(7)]
+    name_ids, code_ids, location_ids, email_ids, record_counts, reminder_counts, appointment_counts = patient_columns
+    record_columns = [array('q') for _ in range(6)]
+    condition_ids, timestamps, timestamp_text_ids, url_ids, medication_counts, allergy_counts = record_columns
+    medication_ids = array('q')
+    allergy_ids = array('q')
+    reminder_ids = array('q')
+    appointment_ids = array('q')
+
+    for patient in patients:
+        name_ids.append(add(patient.name))
+        code_ids.append(add(patient.access_code))
+        location_ids.append(add(getattr(patient, 'location', None)))
+        email_ids.append(add(getattr(patient, 'email', None)))
+        record_counts.append(len(patient.medical_records))
+        for record in patient.medical_records:
+            condition_ids.append(add(record.condition))
+            timestamp = record.timestamp
+            if isinstance(timestamp, datetime):
+                delta = timestamp - EPOCH
+                timestamps.append((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+                timestamp_text_ids.append(NO_STRING)
+            else:
+                timestamps.append(NO_TIMESTAMP)
+                timestamp_text_ids.append(add(timestamp))
+            url_ids.append(add(getattr(record, 'url', None)))
+            medication_counts.append(len(record.medications))
+            medication_ids.extend([add(medication) for medication in record.medications])
+            allergy_counts.append(len(record.allergies))
+            allergy_ids.extend([add(allergy) for allergy in record.allergies])
+        reminders = getattr(patient, 'medication_reminders', [])
+        reminder_counts.append(len(reminders))
+        for reminder in reminders:
+            reminder_ids.append(add(reminder['medication']))
+            reminder_ids.append(add(reminder['frequency']))
+        appointments = getattr(patient, 'appointments', [])
+        appointment_counts.append(len(appointments))
+        appointment_ids.extend([add(json.dumps(appointment)) for appointment in appointments])
+
+    text = ''.join(strings.strings)
+    lengths = array('q', [len(string) for string in strings.strings])
+    encoded = text.encode('utf-8')
+
+    f.write(BINARY_MAGIC)
+    f.write(struct.pack('<IQ', SCHEMA_VERSION, len(encoded)))
+    f.write(encoded)
+    write_column(f, lengths)
+    for column in patient_columns + record_columns:
+        write_column(f, column)
+    for column in (medication_ids, allergy_ids, reminder_ids, appointment_ids):
+        write_column(f, column)
+
+
+def read_binary_columns(data):
+    """Return the string table and the 17 columns (as arrays) of a binary patient file."""
+    if not data.startswith(BINARY_MAGIC):
+        raise ValueError("Not a MediLink binary patient file")
+    offset = len(BINARY_MAGIC)
+    schema_version, text_size = struct.unpack_from('<IQ', data, offset)
+    if schema_version > SCHEMA_VERSION:
+        raise ValueError(f"Unsupported patient data schema version {schema_version}")
+    offset += struct.calcsize('<IQ')
+    text = data[offset:offset + text_size].decode('utf-8')
+    offset += text_size
+    lengths, offset = read_column(data, offset)
+
+    strings = []
+    position = 0
+    for length in lengths:
+        strings.append(text[position:position + length])
+        position += length
+    # Index -1 (NO_STRING) resolves to None through this trailing slot.
+    strings.append(None)
+
+    columns = []
+    for _ in range(17):
+        column, offset = read_column(data, offset)
+        columns.append(column)
+    return strings, columns
+
+
+def load_binary(f, patient_cls, record_cls):
+    strings, columns = read_binary_columns(f.read())
+    (name_ids, code_ids, location_ids, email_ids, record_counts, reminder_counts, appointment_counts,
+     condition_ids, timestamps, timestamp_text_ids, url_ids, medication_counts, allergy_counts,
+     medication_ids, allergy_ids, reminder_ids, appointment_ids) = [column.tolist() for column in columns]
+
+    # Resolve whole columns at once; the per-record loop below then only slices lists.
+    epoch = EPOCH
+    micros = timedelta(microseconds=1)
+    conditions = [strings[j] for j in condition_ids]
+    medications = [strings[j] for j in medication_ids]
+    allergies = [strings[j] for j in allergy_ids]
+    record_timestamps = [epoch + timestamp * micros if timestamp != NO_TIMESTAMP else strings[text_id]
+                         for timestamp, text_id in zip(timestamps, timestamp_text_ids)]
+
+    patients = {}
+    record_index = medication_index = allergy_index = reminder_index = appointment_index = 0
+    for i in range(len(name_ids)):
+        records = []
+        for _ in range(record_counts[i]):
+            medication_end = medication_index + medication_counts[record_index]
+            allergy_end = allergy_index + allergy_counts[record_index]
+            record = record_cls(conditions[record_index], medications[medication_index:medication_end],
+                                allergies[allergy_index:allergy_end], record_timestamps[record_index])
+            url_id = url_ids[record_index]
+            if url_id != NO_STRING:
+                record.url = strings[url_id]
+            records.append(record)
+            medication_index = medication_end
+            allergy_index = allergy_end
+            record_index += 1
+
+        first = records[0] if records else record_cls(None, [], [], None)
+        name = strings[name_ids[i]]
+        patient = patient_cls(name, strings[code_ids[i]], first.condition, first.medications,
+                              first.allergies, first.timestamp)
+        patient.medical_records = records
+        patient.location = strings[location_ids[i]]
+        email = strings[email_ids[i]]
+        if email is not None:
+            patient.email = email
+        reminders = []
+        for _ in range(reminder_counts[i]):
+            reminders.append({'medication': strings[reminder_ids[reminder_index]],
+                              'frequency': strings[reminder_ids[reminder_index + 1]]})
+            reminder_index += 2
+        patient.medication_reminders = reminders
+        appointment_count = appointment_counts[i]
+        patient.appointments = [json.loads(strings[j])
+                                for j in appointment_ids[appointment_index:appointment_index + appointment_count]]
+        appointment_index += appointment_count
+        patients[name] = patient
+    return patients
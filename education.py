@@ -0,0 +1,124 @@
+"""Health education resources shared by every provider.
+
+There is one EducationCatalog per HealthLinkSystem. Each provider sees it
+through a ProviderResources ChainMap, which stores only that provider's
+overrides, so memory does not grow with the number of providers. Lookups go
+through normalized-name and keyword indexes that are built when a resource is
+added, so searching costs one dictionary access per search word.
+"""
+import re
+from collections import ChainMap
+
+DEFAULT_RESOURCES = {
+    'Diabetes': 'https://www.diabetes.org/diabetes',
+    'Hypertension': 'https://www.heart.org/en/health-topics/high-blood-pressure',
+    'Asthma': 'https://www.lung.org/lung-health-diseases/lung-disease-lookup/asthma',
+    'Obesity': 'https://www.cdc.gov/obesity/index.html',
+    'Heart Disease': 'https://www.nhlbi.nih.gov/health-topics/heart-disease',
+    'Arthritis': 'https://www.arthritis.org/health-wellness',
+    'Depression': 'https://www.nimh.nih.gov/health/topics/depression',
+    'Anxiety Disorders': 'https://adaa.org/understanding-anxiety',
+    'Alzheimer\'s Disease': 'https://www.alz.org/alzheimers-dementia/what-is-alzheimers',
+    'Osteoporosis': 'https://www.bones.nih.gov/health-info/bone/osteoporosis/overview',
+    'Chronic Kidney Disease': 'https://www.kidney.org/atoz/content/about-chronic-kidney-disease',
+    'COPD': 'https://www.copdfoundation.org/What-is-COPD/Understanding-COPD/What-is-COPD.aspx',
+    'Hepatitis': 'https://www.cdc.gov/hepatitis/index.htm',
+    'HIV/AIDS': 'https://www.hiv.gov/hiv-basics',
+    'Parkinson\'s Disease': 'https://www.parkinson.org/understanding-parkinsons',
+    'Multiple Sclerosis': 'https://www.nationalmssociety.org/What-is-MS',
+    'Celiac Disease': 'https://celiac.org/about-celiac-disease/what-is-celiac-disease/',
+    'Fibromyalgia': 'https://www.fmcpaware.org/aboutfibromyalgia',
+    'Lupus': 'https://www.lupus.org/resources/what-is-lupus',
+    'Epilepsy': 'https://www.epilepsy.com/learn/about-epilepsy-basics'
+}
+
+MIN_PREFIX = 3
+NON_WORD = re.compile(r"[^0-9a-z]+")
+
+
+def normalize(text):
+    """'  Alzheimer's  DISEASE ' -> 'alzheimers disease'"""
+    return NON_WORD.sub(' ', (text or '').casefold().replace("'", '')).strip()
+
+
+def keywords(text):
+    """Every word of ``text`` and every prefix of it at least MIN_PREFIX characters long."""
+    found = set()
+    for word in normalize(text).split():
+        found.add(word)
+        for end in range(MIN_PREFIX, len(word)):
+            found.add(word[:end])
+    return found
+
+
+class EducationCatalog:
+    def __init__(self, resources=None):
+        self.resources = {}
+        self.by_name = {}
+        self.by_keyword = {}
+        for condition, url in (DEFAULT_RESOURCES if resources is None else resources).items():
+            self.add(condition, url)
+
+    def __len__(self):
+        return len(self.resources)
+
+    def add(self, condition, url):
+        self.resources[condition] = url
+        self.by_name[normalize(condition)] = condition
+        for keyword in keywords(condition):
+            self.by_keyword.setdefault(keyword, set()).add(condition)
+
+    def lookup(self, condition):
+        """Exact match on the normalized condition name; returns (condition, url) or None."""
+        name = self.by_name.get(normalize(condition))
+        return (name, self.resources[name]) if name else None
+
+    def search(self, term):
+        """Return {condition: url} for conditions matching every word of ``term``."""
+        exact = self.lookup(term)
+        if exact:
+            return dict([exact])
+        matches = None
+        for word in normalize(term).split():
+            found = self.by_keyword.get(word, set())
+            matches = found if matches is None else matches & found
+            if not matches:
+                return {}
+        return {condition: self.resources[condition] for condition in sorted(matches or ())}
+
+    def provider_view(self):
+        return ProviderResources(self)
+
+    def resources_for_patient(self, patient, resources=None):
+        """Map the conditions recorded for ``patient`` to their education resources."""
+        resources = self.resources if resources is None else resources
+        linked = {}
+        for record in patient.medical_records:
+            match = self.lookup(record.condition)
+            if match and match[0] not in linked:
+                linked[match[0]] = resources.get(match[0], match[1])
+        return linked
+
+
+class ProviderResources(ChainMap):
+    """The shared catalog with one provider's overrides layered on top; writes go to the overrides."""
+
+    def __init__(self, catalog):
+        super().__init__({}, catalog.resources)
+        self.catalog = catalog
+
+    @property
+    def overrides(self):
+        return self.maps[0]
+
+    def search(self, term):
+        results = {condition: self[condition] for condition in self.catalog.search(term)}
+        wanted = normalize(term)
+        # Overrides are per provider and few, so they are matched directly.
+        for condition, url in self.overrides.items():
+            if wanted in normalize(condition):
+                results[condition] = url
+        return results
+
+    def resources_for_patient(self, patient):
+        return self.catalog.resources_for_patient(patient, self)
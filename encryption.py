@@ -0,0 +1,228 @@
+"""Envelope encryption for stored patient data (needs the 'cryptography' package).
+
+Every sealed blob gets its own random data key. The data is encrypted with that
+key (AES-256-GCM) and the data key is encrypted ("wrapped") with the master key,
+so the master key never touches the data directly and can be rotated by
+re-wrapping the data keys alone.
+
+The master key comes from MEDILINK_MASTER_KEY (urlsafe base64, 32 bytes) or
+from the file named by MEDILINK_KEY_FILE, by default ~/.medilink/master.key,
+which is created on first use. Deployments must keep that file off the volume
+that holds medilink_data and out of its backups: anyone holding both can read
+everything. A key left in medilink_data by older versions is still read, with
+a warning.
+
+patients.enc holds one sealed entry per patient::
+
+    MAGIC, then per patient: <16sI lookup key, blob length> blob
+
+The lookup key is an HMAC of the access code, so the file neither stores codes
+nor names in the clear, and one patient can be found and decrypted without
+touching the others.
+
+The JSON-lines logs next to it (record history, change feed, refills) seal
+every line on its own, see log_codec, so they stay append-only.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import struct
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:  # encrypted storage is optional
+    AESGCM = None
+
+import codec
+from transaction import atomic_write
+
+MAGIC = b'MLNKENC\x01'
+ENTRY_HEADER = struct.Struct('<16sI')
+NONCE_SIZE = 12
+WRAPPED_KEY_SIZE = 32 + 16
+KEY_PATH = os.path.join(os.path.expanduser("~"), ".medilink", "master.key")
+LEGACY_KEY_PATH = os.path.join("medilink_data", "master.key")
+
+
+class Keyring:
+    def __init__(self, master_key):
+        if AESGCM is None:
+            raise RuntimeError("Encrypted storage needs the 'cryptography' package (pip install cryptography)")
+        self.master = AESGCM(master_key)
+        self.lookup_secret = hmac.new(master_key, b'medilink lookup key', hashlib.sha256).digest()
+
+    @classmethod
+    def load(cls, path=None):
+        encoded = os.getenv('MEDILINK_MASTER_KEY')
+        if encoded:
+            return cls(base64.urlsafe_b64decode(encoded))
+        path = path or os.getenv('MEDILINK_KEY_FILE') or KEY_PATH
+        if not os.path.exists(path) and os.path.exists(LEGACY_KEY_PATH):
+            path = LEGACY_KEY_PATH
+        data_directory = os.path.realpath(os.path.dirname(LEGACY_KEY_PATH))
+        if os.path.realpath(path).startswith(data_directory + os.sep):
+            print(f"Warning: the master key {path} is stored with the data it protects. "
+                  f"Move it to {KEY_PATH} or set MEDILINK_KEY_FILE.")
+        if not os.path.exists(path):
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Readable by the owner only.
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(base64.urlsafe_b64encode(os.urandom(32)))
+        with open(path, 'rb') as f:
+            return cls(base64.urlsafe_b64decode(f.read().strip()))
+
+    def lookup_key(self, access_code):
+        return hmac.new(self.lookup_secret, access_code.encode('utf-8'), hashlib.sha256).digest()[:16]
+
+    def seal(self, data, associated_data=b''):
+        data_key = AESGCM.generate_key(bit_length=256)
+        key_nonce = os.urandom(NONCE_SIZE)
+        wrapped_key = self.master.encrypt(key_nonce, data_key, associated_data)
+        nonce = os.urandom(NONCE_SIZE)
+        return key_nonce + wrapped_key + nonce + AESGCM(data_key).encrypt(nonce, data, associated_data)
+
+    def open(self, blob, associated_data=b''):
+        blob = bytes(blob)
+        key_end = NONCE_SIZE + WRAPPED_KEY_SIZE
+        data_key = self.master.decrypt(blob[:NONCE_SIZE], blob[NONCE_SIZE:key_end], associated_data)
+        nonce = blob[key_end:key_end + NONCE_SIZE]
+        return AESGCM(data_key).decrypt(nonce, blob[key_end + NONCE_SIZE:], associated_data)
+
+
+def seal_file(keyring, path, data):
+    """Seal the contents of a whole file; the file name is bound in, so files cannot be swapped."""
+    return keyring.seal(data, os.path.basename(path).encode('utf-8'))
+
+
+def open_file(keyring, path):
+    with open(path, 'rb') as f:
+        return keyring.open(f.read(), os.path.basename(path).encode('utf-8'))
+
+
+def log_codec(keyring, path):
+    """(dumps, loads) for the lines of the JSON-lines log at ``path``.
+
+    With a keyring every line is sealed on its own and base64 encoded.
+    """
+    if keyring is None:
+        return json.dumps, json.loads
+    associated_data = os.path.basename(path).encode('utf-8')
+
+    def dumps(value):
+        return base64.b64encode(keyring.seal(json.dumps(value).encode('utf-8'), associated_data)).decode('ascii')
+
+    def loads(line):
+        return json.loads(keyring.open(base64.b64decode(line), associated_data))
+    return dumps, loads
+
+
+def seal_plain_lines(keyring, path):
+    """Seal, in place, the lines a log got before encryption was switched on; run by the log's writer."""
+    if keyring is None or not os.path.exists(path):
+        return
+    associated_data = os.path.basename(path).encode('utf-8')
+    with open(path, 'rb') as f:
+        if f.read(1) != b'{':
+            return
+        f.seek(0)
+        lines = f.readlines()
+    with atomic_write(path, 'wb') as f:
+        for line in lines:
+            if line.startswith(b'{') and line.endswith(b'\n'):
+                line = base64.b64encode(keyring.seal(line.rstrip(b'\n'), associated_data)) + b'\n'
+            f.write(line)
+
+
+def seal_patient(keyring, patient):
+    return seal_patient_dict(keyring, codec.patient_to_dict(patient))
+
+
+def seal_patient_dict(keyring, data):
+    lookup_key = keyring.lookup_key(data['access_code'])
+    return lookup_key, keyring.seal(json.dumps(data).encode('utf-8'), lookup_key)
+
+
+def dump_encrypted(patients, f, keyring):
+    f.write(MAGIC)
+    for patient in patients:
+        lookup_key, blob = seal_patient(keyring, patient)
+        f.write(ENTRY_HEADER.pack(lookup_key, len(blob)))
+        f.write(blob)
+
+
+def update_encrypted(store, patients, f, keyring):
+    """Write ``store``'s patients to ``f``, sealing ``patients`` afresh and copying the others as stored."""
+    sealed = dict(seal_patient(keyring, patient) for patient in patients)
+    f.write(MAGIC)
+    for lookup_key, (start, length) in store.index.items():
+        blob = sealed.pop(lookup_key, None)
+        if blob is None:
+            blob = store.map[start:start + length]
+        f.write(ENTRY_HEADER.pack(lookup_key, len(blob)))
+        f.write(blob)
+    for lookup_key, blob in sealed.items():
+        f.write(ENTRY_HEADER.pack(lookup_key, len(blob)))
+        f.write(blob)
+
+
+def entry_offsets(data):
+    """Yield (lookup key, blob start, blob length) for every complete entry."""
+    if not data[:len(MAGIC)] == MAGIC:
+        raise ValueError("Not a MediLink encrypted patient file")
+    offset = len(MAGIC)
+    while offset + ENTRY_HEADER.size <= len(data):
+        lookup_key, length = ENTRY_HEADER.unpack_from(data, offset)
+        start = offset + ENTRY_HEADER.size
+        if start + length > len(data):
+            break
+        yield lookup_key, start, length
+        offset = start + length
+
+
+def load_encrypted(f, keyring, patient_cls, record_cls):
+    """Decrypt every patient in the file."""
+    data = f.read()
+    patients = {}
+    for lookup_key, start, length in entry_offsets(data):
+        payload = keyring.open(data[start:start + length], lookup_key)
+        patient = codec.patient_from_dict(json.loads(payload), patient_cls, record_cls)
+        patients[patient.name] = patient
+    return patients
+
+
+class EncryptedPatientStore:
+    """Random access to one patient of a patients.enc file without decrypting the rest."""
+
+    def __init__(self, path, keyring):
+        self.path = path
+        self.keyring = keyring
+        self.map = None
+        self.index = {}
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            for lookup_key, start, length in entry_offsets(self.map):
+                self.index[lookup_key] = (start, length)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def get(self, access_code, patient_cls, record_cls):
+        lookup_key = self.keyring.lookup_key(access_code)
+        entry = self.index.get(lookup_key)
+        if entry is None:
+            return None
+        start, length = entry
+        payload = self.keyring.open(self.map[start:start + length], lookup_key)
+        return codec.patient_from_dict(json.loads(payload), patient_cls, record_cls)
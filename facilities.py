@@ -0,0 +1,254 @@
+"""Offline registry of healthcare facilities with nearest and within-radius search.
+
+Facilities are read from medilink_data/facilities.csv::
+
+    name,type,latitude,longitude,city,services,phone
+
+with services separated by semicolons. Positions are indexed in a k-d tree of
+unit vectors on the sphere: the straight-line distance between two unit vectors
+grows with the great-circle distance, so the tree's answers are exact without
+any special casing near the poles or the date line.
+
+A patient location is either "latitude, longitude" or a city name; a city
+resolves to the mean position of the registry's facilities in that city.
+"""
+import csv
+import heapq
+import math
+import os
+
+from vocabulary import term_key
+
+DEFAULT_PATH = os.path.join("medilink_data", "facilities.csv")
+EARTH_RADIUS_KM = 6371.0088
+LEAF_SIZE = 8
+
+
+def to_vector(latitude, longitude):
+    lat, lon = math.radians(latitude), math.radians(longitude)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def to_lat_lon(vector):
+    x, y, z = vector
+    return math.degrees(math.atan2(z, math.hypot(x, y))), math.degrees(math.atan2(y, x))
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def km_to_chord(km):
+    return 2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+def parse_coordinates(text):
+    """'17.38, 78.48' -> (17.38, 78.48); None if ``text`` is not a latitude and longitude."""
+    parts = (text or '').replace(';', ',').split(',')
+    if len(parts) != 2:
+        return None
+    try:
+        latitude, longitude = float(parts[0]), float(parts[1])
+    except ValueError:
+        return None
+    if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+        return latitude, longitude
+    return None
+
+
+class Facility:
+    def __init__(self, name, kind, latitude, longitude, city='', services=(), phone=''):
+        self.name = name
+        self.kind = kind
+        self.latitude = latitude
+        self.longitude = longitude
+        self.city = city
+        self.services = tuple(services)
+        self.service_keys = frozenset(term_key(service) for service in self.services)
+        self.phone = phone
+
+    def offers(self, service):
+        return term_key(service) in self.service_keys
+
+    def to_row(self):
+        return {'name': self.name, 'type': self.kind, 'latitude': self.latitude, 'longitude': self.longitude,
+                'city': self.city, 'services': ';'.join(self.services), 'phone': self.phone}
+
+
+def box_distance2(point, low, high):
+    """Squared distance from ``point`` to the box [low, high]; 0 inside it."""
+    total = 0.0
+    for axis in range(3):
+        value = point[axis]
+        if value < low[axis]:
+            total += (low[axis] - value) ** 2
+        elif value > high[axis]:
+            total += (value - high[axis]) ** 2
+    return total
+
+
+class KDTree:
+    """Static k-d tree over 3-D points with leaf buckets and a bounding box per node.
+
+    Queries visit nodes nearest box first and stop once no box can hold a closer
+    point, which keeps them fast even far away from every point.
+    """
+
+    def __init__(self, points):
+        self.points = points
+        self.order = list(range(len(points)))
+        # (low corner, high corner, left, right); a leaf has left = None and right = (start, end) in order
+        self.nodes = []
+        if points:
+            self.build(0, len(points))
+
+    def build(self, lo, hi):
+        node_id = len(self.nodes)
+        self.nodes.append(None)
+        points = self.points
+        indices = self.order[lo:hi]
+        low = tuple(min(points[i][axis] for i in indices) for axis in range(3))
+        high = tuple(max(points[i][axis] for i in indices) for axis in range(3))
+        if hi - lo <= LEAF_SIZE:
+            self.nodes[node_id] = (low, high, None, (lo, hi))
+            return node_id
+        # Split along the widest axis, at the median.
+        spreads = [high[axis] - low[axis] for axis in range(3)]
+        axis = spreads.index(max(spreads))
+        indices.sort(key=lambda i: points[i][axis])
+        self.order[lo:hi] = indices
+        mid = (lo + hi) // 2
+        left = self.build(lo, mid)
+        right = self.build(mid, hi)
+        self.nodes[node_id] = (low, high, left, right)
+        return node_id
+
+    def nearest(self, point, k, accept=None):
+        """The ``k`` nearest (squared distance, index) pairs, nearest first; ``accept(index)`` filters."""
+        if not self.nodes or k <= 0:
+            return []
+        best = []
+        px, py, pz = point
+        points, order, nodes = self.points, self.order, self.nodes
+        queue = [(0.0, 0)]
+        while queue:
+            distance, node_id = heapq.heappop(queue)
+            if len(best) == k and distance >= -best[0][0]:
+                break
+            low, high, left, right = nodes[node_id]
+            if left is None:
+                for i in order[right[0]:right[1]]:
+                    if accept is not None and not accept(i):
+                        continue
+                    x, y, z = points[i]
+                    d2 = (x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2
+                    if len(best) < k:
+                        heapq.heappush(best, (-d2, i))
+                    elif d2 < -best[0][0]:
+                        heapq.heapreplace(best, (-d2, i))
+                continue
+            for child in (left, right):
+                child_distance = box_distance2(point, nodes[child][0], nodes[child][1])
+                if len(best) < k or child_distance < -best[0][0]:
+                    heapq.heappush(queue, (child_distance, child))
+        return sorted((-d2, i) for d2, i in best)
+
+    def within(self, point, radius):
+        """(squared distance, index) pairs within ``radius`` of ``point``, nearest first."""
+        if not self.nodes:
+            return []
+        found = []
+        r2 = radius * radius
+        px, py, pz = point
+        points, order, nodes = self.points, self.order, self.nodes
+        stack = [0]
+        while stack:
+            low, high, left, right = nodes[stack.pop()]
+            if box_distance2(point, low, high) > r2:
+                continue
+            if left is None:
+                for i in order[right[0]:right[1]]:
+                    x, y, z = points[i]
+                    d2 = (x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2
+                    if d2 <= r2:
+                        found.append((d2, i))
+                continue
+            stack.append(left)
+            stack.append(right)
+        found.sort()
+        return found
+
+
+class FacilityRegistry:
+    def __init__(self, facilities=()):
+        self.facilities = list(facilities)
+        vectors = [to_vector(f.latitude, f.longitude) for f in self.facilities]
+        self.tree = KDTree(vectors)
+        sums = {}
+        for facility, vector in zip(self.facilities, vectors):
+            if facility.city:
+                total = sums.setdefault(term_key(facility.city), [0.0, 0.0, 0.0])
+                for axis in range(3):
+                    total[axis] += vector[axis]
+        self.cities = {city: to_lat_lon(total) for city, total in sums.items()}
+
+    def __len__(self):
+        return len(self.facilities)
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        """Read a facilities CSV; a missing file gives an empty registry."""
+        if not os.path.exists(path):
+            return cls()
+        facilities = []
+        with open(path, 'r', newline='') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                services = [service.strip() for service in (row.get('services') or '').split(';') if service.strip()]
+                try:
+                    latitude, longitude = float(row['latitude']), float(row['longitude'])
+                    if not row['name'] or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                        raise ValueError(row)
+                    facility = Facility(row['name'], row.get('type') or '', latitude, longitude,
+                                        row.get('city') or '', services, row.get('phone') or '')
+                except (KeyError, TypeError, ValueError):
+                    # One bad row should not hide every other facility
+                    print(f"Warning: skipping malformed facility on line {reader.line_num} of {path}.")
+                    continue
+                facilities.append(facility)
+        return cls(facilities)
+
+    def save(self, path=DEFAULT_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['name', 'type', 'latitude', 'longitude', 'city', 'services', 'phone'])
+            writer.writeheader()
+            for facility in self.facilities:
+                writer.writerow(facility.to_row())
+
+    def resolve(self, location):
+        """(latitude, longitude) for "lat, lon" or a known city name, else None."""
+        return parse_coordinates(location) or self.cities.get(term_key(location or ''))
+
+    def nearest(self, location, k=5, service=None):
+        """[(distance in km, facility)] for the ``k`` closest facilities, optionally only those offering ``service``."""
+        position = self.resolve(location)
+        if position is None:
+            return []
+        accept = None
+        if service:
+            key = term_key(service)
+            accept = lambda i: key in self.facilities[i].service_keys
+        found = self.tree.nearest(to_vector(*position), k, accept)
+        return [(chord_to_km(math.sqrt(d2)), self.facilities[i]) for d2, i in found]
+
+    def within(self, location, radius_km, service=None):
+        """[(distance in km, facility)] for every facility within ``radius_km``, nearest first."""
+        position = self.resolve(location)
+        if position is None:
+            return []
+        found = self.tree.within(to_vector(*position), km_to_chord(radius_km))
+        return [(chord_to_km(math.sqrt(d2)), self.facilities[i]) for d2, i in found
+                if not service or self.facilities[i].offers(service)]
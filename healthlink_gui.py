@@ -0,0 +1,323 @@
+"""Tk front-end for HealthLinkSystem.
+
+Every call into the system runs on a background worker; results come back to
+the Tk thread through ``after()`` so the window keeps repainting while large
+datasets load, save or export.
+"""
+import queue
+import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from tkinter import messagebox, ttk
+
+from MediLink1 import HealthLinkSystem, Patient
+from vocabulary import parse_allergies, parse_medications
+
+POLL_MS = 50
+DEFAULT_PROVIDERS = ["City Hospital", "General Clinic"]
+
+
+def open_system():
+    system = HealthLinkSystem()
+    # The tabs work on every patient, so in encrypted mode they are all decrypted up front
+    system.load_all_patients()
+    return system
+
+
+class BackgroundRunner:
+    """Run callables off the Tk thread and deliver their results back on it."""
+
+    def __init__(self, root):
+        self.root = root
+        # A single worker keeps the window's own system operations in order.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='healthlink-gui')
+        self.results = queue.Queue()
+        self.pending = 0
+        self.root.after(POLL_MS, self.poll)
+
+    def submit(self, func, *args, on_done=None, on_error=None):
+        self.pending += 1
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda f: self.results.put((f, on_done, on_error)))
+
+    def poll(self):
+        try:
+            while True:
+                future, on_done, on_error = self.results.get_nowait()
+                self.pending -= 1
+                error = future.exception()
+                if error is None:
+                    if on_done:
+                        on_done(future.result())
+                elif on_error:
+                    on_error(error)
+                else:
+                    messagebox.showerror("HealthLink System", str(error))
+        except queue.Empty:
+            pass
+        self.root.after(POLL_MS, self.poll)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class HealthLinkApp(ttk.Frame):
+    def __init__(self, master, healthlink_system=None):
+        super().__init__(master, padding=10)
+        self.system = None
+        self.runner = BackgroundRunner(master)
+        self.status = tk.StringVar(value="Loading data...")
+
+        self.build_toolbar()
+        notebook = ttk.Notebook(self)
+        notebook.pack(fill='both', expand=True, pady=(8, 8))
+        notebook.add(self.build_records_tab(notebook), text="Records")
+        notebook.add(self.build_register_tab(notebook), text="Register Patient")
+        notebook.add(self.build_search_tab(notebook), text="Search")
+        notebook.add(self.build_appointments_tab(notebook), text="Appointments")
+        ttk.Label(self, textvariable=self.status, anchor='w').pack(fill='x')
+
+        if healthlink_system is not None:
+            self.attach_system(healthlink_system)
+        else:
+            # Constructing the system reads patients.json, so it happens off the Tk thread too.
+            self.runner.submit(open_system, on_done=self.attach_system, on_error=self.show_error)
+
+    def attach_system(self, healthlink_system):
+        self.system = healthlink_system
+        with self.system.lock:
+            for name in DEFAULT_PROVIDERS:
+                if not any(provider.name == name for provider in self.system.providers):
+                    self.system.register_provider(name, '')
+        self.provider_choice['values'] = [provider.name for provider in self.system.providers]
+        self.provider_choice.current(0)
+        self.set_status(f"{len(self.system.patients)} patients loaded.")
+
+    def run(self, description, func, *args, on_done=None):
+        if self.system is None:
+            self.set_status("Still loading data, please wait.")
+            return
+        self.set_status(f"{description}...")
+        system = self.system
+
+        def locked(*call_args):
+            # The system's save thread runs alongside the worker, so each task holds the lock saves take
+            with system.lock:
+                return func(*call_args)
+        self.runner.submit(locked, *args, on_done=on_done, on_error=self.show_error)
+
+    def set_status(self, text):
+        self.status.set(text)
+
+    def show_error(self, error):
+        self.set_status(f"Error: {error}")
+        messagebox.showerror("HealthLink System", str(error))
+
+    def build_toolbar(self):
+        toolbar = ttk.Frame(self)
+        toolbar.pack(fill='x')
+        ttk.Button(toolbar, text="Load", command=self.load).pack(side='left')
+        ttk.Button(toolbar, text="Save", command=self.save).pack(side='left', padx=4)
+        ttk.Button(toolbar, text="Export CSV", command=self.export).pack(side='left')
+
+    def load(self):
+        self.run("Loading data", lambda: (self.system.load_data(), self.system.load_all_patients()),
+                 on_done=lambda _: self.set_status(f"{len(self.system.patients)} patients loaded."))
+
+    def save(self):
+        self.run("Saving data", self.system_call('save_data'), on_done=lambda _: self.set_status("Data saved."))
+
+    def export(self):
+        self.run("Exporting patient data", self.system_call('export_patient_data'),
+                 on_done=lambda _: self.set_status("Exported to patient_data.csv."))
+
+    def system_call(self, method_name):
+        return lambda *args: getattr(self.system, method_name)(*args)
+
+    def build_records_tab(self, notebook):
+        tab = ttk.Frame(notebook, padding=8)
+        self.records_code = tk.StringVar()
+        row = ttk.Frame(tab)
+        row.pack(fill='x')
+        ttk.Label(row, text="Access code:").pack(side='left')
+        ttk.Entry(row, textvariable=self.records_code, width=16).pack(side='left', padx=4)
+        ttk.Button(row, text="View Records", command=self.view_records).pack(side='left')
+        self.records_text = tk.Text(tab, height=18, wrap='word', state='disabled')
+        self.records_text.pack(fill='both', expand=True, pady=(8, 0))
+        return tab
+
+    def view_records(self):
+        self.run("Looking up records", self.lookup_records, self.records_code.get().strip(),
+                 on_done=self.show_records)
+
+    def lookup_records(self, code):
+        # Goes through the access guard like every other code typed into the window
+        wait = self.system.access_guard.retry_after("gui")
+        if wait:
+            return f"Too many access attempts. Please try again in {wait:.0f} seconds."
+        return self.system.verify_access(code, "gui")
+
+    def show_records(self, patient):
+        lines = []
+        if isinstance(patient, str):
+            lines.append(patient)
+        elif patient is None:
+            lines.append("Access denied. Invalid access code.")
+        else:
+            lines.append(f"Medical Records for {patient.name}:")
+            for record in patient.medical_records:
+                lines.append(f"Condition: {record.condition}")
+                lines.append(f"Medications: {', '.join(record.medications)}")
+                lines.append(f"Allergies: {', '.join(record.allergies)}")
+                lines.append(f"Timestamp: {record.timestamp}")
+                lines.append("------------------------")
+        self.replace_text(self.records_text, "\n".join(lines))
+        self.set_status("Ready.")
+
+    def replace_text(self, widget, text):
+        widget.configure(state='normal')
+        widget.delete('1.0', 'end')
+        widget.insert('end', text)
+        widget.configure(state='disabled')
+
+    def build_register_tab(self, notebook):
+        tab = ttk.Frame(notebook, padding=8)
+        self.register_fields = {}
+        for row, (key, label) in enumerate([
+            ('name', "Patient name"),
+            ('condition', "Medical condition"),
+            ('medications', "Medications (comma-separated)"),
+            ('allergies', "Allergies (comma-separated)"),
+        ]):
+            ttk.Label(tab, text=label).grid(row=row, column=0, sticky='w', pady=2)
+            variable = tk.StringVar()
+            ttk.Entry(tab, textvariable=variable, width=40).grid(row=row, column=1, sticky='we', pady=2)
+            self.register_fields[key] = variable
+        ttk.Label(tab, text="Provider").grid(row=4, column=0, sticky='w', pady=2)
+        self.provider_choice = ttk.Combobox(tab, state='readonly', width=38)
+        self.provider_choice.grid(row=4, column=1, sticky='we', pady=2)
+        ttk.Button(tab, text="Register", command=self.register_patient).grid(row=5, column=1, sticky='e', pady=8)
+        tab.columnconfigure(1, weight=1)
+        return tab
+
+    def register_patient(self):
+        values = {key: variable.get().strip() for key, variable in self.register_fields.items()}
+        if not values['name']:
+            messagebox.showwarning("HealthLink System", "Please enter the patient's name.")
+            return
+        provider_name = self.provider_choice.get()
+        self.run("Registering patient", self.create_patient, values, provider_name, on_done=self.patient_registered)
+
+    def create_patient(self, values, provider_name):
+        patient = Patient(values['name'], self.system.generate_access_code(), values['condition'],
+                          parse_medications(values['medications']), parse_allergies(values['allergies']), datetime.now())
+        if self.system.name_taken(patient.name, patient.access_code):
+            raise ValueError(f"A patient named {patient.name} is already registered.")
+        provider = next((p for p in self.system.providers if p.name == provider_name), None)
+        self.system.add_patient(patient, provider)
+        return patient
+
+    def patient_registered(self, patient):
+        for variable in self.register_fields.values():
+            variable.set('')
+        self.set_status(f"Patient {patient.name} registered with access code: {patient.access_code}")
+        messagebox.showinfo("HealthLink System",
+                            f"Patient {patient.name} registered with access code: {patient.access_code}")
+
+    def build_search_tab(self, notebook):
+        tab = ttk.Frame(notebook, padding=8)
+        self.search_keyword = tk.StringVar()
+        row = ttk.Frame(tab)
+        row.pack(fill='x')
+        ttk.Label(row, text="Name contains:").pack(side='left')
+        entry = ttk.Entry(row, textvariable=self.search_keyword, width=24)
+        entry.pack(side='left', padx=4)
+        entry.bind('<Return>', lambda event: self.search())
+        ttk.Button(row, text="Search", command=self.search).pack(side='left')
+        self.search_results = ttk.Treeview(tab, columns=('name', 'code', 'records'), show='headings', height=16)
+        self.search_results.heading('name', text="Name")
+        self.search_results.heading('code', text="Access Code")
+        self.search_results.heading('records', text="Records")
+        self.search_results.pack(fill='both', expand=True, pady=(8, 0))
+        return tab
+
+    def search(self):
+        self.run("Searching", self.system_call('find_patients'), self.search_keyword.get().strip(),
+                 on_done=self.show_search_results)
+
+    def show_search_results(self, patients):
+        self.search_results.delete(*self.search_results.get_children())
+        for patient in patients:
+            self.search_results.insert('', 'end', values=(patient.name, patient.access_code,
+                                                          len(patient.medical_records)))
+        self.set_status(f"{len(patients)} patients found." if patients else "No patient found with the given keyword.")
+
+    def build_appointments_tab(self, notebook):
+        tab = ttk.Frame(notebook, padding=8)
+        self.appointment_code = tk.StringVar()
+        self.appointment_date = tk.StringVar()
+        ttk.Label(tab, text="Access code").grid(row=0, column=0, sticky='w', pady=2)
+        ttk.Entry(tab, textvariable=self.appointment_code, width=16).grid(row=0, column=1, sticky='w', pady=2)
+        ttk.Label(tab, text="Date (YYYY-MM-DD)").grid(row=1, column=0, sticky='w', pady=2)
+        ttk.Entry(tab, textvariable=self.appointment_date, width=16).grid(row=1, column=1, sticky='w', pady=2)
+        buttons = ttk.Frame(tab)
+        buttons.grid(row=2, column=1, sticky='w', pady=8)
+        ttk.Button(buttons, text="Schedule", command=lambda: self.change_appointment('schedule')).pack(side='left')
+        ttk.Button(buttons, text="Reschedule",
+                   command=lambda: self.change_appointment('reschedule')).pack(side='left', padx=4)
+        ttk.Button(buttons, text="Cancel", command=lambda: self.change_appointment('cancel')).pack(side='left')
+        return tab
+
+    def change_appointment(self, action):
+        code = self.appointment_code.get().strip()
+        date = self.appointment_date.get().strip()
+        if action != 'cancel':
+            try:
+                datetime.strptime(date, "%Y-%m-%d")
+            except ValueError:
+                messagebox.showwarning("HealthLink System", "Please enter the date as YYYY-MM-DD.")
+                return
+        # Scheduling sends the reminder e-mail, which can block on SMTP for seconds.
+        self.run("Updating appointment", self.apply_appointment, action, code, date,
+                 on_done=self.set_status)
+
+    def apply_appointment(self, action, code, date):
+        wait = self.system.access_guard.retry_after("gui")
+        if wait:
+            return f"Too many access attempts. Please try again in {wait:.0f} seconds."
+        patient = self.system.verify_access(code, "gui")
+        if patient is None:
+            return "Access denied. Invalid access code."
+        if action == 'schedule':
+            self.system.schedule_appointment(patient, date)
+            return f"Appointment for {patient.name} scheduled on {date}."
+        if action == 'reschedule':
+            self.system.reschedule_appointment(patient, date)
+            return f"Appointment for {patient.name} moved to {date}."
+        if patient.name not in self.system.appointment_reminders:
+            return "No appointment found to cancel."
+        self.system.cancel_appointment(patient)
+        return f"Appointment for {patient.name} cancelled."
+
+
+def run(window=None, healthlink_system=None):
+    if window is None:
+        window = tk.Tk()
+        window.title("HealthLink System")
+        window.geometry("900x600")
+    app = HealthLinkApp(window, healthlink_system)
+    app.place(relx=0.5, rely=0.5, anchor='center', relwidth=0.9, relheight=0.9)
+
+    def close():
+        if app.runner.pending and not messagebox.askokcancel(
+                "HealthLink System", "An operation is still running. Quit anyway?"):
+            return
+        app.runner.shutdown()
+        window.destroy()
+
+    window.protocol('WM_DELETE_WINDOW', close)
+    window.mainloop()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,149 @@
+"""Probable duplicate patients, found without comparing every pair.
+
+Each patient goes into a few blocks keyed by their name: the sorted name
+tokens, the surname with the first initial, and the first name with the
+surname initial. Only patients sharing a block are compared, so a typo in one
+name part or swapped name order still meets. Blocks larger than MAX_BLOCK are
+sorted by location and name and compared within a sliding window instead of
+pairwise (sorted neighbourhood), which bounds the work at O(n * WINDOW) per key.
+
+A pair is scored from name similarity, location and the overlap of their
+conditions, medications and allergies (including archived records).
+"""
+import re
+from difflib import SequenceMatcher
+
+from vocabulary import term_key
+
+NAME_WEIGHT = 0.6
+LOCATION_WEIGHT = 0.15
+HISTORY_WEIGHT = 0.25
+DEFAULT_THRESHOLD = 0.85
+MAX_BLOCK = 50
+WINDOW = 10
+NAME_TOKENS = re.compile(r"[^\W\d_]+")
+
+
+def name_tokens(name):
+    # Digits and punctuation are not part of a person's name.
+    return NAME_TOKENS.findall((name or '').casefold())
+
+
+def blocking_keys(name):
+    tokens = name_tokens(name)
+    if not tokens:
+        return []
+    keys = ['n:' + ' '.join(sorted(tokens))]
+    if len(tokens) > 1:
+        first, last = tokens[0], tokens[-1]
+        keys.append(f's:{last}:{first[0]}')
+        keys.append(f'f:{first}:{last[0]}')
+    return keys
+
+
+class PatientFeatures:
+    __slots__ = ('patient', 'name', 'location', 'history')
+
+    def __init__(self, patient, records):
+        self.patient = patient
+        self.name = ' '.join(sorted(name_tokens(patient.name)))
+        self.location = term_key(patient.location) if patient.location else None
+        history = set()
+        for record in records:
+            history.add('c:' + term_key(record.condition or ''))
+            history.update('m:' + term_key(medication) for medication in record.medications)
+            history.update('a:' + term_key(allergy) for allergy in record.allergies)
+        self.history = history
+
+
+def similarity(a, b, threshold=0.0):
+    """Score two PatientFeatures between 0 and 1; returns 0 early once ``threshold`` is out of reach."""
+    if a.location is None or b.location is None:
+        location = 0.5
+    else:
+        location = 1.0 if a.location == b.location else 0.0
+    if a.history and b.history:
+        # Overlap rather than Jaccard: a second registration usually holds a subset of the history.
+        history = len(a.history & b.history) / min(len(a.history), len(b.history))
+    else:
+        history = 0.5
+    partial = LOCATION_WEIGHT * location + HISTORY_WEIGHT * history
+    if partial + NAME_WEIGHT < threshold:
+        return 0.0
+    name = 1.0 if a.name == b.name else SequenceMatcher(None, a.name, b.name).ratio()
+    return partial + NAME_WEIGHT * name
+
+
+class RecordLinker:
+    def __init__(self, records_of=None):
+        # blocking key -> {access code: patient}
+        self.blocks = {}
+        self.records_of = records_of or (lambda patient: patient.medical_records)
+
+    def add(self, patient):
+        for key in blocking_keys(patient.name):
+            self.blocks.setdefault(key, {})[patient.access_code] = patient
+
+    def remove(self, patient):
+        for key in blocking_keys(patient.name):
+            block = self.blocks.get(key)
+            if block is not None:
+                block.pop(patient.access_code, None)
+                if not block:
+                    del self.blocks[key]
+
+    def features(self, patient):
+        return PatientFeatures(patient, self.records_of(patient))
+
+    def matches(self, patient, threshold=DEFAULT_THRESHOLD):
+        """[(score, other patient)] for likely duplicates of ``patient``, best first."""
+        features = self.features(patient)
+        seen = {patient.access_code}
+        found = []
+        for key in blocking_keys(patient.name):
+            for code, other in self.blocks.get(key, {}).items():
+                if code in seen:
+                    continue
+                seen.add(code)
+                score = similarity(features, self.features(other), threshold)
+                if score >= threshold:
+                    found.append((score, other))
+        found.sort(key=lambda match: -match[0])
+        return found
+
+    def duplicates(self, threshold=DEFAULT_THRESHOLD):
+        """[(score, patient, patient)] for every likely duplicate pair, best first."""
+        cache = {}
+
+        def features_of(patient):
+            features = cache.get(patient.access_code)
+            if features is None:
+                features = cache[patient.access_code] = self.features(patient)
+            return features
+
+        pairs = {}
+
+        def compare(a, b):
+            pair = (a.patient.access_code, b.patient.access_code)
+            if pair[0] > pair[1]:
+                pair = pair[::-1]
+            if pair in pairs:
+                return
+            score = similarity(a, b, threshold)
+            if score >= threshold:
+                pairs[pair] = (score, a.patient, b.patient)
+
+        for block in self.blocks.values():
+            if len(block) < 2:
+                continue
+            members = [features_of(patient) for patient in block.values()]
+            if len(members) <= MAX_BLOCK:
+                for i, a in enumerate(members):
+                    for b in members[i + 1:]:
+                        compare(a, b)
+            else:
+                members.sort(key=lambda features: (features.location or '', features.name))
+                for i, a in enumerate(members):
+                    for b in members[i + 1:i + WINDOW]:
+                        compare(a, b)
+        return sorted(pairs.values(), key=lambda match: -match[0])
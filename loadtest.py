@@ -0,0 +1,411 @@
+"""Replay menu sessions against one HealthLinkSystem from many concurrent users.
+
+A session is the list of answers a user types into one of the MediLink1 menus::
+
+    {"entry": "hospital_staff_menu", "inputs": ["City Hospital", "password", "1", "AB12CD34", "23"]}
+
+Sessions come from a JSONL file (recorded with ``record`` or written by
+``generate``) or are generated against a synthetic system. Each simulated user
+is a thread; MediLink1's input() and print() are swapped for per-thread
+scripted versions, so the real menu code runs unchanged. Every call to a
+HealthLinkSystem operation is timed, and the background save thread runs at a
+short interval so waits on the system lock show up in the report.
+
+    python loadtest.py run --scale 2000 --users 20 --duration 30 --save-interval 5
+    python loadtest.py generate --scale 2000 --count 200 --output sessions.jsonl
+    python loadtest.py run --sessions sessions.jsonl --data ./clinic-copy
+    python loadtest.py record --output sessions.jsonl
+"""
+import argparse
+import builtins
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import MediLink1
+import synthetic_data
+from access_control import AccessGuard
+
+ENTRIES = ('main', 'login_signup_menu', 'hospital_staff_menu', 'patient_portal_menu')
+OPERATIONS = (
+    'verify_access', 'access_medical_record', 'add_patient', 'add_medical_record', 'schedule_appointment',
+    'reschedule_appointment', 'cancel_appointment', 'request_medication_refill', 'fulfil_medication_refills',
+    'admit_patient', 'discharge_patient', 'nearest_facilities', 'possible_duplicates', 'merge_patients',
+    'generate_patient_report', 'save_data', 'archive_old_records',
+)
+STAFF_LOGOUT = '23'
+PORTAL_LOGOUT = '6'
+
+
+class SessionEnded(Exception):
+    """Raised by the scripted input() once a session has no answers left."""
+
+
+class SessionRefused(Exception):
+    """Raised by the scripted print() when the menu turns the user away; the rest of the session would be noise."""
+
+
+# Printed by verify_access_code and the menus when access is refused
+REFUSALS = (("Too many access attempts", "rate limited"), ("Access denied", "access denied"))
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def summary(self, duration):
+        report = {}
+        for name, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            report[name] = {
+                'count': len(samples),
+                'per_second': len(samples) / duration if duration else 0.0,
+                'p50_ms': quantile(samples, 0.5) * 1000,
+                'p99_ms': quantile(samples, 0.99) * 1000,
+                'max_ms': samples[-1] * 1000,
+            }
+        return report
+
+
+def quantile(sorted_samples, fraction):
+    return sorted_samples[min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))]
+
+
+class InstrumentedLock:
+    """Wraps the system lock and records how long each blocked acquire waited, per thread kind."""
+
+    def __init__(self, lock, recorder):
+        self.lock = lock
+        self.recorder = recorder
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            return True
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        self.recorder.add(f"{thread_kind()}:lock_wait", time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def thread_kind():
+    return 'backup' if threading.current_thread().name == 'backup' else 'user'
+
+
+class ScriptedConsole:
+    """Per-thread stand-ins for input() and print() inside MediLink1."""
+
+    def __init__(self, think_time=0.0, abort_on_refusal=False):
+        self.local = threading.local()
+        self.think_time = think_time
+        self.abort_on_refusal = abort_on_refusal
+
+    def start(self, inputs):
+        self.local.inputs = iter(inputs)
+
+    def input(self, prompt=''):
+        inputs = getattr(self.local, 'inputs', None)
+        if inputs is None:
+            # Threads that are not simulated users never wait for a person.
+            return ''
+        if self.think_time:
+            time.sleep(self.think_time)
+        for value in inputs:
+            return value
+        raise SessionEnded()
+
+    def print(self, *args, **kwargs):
+        if self.abort_on_refusal and args and getattr(self.local, 'inputs', None) is not None:
+            text = str(args[0])
+            for prefix, kind in REFUSALS:
+                if text.startswith(prefix):
+                    raise SessionRefused(kind)
+
+    @contextlib.contextmanager
+    def installed(self):
+        MediLink1.input = self.input
+        MediLink1.print = self.print
+        try:
+            yield self
+        finally:
+            del MediLink1.input
+            del MediLink1.print
+
+
+def time_operations(system, recorder, names=OPERATIONS):
+    """Replace the system's methods with timed wrappers; nested calls are timed as well."""
+    for name in names:
+        method = getattr(system, name, None)
+        if method is None:
+            continue
+
+        def timed(*args, _method=method, _name=name, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                recorder.add(f"{thread_kind()}:{_name}", time.perf_counter() - start)
+        setattr(system, name, timed)
+
+
+def staff_session(provider, rng, steps):
+    patients = list(provider.patients)
+    inputs = [provider.name, 'password']
+    for _ in range(steps):
+        patient = rng.choice(patients)
+        action = rng.random()
+        if action < 0.4:
+            # Some lookups use a wrong code; only actions that ask nothing more after the code may do so.
+            inputs += ['1', patient.access_code if rng.random() < 0.9 else 'WRONG000']
+        elif action < 0.55:
+            record = synthetic_data.generate_record(rng)
+            inputs += ['3', patient.access_code, record.condition, ', '.join(record.medications),
+                       ', '.join(record.allergies)]
+        elif action < 0.7:
+            inputs += ['7', patient.access_code, f"2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"]
+        elif action < 0.85:
+            inputs += ['17', patient.access_code, rng.choice(synthetic_data.MEDICATIONS), str(rng.randint(1, 3))]
+        else:
+            inputs += ['13']
+    return {'entry': 'hospital_staff_menu', 'inputs': inputs + [STAFF_LOGOUT]}
+
+
+def portal_session(system, rng, steps):
+    patients = list(system.directory.patients.values())
+    facilities = len(system.facility_registry())
+    inputs = []
+    for _ in range(steps):
+        patient = rng.choice(patients)
+        action = rng.random()
+        if action < 0.5:
+            inputs += ['1', patient.access_code]
+        elif action < 0.8 or not facilities or not patient.location:
+            inputs += ['3', patient.access_code, rng.choice(synthetic_data.MEDICATIONS), str(rng.randint(1, 3))]
+        else:
+            # Service, radius and "Press Enter"; the location comes from the patient
+            inputs += ['5', patient.access_code, '', '', '']
+    return {'entry': 'patient_portal_menu', 'inputs': inputs + [PORTAL_LOGOUT]}
+
+
+def generate_sessions(system, count, seed=0, steps=8, staff_fraction=0.5):
+    rng = random.Random(seed)
+    providers = [provider for provider in system.providers if provider.patients]
+    sessions = []
+    for _ in range(count):
+        if providers and rng.random() < staff_fraction:
+            sessions.append(staff_session(rng.choice(providers), rng, steps))
+        else:
+            sessions.append(portal_session(system, rng, steps))
+    return sessions
+
+
+def read_sessions(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_sessions(sessions, path):
+    with open(path, 'w') as f:
+        for session in sessions:
+            f.write(json.dumps(session) + "\n")
+
+
+def build_system(scale, seed, data=None):
+    """A system in a temporary working directory: a copy of ``data``, or synthetic patients."""
+    workdir = tempfile.mkdtemp(prefix='medilink-load-')
+    if data:
+        shutil.copytree(data, workdir, dirs_exist_ok=True)
+    os.makedirs(os.path.join(workdir, "medilink_data"), exist_ok=True)
+    os.chdir(workdir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if data:
+            system = MediLink1.HealthLinkSystem(start_backup=False)
+            # Sessions are scripted from the patient list, which encrypted storage only has once decrypted
+            system.load_all_patients()
+            # Providers are not stored on disk; recorded staff sessions log in with these.
+            if not system.providers:
+                for name in synthetic_data.PROVIDER_NAMES:
+                    system.register_provider(name, 'password')
+        else:
+            count = synthetic_data.parse_scale(scale)
+            synthetic_data.write_facilities_csv(max(100, count // 10), seed)
+            system = synthetic_data.build_system(count, seed)
+        system.save_data()
+    return system, workdir
+
+
+def run_load(system, sessions, users=10, duration=30.0, save_interval=5.0, think_time=0.0, rate_limit=False):
+    """Replay ``sessions`` (cycled) from ``users`` threads for ``duration`` seconds and return a report."""
+    recorder = LatencyRecorder()
+    if not rate_limit:
+        # Only failed attempts are charged, but all portal sessions here share one terminal's bucket and all staff
+        # sessions for a provider share that provider's; off by default so the report measures the system.
+        system.access_guard = AccessGuard(capacity=float('inf'), refill_per_second=float('inf'))
+    system.lock = InstrumentedLock(system.lock, recorder)
+    time_operations(system, recorder)
+    # With the limit on, a refused session stops there and counts as an error
+    console = ScriptedConsole(think_time, abort_on_refusal=rate_limit)
+    next_session = itertools.cycle(sessions).__next__
+    session_lock = threading.Lock()
+    counts = {'sessions': 0, 'errors': 0}
+    errors = {}
+    deadline = time.perf_counter() + duration
+
+    def user():
+        while time.perf_counter() < deadline:
+            with session_lock:
+                session = next_session()
+            console.start(session['inputs'])
+            start = time.perf_counter()
+            try:
+                getattr(MediLink1, session['entry'])(system)
+            except SessionEnded:
+                pass
+            except Exception as e:
+                with session_lock:
+                    counts['errors'] += 1
+                    key = f"{type(e).__name__}: {e}"
+                    errors[key] = errors.get(key, 0) + 1
+                continue
+            recorder.add(f"session:{session['entry']}", time.perf_counter() - start)
+            with session_lock:
+                counts['sessions'] += 1
+
+    saver = None
+    if save_interval:
+        system.save_interval = save_interval
+        saver = threading.Thread(target=system.periodic_backup, name='backup', daemon=True)
+        saver.start()
+    start = time.perf_counter()
+    with console.installed():
+        threads = [threading.Thread(target=user, name=f"user-{i}") for i in range(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+    if saver is not None:
+        system.backup_stop.set()
+        saver.join()
+    return {
+        'users': users,
+        'duration_s': elapsed,
+        'save_interval_s': save_interval,
+        'sessions': counts['sessions'],
+        'sessions_per_second': counts['sessions'] / elapsed,
+        'errors': counts['errors'],
+        'error_kinds': errors,
+        'operations': recorder.summary(elapsed),
+    }
+
+
+def print_report(report):
+    print(f"{report['users']} users, {report['duration_s']:.1f} s, {report['sessions']} sessions "
+          f"({report['sessions_per_second']:.1f}/s), {report['errors']} errors")
+    for kind, count in report['error_kinds'].items():
+        print(f"  {count} x {kind}")
+    print(f"{'operation':40} {'count':>8} {'per s':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, row in report['operations'].items():
+        print(f"{name:40} {row['count']:8d} {row['per_second']:9.1f} {row['p50_ms']:9.3f} "
+              f"{row['p99_ms']:9.3f} {row['max_ms']:9.3f}")
+
+
+def record(path):
+    """Run the interactive menus and append everything typed to ``path`` as one session."""
+    inputs = []
+
+    def recording_input(prompt=''):
+        value = builtins.input(prompt)
+        inputs.append(value)
+        return value
+
+    MediLink1.input = recording_input
+    try:
+        MediLink1.main()
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        del MediLink1.input
+        with open(path, 'a') as f:
+            f.write(json.dumps({'entry': 'main', 'inputs': inputs}) + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent session replay for the MediLink menus.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help="replay sessions from concurrent users")
+    run_parser.add_argument('--scale', default='2000', help="synthetic patients when --data is not given")
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--data', help="copy this data directory instead of generating patients")
+    run_parser.add_argument('--sessions', help="JSONL sessions to replay; generated if omitted")
+    run_parser.add_argument('--users', type=int, default=10)
+    run_parser.add_argument('--duration', type=float, default=30.0)
+    run_parser.add_argument('--save-interval', type=float, default=5.0,
+                            help="seconds between background saves; 0 disables the save thread")
+    run_parser.add_argument('--think-time', type=float, default=0.0, help="seconds a user waits before each answer")
+    run_parser.add_argument('--rate-limit', action='store_true',
+                            help="keep the access-code rate limit on; refused sessions stop and count as errors")
+    run_parser.add_argument('--output', help="also write the report here as JSON")
+    generate_parser = subparsers.add_parser('generate', help="write synthetic sessions")
+    generate_parser.add_argument('--scale', default='2000')
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--count', type=int, default=100)
+    generate_parser.add_argument('--output', required=True)
+    record_parser = subparsers.add_parser('record', help="run the menus and record what is typed")
+    record_parser.add_argument('--output', required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        record(args.output)
+        return 0
+
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output) if args.output else None
+    sessions_path = os.path.abspath(args.sessions) if getattr(args, 'sessions', None) else None
+    data = os.path.abspath(args.data) if getattr(args, 'data', None) else None
+    system, workdir = build_system(args.scale, args.seed, data)
+    try:
+        if args.command == 'generate':
+            write_sessions(generate_sessions(system, args.count, args.seed), output)
+            return 0
+        sessions = read_sessions(sessions_path) if sessions_path else generate_sessions(system, 200, args.seed)
+        unknown = {session['entry'] for session in sessions} - set(ENTRIES)
+        if unknown:
+            print(f"Unknown session entry points: {', '.join(sorted(unknown))}")
+            return 1
+        report = run_load(system, sessions, args.users, args.duration, args.save_interval,
+                          args.think_time, args.rate_limit)
+        print_report(report)
+        if output:
+            with open(output, 'w') as f:
+                json.dump(report, f, indent=2)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""Provider <-> patient membership.
+
+A PatientDirectory holds every patient once, keyed by access code, plus a
+two-way index of which providers a patient belongs to. Providers see their
+patients through a PatientSet view, so a patient shared by several providers is
+still a single object, and add, remove, transfer and delete are all O(1) per
+membership. Listing a provider's patients is O(k) in that provider's patients.
+"""
+
+
+class PatientSet:
+    """Insertion-ordered set of patients keyed by access code; iterating yields patients."""
+
+    def __init__(self):
+        self.by_code = {}
+
+    def __iter__(self):
+        return iter(list(self.by_code.values()))
+
+    def __len__(self):
+        return len(self.by_code)
+
+    def __bool__(self):
+        return bool(self.by_code)
+
+    def __contains__(self, item):
+        return getattr(item, 'access_code', item) in self.by_code
+
+    def get(self, access_code):
+        return self.by_code.get(access_code)
+
+    def add(self, patient):
+        self.by_code[patient.access_code] = patient
+
+    def discard(self, access_code):
+        return self.by_code.pop(access_code, None)
+
+
+class PatientDirectory:
+    def __init__(self):
+        self.patients = {}
+        self.members = {}
+        self.memberships = {}
+        self.removal_listeners = []
+
+    def __len__(self):
+        return len(self.patients)
+
+    def get(self, access_code):
+        return self.patients.get(access_code)
+
+    def patients_of(self, provider_name):
+        members = self.members.get(provider_name)
+        if members is None:
+            members = self.members[provider_name] = PatientSet()
+        return members
+
+    def providers_of(self, access_code):
+        return set(self.memberships.get(access_code, ()))
+
+    def add(self, patient):
+        """Add or replace ``patient`` without changing its memberships."""
+        self.patients[patient.access_code] = patient
+        # Memberships may have been restored before the patient object was loaded.
+        for provider_name in self.memberships.get(patient.access_code, ()):
+            self.patients_of(provider_name).add(patient)
+
+    def attach(self, provider_name, patient):
+        self.add(patient)
+        self.memberships.setdefault(patient.access_code, set()).add(provider_name)
+        self.patients_of(provider_name).add(patient)
+
+    def detach(self, provider_name, access_code):
+        providers = self.memberships.get(access_code)
+        if providers:
+            providers.discard(provider_name)
+        return self.patients_of(provider_name).discard(access_code)
+
+    def transfer(self, access_code, from_provider_name, to_provider_name):
+        patient = self.detach(from_provider_name, access_code)
+        if patient is None:
+            return None
+        self.attach(to_provider_name, patient)
+        return patient
+
+    def remove(self, access_code):
+        """Delete a patient from the directory and every provider, then notify the listeners."""
+        patient = self.patients.pop(access_code, None)
+        for provider_name in self.memberships.pop(access_code, ()):
+            self.patients_of(provider_name).discard(access_code)
+        if patient is not None:
+            for listener in self.removal_listeners:
+                listener(patient)
+        return patient
+
+    def reset(self, patients, memberships=None):
+        self.patients = {}
+        self.members = {}
+        self.memberships = {code: set(names) for code, names in (memberships or {}).items()}
+        for patient in patients:
+            self.add(patient)
+
+    def memberships_to_dict(self):
+        return {code: sorted(names) for code, names in self.memberships.items() if names and code in self.patients}
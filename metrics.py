@@ -0,0 +1,221 @@
+"""Latency histograms, counters and opt-in profiling for HealthLinkSystem operations.
+
+Set MEDILINK_METRICS_FILE to write a dump when the menu exits; a path ending in
+.prom is written in Prometheus text format, anything else as JSON.
+
+Set MEDILINK_PROFILE to an operation name (for example save_data) to profile
+each call of that operation. MEDILINK_PROFILE_MODE picks cprofile (default) or
+tracemalloc; reports are written under medilink_data/profiles.
+"""
+import atexit
+import bisect
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+ENABLED = os.getenv('MEDILINK_METRICS', '1') != '0'
+
+# Upper bounds in seconds, from 10 microseconds to 10 seconds.
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROFILE_OPERATION = os.getenv('MEDILINK_PROFILE')
+PROFILE_DIR = os.path.join("medilink_data", "profiles")
+
+
+class Histogram:
+    def __init__(self, kind):
+        self.kind = kind
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, fraction):
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bound, bucket_count in zip(BUCKETS, self.bucket_counts):
+            seen += bucket_count
+            if seen >= target:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'count': self.count,
+            'sum_s': self.total,
+            'max_s': self.max,
+            'p50_s': self.quantile(0.5),
+            'p99_s': self.quantile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(BUCKETS, self.bucket_counts)},
+            'overflow': self.bucket_counts[-1],
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, operation, kind, seconds):
+        with self.lock:
+            histogram = self.histograms.get(operation)
+            if histogram is None:
+                histogram = self.histograms[operation] = Histogram(kind)
+            histogram.observe(seconds)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'operations': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            if self.histograms:
+                lines.append("# HELP medilink_operation_seconds Latency of HealthLinkSystem operations.")
+                lines.append("# TYPE medilink_operation_seconds histogram")
+            for name, histogram in sorted(self.histograms.items()):
+                labels = f'operation="{name}",kind="{histogram.kind}"'
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'medilink_operation_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'medilink_operation_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'medilink_operation_seconds_sum{{{labels}}} {histogram.total}')
+                lines.append(f'medilink_operation_seconds_count{{{labels}}} {histogram.count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE medilink_{name}_total counter")
+                lines.append(f"medilink_{name}_total {value}")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE medilink_{name} gauge")
+                lines.append(f"medilink_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.prometheus_text())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+
+
+registry = MetricsRegistry()
+
+
+def increment(name, value=1):
+    if ENABLED:
+        registry.increment(name, value)
+
+
+def set_gauge(name, value):
+    if ENABLED:
+        registry.set_gauge(name, value)
+
+
+def observe(operation, kind, seconds):
+    if ENABLED:
+        registry.observe(operation, kind, seconds)
+
+
+@contextmanager
+def profile(operation, mode=None):
+    """Profile the enclosed block with cProfile or tracemalloc and write a report."""
+    mode = mode or os.getenv('MEDILINK_PROFILE_MODE', 'cprofile')
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
+    if mode == 'tracemalloc':
+        already_tracing = tracemalloc.is_tracing()
+        if not already_tracing:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            after = tracemalloc.take_snapshot()
+            if not already_tracing:
+                tracemalloc.stop()
+            with open(os.path.join(PROFILE_DIR, f"{operation}-{stamp}.tracemalloc.txt"), 'w') as f:
+                for stat in after.compare_to(before, 'lineno')[:50]:
+                    f.write(f"{stat}\n")
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = os.path.join(PROFILE_DIR, f"{operation}-{stamp}.prof")
+            profiler.dump_stats(path)
+            with open(path[:-len('.prof')] + '.txt', 'w') as f:
+                pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(40)
+
+
+def timed(kind, name=None):
+    """Record the latency of every call in the histogram for ``name`` (the function name by default)."""
+    def decorator(func):
+        operation = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                if PROFILE_OPERATION == operation:
+                    with profile(operation):
+                        return func(*args, **kwargs)
+                return func(*args, **kwargs)
+            except Exception:
+                registry.increment(f"{operation}_errors")
+                raise
+            finally:
+                registry.observe(operation, kind, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def dump_on_exit(path=None):
+    path = path or os.getenv('MEDILINK_METRICS_FILE')
+    if path:
+        atexit.register(registry.dump, path)
+    return path
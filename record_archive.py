@@ -0,0 +1,250 @@
+"""Append-only, memory-mapped archive for old medical records.
+
+Each entry in the file is::
+
+    <II  access code length, payload length
+    access code (utf-8)
+    payload: <qBHH timestamp, flags, medication count, allergy count,
+             then <H-length-prefixed utf-8 strings (<I with the LONG_STRINGS flag):
+             condition, [timestamp text], [url], medications..., allergies...
+
+An entry with an empty payload is a tombstone: forgetting a patient appends one
+and drops them from the index. compact() rewrites the file without forgotten
+entries; forget runs it once they make up COMPACT_FRACTION of the file, and
+HealthLinkSystem's save thread runs it for whatever is left, so deleted records
+do not stay on disk for longer than a save interval.
+
+Records are decoded straight from slices of the memory map, so nothing is held in
+memory apart from the per-patient offset index. A lock covers every read and
+remap, so a reader never slices a view that a writer has just released.
+
+With a keyring (encrypted storage mode) the access code is replaced by its hex
+lookup key and each payload is sealed, with that key bound in.
+"""
+import mmap
+import os
+import struct
+import threading
+from datetime import datetime, timedelta
+
+ENTRY_HEADER = struct.Struct('<II')
+RECORD_HEADER = struct.Struct('<qBHH')
+STRING_LENGTH = struct.Struct('<H')
+LONG_STRING_LENGTH = struct.Struct('<I')
+
+EPOCH = datetime(1970, 1, 1)
+NO_TIMESTAMP = -(2 ** 63)
+HAS_URL = 1
+TEXT_TIMESTAMP = 2
+LONG_STRINGS = 4
+# Forgotten bytes are reclaimed once they are this share of the file, and at least this many
+COMPACT_FRACTION = 0.25
+COMPACT_MIN_BYTES = 1024 * 1024
+
+
+def encode_record(record):
+    timestamp = record.timestamp
+    flags = 0
+    strings = [record.condition or '']
+    if isinstance(timestamp, datetime):
+        delta = timestamp - EPOCH
+        micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    else:
+        micros = NO_TIMESTAMP
+        if timestamp is not None:
+            flags |= TEXT_TIMESTAMP
+            strings.append(str(timestamp))
+    url = getattr(record, 'url', None)
+    if url:
+        flags |= HAS_URL
+        strings.append(url)
+    strings.extend(record.medications)
+    strings.extend(record.allergies)
+    data = [value.encode('utf-8') for value in strings]
+    length = STRING_LENGTH
+    if any(len(value) > 0xFFFF for value in data):
+        # Rare enough that every other record keeps the short lengths
+        flags |= LONG_STRINGS
+        length = LONG_STRING_LENGTH
+    header = RECORD_HEADER.pack(micros, flags, len(record.medications), len(record.allergies))
+    return header + b''.join(length.pack(len(value)) + value for value in data)
+
+
+class RecordArchive:
+    def __init__(self, path, keyring=None):
+        self.path = path
+        self.keyring = keyring
+        self.index = {}
+        self.map = None
+        self.view = None
+        self.size = 0
+        # Bytes of forgotten entries and tombstones, reclaimed by the next compaction
+        self.dead_bytes = 0
+        # Archiving runs on the save thread while menus read, and remapping releases the view readers slice
+        self.lock = threading.RLock()
+        if os.path.exists(path):
+            self.size = os.path.getsize(path)
+            self.remap()
+            self.build_index()
+
+    def remap(self):
+        with self.lock:
+            self.close()
+            if self.size:
+                with open(self.path, 'rb') as f:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.map)
+
+    def close(self):
+        with self.lock:
+            if self.view is not None:
+                self.view.release()
+                self.view = None
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+
+    def build_index(self):
+        offset = 0
+        while offset + ENTRY_HEADER.size <= self.size:
+            code_length, payload_length = ENTRY_HEADER.unpack_from(self.map, offset)
+            code_start = offset + ENTRY_HEADER.size
+            payload_start = code_start + code_length
+            if payload_start + payload_length > self.size:
+                # A torn write at the end of the file; everything before it is intact.
+                break
+            access_code = str(self.view[code_start:payload_start], 'utf-8')
+            if payload_length:
+                self.index.setdefault(access_code, []).append((payload_start, payload_length))
+            else:
+                # A tombstone: everything stored under the code before it is forgotten
+                self.dead_bytes += payload_start - offset + self.entry_bytes(access_code)
+                self.index.pop(access_code, None)
+            offset = payload_start + payload_length
+
+    def entry_bytes(self, key):
+        code_length = len(key.encode('utf-8'))
+        return sum(ENTRY_HEADER.size + code_length + length for _, length in self.index.get(key, ()))
+
+    def append(self, access_code, records):
+        self.append_many([(access_code, records)])
+
+    def key(self, access_code):
+        return access_code if self.keyring is None else self.keyring.lookup_key(access_code).hex()
+
+    def append_many(self, batches):
+        """Append ``(access_code, records)`` batches with one write and one remap."""
+        with self.lock:
+            chunks = []
+            offset = self.size
+            for access_code, records in batches:
+                key = self.key(access_code)
+                code = key.encode('utf-8')
+                entries = self.index.setdefault(key, [])
+                for record in records:
+                    payload = encode_record(record)
+                    if self.keyring is not None:
+                        payload = self.keyring.seal(payload, code)
+                    chunks.append(ENTRY_HEADER.pack(len(code), len(payload)) + code + payload)
+                    entries.append((offset + ENTRY_HEADER.size + len(code), len(payload)))
+                    offset += len(chunks[-1])
+            self.write(chunks, offset)
+
+    def write(self, chunks, size):
+        if not chunks:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'ab') as f:
+            f.write(b''.join(chunks))
+        self.size = size
+        self.remap()
+
+    def forget(self, access_code):
+        """Drop a patient's entries: a tombstone records it, and the bytes go at the next compaction."""
+        with self.lock:
+            key = self.key(access_code)
+            if key not in self.index:
+                return
+            code = key.encode('utf-8')
+            tombstone = ENTRY_HEADER.pack(len(code), 0) + code
+            self.dead_bytes += self.entry_bytes(key) + len(tombstone)
+            del self.index[key]
+            self.write([tombstone], self.size + len(tombstone))
+            if self.dead_bytes >= max(COMPACT_MIN_BYTES, self.size * COMPACT_FRACTION):
+                self.compact()
+
+    def compact(self):
+        """Rewrite the file with only the indexed entries, in their current order."""
+        with self.lock:
+            temp_path = f"{self.path}.tmp"
+            entries = sorted((offset, length, key) for key, offsets in self.index.items()
+                             for offset, length in offsets)
+            index = {}
+            size = 0
+            with open(temp_path, 'wb') as f:
+                for offset, length, key in entries:
+                    code = key.encode('utf-8')
+                    # Sealed payloads are bound to the key, not the offset, so they copy as they are
+                    f.write(ENTRY_HEADER.pack(len(code), length) + code)
+                    f.write(self.view[offset:offset + length])
+                    index.setdefault(key, []).append((size + ENTRY_HEADER.size + len(code), length))
+                    size += ENTRY_HEADER.size + len(code) + length
+                f.flush()
+                os.fsync(f.fileno())
+            # A mapped file cannot be replaced on Windows
+            self.close()
+            os.replace(temp_path, self.path)
+            self.index = index
+            self.size = size
+            self.dead_bytes = 0
+            self.remap()
+
+    def count(self, access_code):
+        return len(self.index.get(self.key(access_code), ()))
+
+    def read_record(self, offset, record_cls, view=None):
+        view = self.view if view is None else view
+        micros, flags, medication_count, allergy_count = RECORD_HEADER.unpack_from(view, offset)
+        position = offset + RECORD_HEADER.size
+        string_length = LONG_STRING_LENGTH if flags & LONG_STRINGS else STRING_LENGTH
+        strings = []
+        for _ in range(1 + bool(flags & TEXT_TIMESTAMP) + bool(flags & HAS_URL) + medication_count + allergy_count):
+            (length,) = string_length.unpack_from(view, position)
+            position += string_length.size
+            strings.append(str(view[position:position + length], 'utf-8'))
+            position += length
+
+        condition = strings[0]
+        next_string = 1
+        if micros != NO_TIMESTAMP:
+            timestamp = EPOCH + timedelta(microseconds=micros)
+        elif flags & TEXT_TIMESTAMP:
+            timestamp = strings[next_string]
+            next_string += 1
+        else:
+            timestamp = None
+        url = None
+        if flags & HAS_URL:
+            url = strings[next_string]
+            next_string += 1
+        medications = strings[next_string:next_string + medication_count]
+        allergies = strings[next_string + medication_count:]
+        record = record_cls(condition, medications, allergies, timestamp)
+        if url:
+            record.url = url
+        return record
+
+    def iter_records(self, access_code, record_cls):
+        key = self.key(access_code)
+        records = []
+        # Decoded under the lock, since a remap or compaction in between would invalidate the offsets
+        with self.lock:
+            for offset, length in self.index.get(key, ()):
+                if self.keyring is None:
+                    records.append(self.read_record(offset, record_cls))
+                else:
+                    payload = self.keyring.open(self.view[offset:offset + length], key.encode('utf-8'))
+                    records.append(self.read_record(0, record_cls, memoryview(payload)))
+        return iter(records)
@@ -0,0 +1,319 @@
+"""Versioned medical record history.
+
+Every edit of a MedicalRecordEntry becomes a new version that stores only the
+fields that changed and points at its parent, so unchanged fields are shared
+between versions instead of copied. Every CHECKPOINT_INTERVAL versions a full
+snapshot is kept, which bounds the work an "as of" read has to do. Versions can
+be appended to a JSON lines file so the history survives restarts while the
+file grows with the size of the edits. With a keyring every line of the file
+is sealed (see encryption.log_codec).
+
+A record is identified by its position among all of the patient's records,
+archived ones first. Callers pass the index into ``patient.medical_records``;
+``archived_count(access_code)`` turns it into that position. When records move
+to the archive, reindex() moves their histories along and logs the move, so
+the file replays to the same keys.
+"""
+import bisect
+import os
+from datetime import datetime
+
+import encryption
+
+RECORD_FIELDS = ('condition', 'medications', 'allergies', 'timestamp', 'url')
+CHECKPOINT_INTERVAL = 16
+
+
+def record_fields(record):
+    return {field: getattr(record, field, None) for field in RECORD_FIELDS}
+
+
+class RecordVersion:
+    __slots__ = ('number', 'edited_at', 'author', 'changes', 'parent', 'snapshot')
+
+    def __init__(self, number, edited_at, author, changes, parent):
+        self.number = number
+        self.edited_at = edited_at
+        self.author = author
+        self.changes = changes
+        self.parent = parent
+        self.snapshot = None
+
+    def fields(self):
+        # Walk back to the nearest snapshot, then replay the diffs forwards.
+        chain = []
+        version = self
+        while version is not None and version.snapshot is None:
+            chain.append(version.changes)
+            version = version.parent
+        fields = dict(version.snapshot) if version is not None else {}
+        for changes in reversed(chain):
+            fields.update(changes)
+        return fields
+
+
+class VersionedRecord:
+    def __init__(self):
+        self.versions = []
+        self.edit_times = []
+
+    @property
+    def latest(self):
+        return self.versions[-1] if self.versions else None
+
+    def add_version(self, fields, edited_at, author=None):
+        """Store ``fields`` as a new version and return it, or None when nothing changed."""
+        latest = self.latest
+        current = latest.fields() if latest else {}
+        changes = {field: value for field, value in fields.items() if current.get(field) != value}
+        if latest is not None and not changes:
+            return None
+        version = RecordVersion(len(self.versions) + 1, edited_at, author, changes, latest)
+        if version.number % CHECKPOINT_INTERVAL == 1:
+            # The snapshot references the existing field values, it does not copy them.
+            version.snapshot = dict(current, **changes)
+        self.versions.append(version)
+        self.edit_times.append(edited_at)
+        return version
+
+    def as_of(self, when):
+        index = bisect.bisect_right(self.edit_times, when)
+        if index == 0:
+            return None
+        return self.versions[index - 1].fields()
+
+
+class RecordHistory:
+    def __init__(self, path=None, archived_count=None, keyring=None):
+        self.path = path
+        if path:
+            encryption.seal_plain_lines(keyring, path)
+        self.dumps, self.loads = encryption.log_codec(keyring, path)
+        self.archived_count = archived_count or (lambda access_code: 0)
+        self.records = {}
+        self.audit = []
+        self.audit_by_patient = {}
+        # Returns the list to hold file appends in until commit (the caller's transaction), or None
+        self.buffer = lambda: None
+        if path and os.path.exists(path):
+            self.load()
+
+    def position(self, access_code, index):
+        return self.archived_count(access_code) + index
+
+    def key(self, patient, index):
+        return (patient.access_code, self.position(patient.access_code, index))
+
+    def is_tracked(self, patient, index):
+        return self.key(patient, index) in self.records
+
+    def track(self, patient, author=None):
+        """Record a baseline version for every record of ``patient`` that has no history yet."""
+        for index, record in enumerate(patient.medical_records):
+            if not self.is_tracked(patient, index):
+                edited_at = record.timestamp if isinstance(record.timestamp, datetime) else datetime.now()
+                self.add_version(*self.key(patient, index), record_fields(record), edited_at, author)
+
+    def record_added(self, patient, index, author=None, edited_at=None):
+        record = patient.medical_records[index]
+        return self.add_version(*self.key(patient, index), record_fields(record),
+                                edited_at or datetime.now(), author)
+
+    def replace_record(self, patient, index, record, author=None, edited_at=None):
+        """Put ``record`` at ``index`` in place of the current entry and store the edit as a new version."""
+        # Older records may predate the history, so give them a baseline before overwriting.
+        self.track(patient)
+        patient.medical_records[index] = record
+        return self.add_version(*self.key(patient, index), record_fields(record),
+                                edited_at or datetime.now(), author)
+
+    def add_version(self, access_code, index, fields, edited_at, author=None, persist=True):
+        versioned = self.records.get((access_code, index))
+        if versioned is None:
+            versioned = self.records[(access_code, index)] = VersionedRecord()
+        version = versioned.add_version(fields, edited_at, author)
+        if version is None:
+            return None
+        entry = (edited_at, access_code, index, version.number, author, tuple(version.changes))
+        self.audit.append(entry)
+        self.audit_by_patient.setdefault(access_code, []).append(entry)
+        if persist and self.path:
+            self.append_to_file(access_code, index, version)
+        return version
+
+    def discard_version(self, access_code, index, version):
+        """Drop ``version`` again if it is still the latest one, e.g. when a transaction rolls back."""
+        self.drop_version(access_code, self.position(access_code, index), version.number)
+
+    def drop_version(self, access_code, position, number):
+        versioned = self.records.get((access_code, position))
+        if versioned is None or versioned.latest is None or versioned.latest.number != number:
+            return
+        versioned.versions.pop()
+        versioned.edit_times.pop()
+        if not versioned.versions:
+            del self.records[(access_code, position)]
+        # Edits of other records may have come later, so the entry is looked up rather than popped
+        entries = self.audit_by_patient.get(access_code, [])
+        for i in range(len(entries) - 1, -1, -1):
+            if entries[i][2] == position and entries[i][3] == number:
+                entry = entries.pop(i)
+                break
+        else:
+            return
+        for i in range(len(self.audit) - 1, -1, -1):
+            if self.audit[i] is entry:
+                del self.audit[i]
+                break
+        pending = self.buffer()
+        if pending:
+            key = (access_code, position, number)
+            pending[:] = [line for line in pending
+                          if (line['access_code'], line.get('index'), line.get('version')) != key]
+
+    def discard_lines(self, lines):
+        """Drop the versions in a rolled-back transaction's ``lines``; returns the record moves, which still apply."""
+        moves = []
+        # Positions were renamed by any moves that came after a version line
+        later_moves = {}
+        for line in reversed(lines):
+            access_code = line['access_code']
+            if 'moves' in line:
+                moves.append(line)
+                later_moves.setdefault(access_code, []).insert(0, dict(line['moves']))
+                continue
+            position = line['index']
+            for patient_moves in later_moves.get(access_code, ()):
+                position = patient_moves.get(position, position)
+            self.drop_version(access_code, position, line['version'])
+        moves.reverse()
+        return moves
+
+    def records_as_of(self, patient, when, archived=()):
+        """Return the field dicts of ``patient``'s records as they stood at ``when``.
+
+        ``archived`` are the patient's archived records, which come first.
+        """
+        current = list(archived) + patient.medical_records
+        records = []
+        index = 0
+        while (patient.access_code, index) in self.records or index < len(current):
+            versioned = self.records.get((patient.access_code, index))
+            if versioned is not None:
+                fields = versioned.as_of(when)
+            else:
+                record = current[index]
+                timestamp = record.timestamp
+                fields = record_fields(record) if not isinstance(timestamp, datetime) or timestamp <= when else None
+            if fields is not None:
+                records.append(fields)
+            index += 1
+        return records
+
+    def audit_trail(self, access_code=None):
+        if access_code is None:
+            return list(self.audit)
+        return list(self.audit_by_patient.get(access_code, []))
+
+    def last_edited(self, access_code, position):
+        """When the record at ``position`` (archived records first) last changed, or None."""
+        versioned = self.records.get((access_code, position))
+        return versioned.latest.edited_at if versioned else None
+
+    def versions(self, patient, index):
+        versioned = self.records.get(self.key(patient, index))
+        return list(versioned.versions) if versioned else []
+
+    def reindex(self, moves_by_patient, persist=True, renamed=None):
+        """Move histories to new positions; ``moves_by_patient`` is {access code: {old position: new position}}."""
+        # Loading passes its own ``renamed`` and rewrites self.audit once at the end
+        rebuild = renamed is None
+        renamed = {} if rebuild else renamed
+        lines = []
+        for access_code, moves in moves_by_patient.items():
+            moves = {old: new for old, new in moves.items() if old != new}
+            if not moves:
+                continue
+            moved = {moves[index]: self.records.pop((access_code, index))
+                     for index in list(moves) if (access_code, index) in self.records}
+            self.records.update(((access_code, index), versioned) for index, versioned in moved.items())
+            entries = self.audit_by_patient.get(access_code, [])
+            for i, entry in enumerate(entries):
+                if entry[2] in moves:
+                    renamed[id(entry)] = entries[i] = entry[:2] + (moves[entry[2]],) + entry[3:]
+            lines.append({'access_code': access_code, 'moves': sorted(moves.items())})
+        if rebuild:
+            self.rename_audit(renamed)
+        if persist and self.path and lines:
+            pending = self.buffer()
+            if pending is not None:
+                pending.extend(lines)
+            else:
+                self.write_lines(lines)
+
+    def rename_audit(self, renamed):
+        # Ids are safe to match on: every replaced entry is still referenced from self.audit or ``renamed``
+        if renamed:
+            audit = []
+            for entry in self.audit:
+                while id(entry) in renamed:
+                    entry = renamed[id(entry)]
+                audit.append(entry)
+            self.audit = audit
+
+    def append_to_file(self, access_code, index, version):
+        line = {
+            'access_code': access_code,
+            'index': index,
+            'version': version.number,
+            'edited_at': version.edited_at.isoformat(),
+            'author': version.author,
+            'changes': {field: encode_value(value) for field, value in version.changes.items()},
+        }
+        pending = self.buffer()
+        if pending is not None:
+            pending.append(line)
+        else:
+            self.write_lines([line])
+
+    def write_lines(self, lines):
+        if not lines or not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(''.join(self.dumps(line) + "\n" for line in lines))
+
+    def load(self):
+        renamed = {}
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = self.loads(line)
+                if 'moves' in entry:
+                    self.reindex({entry['access_code']: dict(entry['moves'])}, persist=False, renamed=renamed)
+                    continue
+                versioned = self.records.get((entry['access_code'], entry['index']))
+                latest = versioned.latest.fields() if versioned and versioned.latest else {}
+                fields = dict(latest)
+                fields.update({field: decode_value(field, value) for field, value in entry['changes'].items()})
+                self.add_version(entry['access_code'], entry['index'], fields,
+                                 datetime.fromisoformat(entry['edited_at']), entry['author'], persist=False)
+        self.rename_audit(renamed)
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def decode_value(field, value):
+    if field == 'timestamp' and isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    return value
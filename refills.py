@@ -0,0 +1,201 @@
+"""Persistent medication refill queue with batched fulfilment.
+
+Requests are appended to medilink_data/refills.jsonl and replayed on start, so
+nothing is lost between runs. A patient has at most one pending request per
+medication; asking again returns the pending one. Fulfilment works one
+medication at a time: pending requests are served oldest first while stock
+lasts, and the whole batch is committed by a single log line that lists the
+fulfilled request ids together with the stock left. Inventory changes made by
+a batch are replayed from that line if the state file was not saved after it,
+so a request is never fulfilled without its stock being taken, or vice versa.
+With a keyring every log line is sealed (see encryption.log_codec).
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import encryption
+import metrics
+from transaction import atomic_write
+from vocabulary import MEDICATIONS, term_key
+
+DEFAULT_PATH = os.path.join("medilink_data", "refills.jsonl")
+# Rewrite the log on start once it holds this many lines and most are finished requests
+COMPACT_MIN_LINES = 10000
+
+
+class RefillQueue:
+    def __init__(self, path=DEFAULT_PATH, keyring=None):
+        self.path = path
+        encryption.seal_plain_lines(keyring, path)
+        self.dumps, self.loads = encryption.log_codec(keyring, path)
+        self.lock = threading.Lock()
+        self.sequence = 0
+        # medication -> OrderedDict of request id -> request, oldest first
+        self.pending = {}
+        self.by_patient = {}
+        # inventory item -> (sequence, quantity left) from the newest batch
+        self.stock = {}
+        self.load()
+
+    def __len__(self):
+        return len(self.by_patient)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        lines = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Torn by a crash; the request was never acknowledged.
+                    break
+                lines += 1
+                self.replay(self.loads(line))
+        if lines >= COMPACT_MIN_LINES and len(self) * 2 < lines:
+            self.compact()
+        metrics.set_gauge('refill_backlog', len(self))
+
+    def replay(self, event):
+        self.sequence = max(self.sequence, event['seq'])
+        if event['type'] == 'requested':
+            # Older logs also stored the patient's name; compact() leaves it out
+            event['request'].pop('patient', None)
+            self.add(event['request'])
+        elif event['type'] == 'fulfilled':
+            for request_id in event['ids']:
+                self.remove(request_id)
+            for item, quantity in event['stock'].items():
+                self.stock[item] = (event['seq'], quantity)
+        elif event['type'] == 'cancelled':
+            self.remove(event['id'])
+
+    def add(self, request):
+        self.pending.setdefault(request['medication'], OrderedDict())[request['id']] = request
+        self.by_patient[(request['access_code'], request['medication'])] = request
+
+    def remove(self, request_id):
+        medication, _ = request_id.rsplit('#', 1)
+        request = self.pending.get(medication, {}).pop(request_id, None)
+        if request is not None:
+            self.by_patient.pop((request['access_code'], medication), None)
+            if not self.pending[medication]:
+                del self.pending[medication]
+        return request
+
+    def write(self, events):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(''.join(self.dumps(event) + "\n" for event in events))
+
+    def next_event(self, event_type, **data):
+        self.sequence += 1
+        event = {'seq': self.sequence, 'time': datetime.now().isoformat(), 'type': event_type}
+        event.update(data)
+        return event
+
+    def request(self, patient, medication, quantity, source):
+        """Queue a refill; returns (request, False) if the same medication is already pending for the patient."""
+        if quantity <= 0:
+            raise ValueError("Refill quantity must be positive")
+        medication = MEDICATIONS.normalize([medication])
+        if not medication:
+            raise ValueError("Medication name is empty")
+        medication = medication[0]
+        with self.lock:
+            existing = self.by_patient.get((patient.access_code, medication))
+            if existing is not None:
+                metrics.increment('refills_deduplicated')
+                return existing, False
+            event = self.next_event('requested')
+            request = {
+                'id': f"{medication}#{event['seq']}",
+                'access_code': patient.access_code,
+                'medication': medication,
+                'quantity': quantity,
+                'source': source,
+                'requested': time.time(),
+            }
+            event['request'] = request
+            self.write([event])
+            self.add(request)
+        metrics.increment('refills_requested')
+        metrics.set_gauge('refill_backlog', len(self))
+        return request, True
+
+    def cancel(self, request_id):
+        with self.lock:
+            request = self.remove(request_id)
+            if request is not None:
+                self.write([self.next_event('cancelled', id=request_id)])
+        metrics.set_gauge('refill_backlog', len(self))
+        return request
+
+    def backlog(self):
+        """{medication: (pending requests, total quantity)}"""
+        return {medication: (len(requests), sum(request['quantity'] for request in requests.values()))
+                for medication, requests in self.pending.items()}
+
+    def fulfil(self, inventory, medications=None):
+        """Serve pending requests from ``inventory``, one batch per medication.
+
+        Requests are served oldest first and a medication's batch stops at the
+        first request its stock cannot cover, so large requests are not starved.
+        Returns the fulfilled requests.
+        """
+        # Inventory items are typed freely, so they are matched on the normalized name.
+        items = {term_key(item): item for item in inventory}
+        fulfilled = []
+        now = time.time()
+        with self.lock:
+            for medication in list(MEDICATIONS.normalize(medications) if medications else self.pending):
+                requests = self.pending.get(medication)
+                item = items.get(term_key(medication))
+                if not requests or item is None:
+                    continue
+                stock = inventory[item]
+                batch = []
+                for request in requests.values():
+                    if request['quantity'] > stock:
+                        break
+                    stock -= request['quantity']
+                    batch.append(request)
+                if not batch:
+                    continue
+                event = self.next_event('fulfilled', medication=medication,
+                                        ids=[request['id'] for request in batch], stock={item: stock})
+                self.write([event])
+                # The log line above is the commit point; memory follows it.
+                inventory[item] = stock
+                self.stock[item] = (event['seq'], stock)
+                for request in batch:
+                    self.remove(request['id'])
+                    metrics.observe('refill_fulfilment', 'refill', now - request['requested'])
+                fulfilled.extend(batch)
+        metrics.increment('refills_fulfilled', len(fulfilled))
+        metrics.set_gauge('refill_backlog', len(self))
+        return fulfilled
+
+    def apply_stock(self, inventory, since_sequence):
+        """Redo the inventory changes of batches newer than ``since_sequence`` (the one the state file saw)."""
+        for item, (sequence, quantity) in self.stock.items():
+            if sequence > since_sequence:
+                inventory[item] = quantity
+
+    def compact(self):
+        """Rewrite the log with only the pending requests and the newest stock levels."""
+        events = [{'seq': seq, 'time': None, 'type': 'fulfilled', 'ids': [], 'stock': {item: quantity}}
+                  for item, (seq, quantity) in self.stock.items()]
+        for requests in self.pending.values():
+            for request in requests.values():
+                events.append({'seq': int(request['id'].rsplit('#', 1)[1]), 'time': None,
+                               'type': 'requested', 'request': request})
+        events.sort(key=lambda event: event['seq'])
+        # Keeps the sequence from going back when the newest events were dropped
+        events.append({'seq': self.sequence, 'time': datetime.now().isoformat(), 'type': 'compacted'})
+        with atomic_write(self.path) as f:
+            f.write(''.join(self.dumps(event) + "\n" for event in events))
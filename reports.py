@@ -0,0 +1,195 @@
+"""Patient reports for many patients at once, as text, HTML or CSV.
+
+Patients are flattened into plain tuples, cut into chunks and rendered in
+worker processes. Each worker streams its chunk into a part file per format;
+the parts are then appended, in order, to one report file per format between
+the shared header and footer. The templates live at module level, so every
+worker renders with the same ones. Small batches are rendered in-process.
+
+    python reports.py --provider "City Hospital" --format text html csv --output reports
+"""
+import argparse
+import csv
+import html
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from string import Template
+
+FORMATS = ('text', 'html', 'csv')
+EXTENSIONS = {'text': 'txt', 'html': 'html', 'csv': 'csv'}
+# Below this many patients rendering stays in-process; starting workers costs more than it saves.
+PARALLEL_THRESHOLD = 5000
+CHUNK_SIZE = 2000
+CSV_FIELDS = ['Name', 'Access Code', 'Location', 'Condition', 'Medications', 'Allergies', 'Timestamp']
+
+TEMPLATES = {
+    'text': {
+        'header': Template("MediLink patient reports\nGenerated: $generated\nPatients: $count\n\n"),
+        'patient': Template("Patient Report for $name:\nAccess Code: $access_code\nLocation: $location\n$records\n"),
+        'record': Template("Condition: $condition\nMedications: $medications\nAllergies: $allergies\n"
+                           "Timestamp: $timestamp\n------------------------\n"),
+        'empty': "No medical records found for this patient.\n",
+        'footer': Template(""),
+    },
+    'html': {
+        'header': Template("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Patient Reports</title>\n"
+                           "<style>table{border-collapse:collapse}td,th{border:1px solid #999;padding:2px 6px}</style>\n"
+                           "</head><body>\n<h1>MediLink patient reports</h1>\n"
+                           "<p>Generated: $generated &middot; Patients: $count</p>\n"),
+        'patient': Template("<section><h2>$name</h2><p>Access Code: $access_code &middot; Location: $location</p>\n"
+                            "$records</section>\n"),
+        'record': Template("<tr><td>$timestamp</td><td>$condition</td><td>$medications</td><td>$allergies</td></tr>\n"),
+        'records': Template("<table><tr><th>Timestamp</th><th>Condition</th><th>Medications</th><th>Allergies</th></tr>\n"
+                            "$rows</table>\n"),
+        'empty': "<p>No medical records found for this patient.</p>\n",
+        'footer': Template("</body></html>\n"),
+    },
+}
+
+
+def format_timestamp(timestamp):
+    if isinstance(timestamp, datetime):
+        return timestamp.strftime("%Y-%m-%d %H:%M")
+    return str(timestamp or '')
+
+
+def patient_row(patient, records):
+    """Plain tuples are all a worker needs, and they pickle far faster than Patient objects."""
+    return (patient.name, patient.access_code, patient.location or '',
+            tuple((record.condition or '', ', '.join(record.medications), ', '.join(record.allergies),
+                   format_timestamp(record.timestamp)) for record in records))
+
+
+def render_text(rows, out):
+    templates = TEMPLATES['text']
+    for name, access_code, location, records in rows:
+        body = ''.join(templates['record'].substitute(condition=condition, medications=medications,
+                                                      allergies=allergies, timestamp=timestamp)
+                       for condition, medications, allergies, timestamp in records)
+        out.write(templates['patient'].substitute(name=name, access_code=access_code, location=location or '-',
+                                                  records=body or templates['empty']))
+
+
+def render_html(rows, out):
+    templates = TEMPLATES['html']
+    for name, access_code, location, records in rows:
+        body = ''.join(templates['record'].substitute(condition=html.escape(condition),
+                                                      medications=html.escape(medications),
+                                                      allergies=html.escape(allergies),
+                                                      timestamp=html.escape(timestamp))
+                       for condition, medications, allergies, timestamp in records)
+        out.write(templates['patient'].substitute(
+            name=html.escape(name), access_code=html.escape(access_code), location=html.escape(location or '-'),
+            records=templates['records'].substitute(rows=body) if body else templates['empty']))
+
+
+def render_csv(rows, out):
+    writer = csv.writer(out)
+    for name, access_code, location, records in rows:
+        for condition, medications, allergies, timestamp in records:
+            writer.writerow([name, access_code, location, condition, medications, allergies, timestamp])
+
+
+RENDERERS = {'text': render_text, 'html': render_html, 'csv': render_csv}
+
+
+def render_chunk(rows, parts):
+    """Write ``rows`` to ``parts`` ({format: path}); runs in a worker process for large batches."""
+    for fmt, path in parts.items():
+        with open(path, 'w', newline='', encoding='utf-8') as out:
+            RENDERERS[fmt](rows, out)
+    return len(rows)
+
+
+def write_header(fmt, out, count):
+    if fmt == 'csv':
+        csv.writer(out).writerow(CSV_FIELDS)
+    else:
+        generated = datetime.now().strftime("%Y-%m-%d %H:%M")
+        out.write(TEMPLATES[fmt]['header'].substitute(generated=generated, count=count))
+
+
+def generate_reports(rows, output_dir, formats=FORMATS, name='patient_report', workers=None, progress=None):
+    """Render patient rows into one file per format under ``output_dir``.
+
+    ``progress(done, total, elapsed)`` is called after each chunk. Returns
+    {format: path}.
+    """
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown report formats: {', '.join(sorted(unknown))}")
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {fmt: os.path.join(output_dir, f"{name}.{EXTENSIONS[fmt]}") for fmt in formats}
+    chunks = [rows[start:start + CHUNK_SIZE] for start in range(0, len(rows), CHUNK_SIZE)]
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=output_dir) as parts_dir:
+        part_paths = [{fmt: os.path.join(parts_dir, f"{i:05d}.{EXTENSIONS[fmt]}") for fmt in formats}
+                      for i in range(len(chunks))]
+        outputs = {fmt: open(path, 'w', newline='', encoding='utf-8') for fmt, path in paths.items()}
+        try:
+            for fmt, out in outputs.items():
+                write_header(fmt, out, len(rows))
+
+            def collect(done, parts):
+                # Parts arrive in chunk order, so appending them keeps the patients in order.
+                for fmt, out in outputs.items():
+                    with open(parts[fmt], 'r', newline='', encoding='utf-8') as part:
+                        shutil.copyfileobj(part, out)
+                    os.remove(parts[fmt])
+                if progress:
+                    progress(done, len(rows), time.perf_counter() - start)
+
+            done = 0
+            if len(rows) < PARALLEL_THRESHOLD or (os.cpu_count() or 1) < 2:
+                for chunk, parts in zip(chunks, part_paths):
+                    done += render_chunk(chunk, parts)
+                    collect(done, parts)
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    for count, parts in zip(executor.map(render_chunk, chunks, part_paths), part_paths):
+                        done += count
+                        collect(done, parts)
+            for fmt, out in outputs.items():
+                if fmt in TEMPLATES:
+                    out.write(TEMPLATES[fmt]['footer'].substitute())
+        finally:
+            for out in outputs.values():
+                out.close()
+    return paths
+
+
+def print_progress(done, total, elapsed):
+    rate = done / elapsed if elapsed else 0.0
+    print(f"Rendered {done}/{total} patients ({rate:.0f} patients/s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render patient reports for many patients at once.")
+    parser.add_argument('--provider', help="only this provider's patients")
+    parser.add_argument('--condition', help="only patients with a record of this condition")
+    parser.add_argument('--changed-since', type=datetime.fromisoformat, metavar='YYYY-MM-DD',
+                        help="only patients with records added or edited since then")
+    parser.add_argument('--format', nargs='+', choices=FORMATS, default=['text'])
+    parser.add_argument('--output', default='reports', help="directory for the report files")
+    parser.add_argument('--workers', type=int, help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    from MediLink1 import HealthLinkSystem
+    system = HealthLinkSystem(start_backup=False)
+    patients = system.select_report_patients(args.provider, args.condition, args.changed_since)
+    if not patients:
+        print("No patients match.")
+        return 1
+    paths = system.generate_batch_reports(patients, args.output, args.format, args.workers, print_progress)
+    for path in paths.values():
+        print(f"Wrote {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""Synthetic patients, records, appointments and staff for benchmarks and load tests."""
+import json
+import os
+import random
+import string
+from datetime import datetime, timedelta
+
+from MediLink1 import HealthLinkSystem, MedicalRecordEntry, Patient
+from facilities import Facility, FacilityRegistry
+
+SCALES = {
+    '1k': 1000,
+    '100k': 100000,
+    '1m': 1000000,
+}
+
+FIRST_NAMES = [
+    'Aarav', 'Vivaan', 'Aditya', 'Vihaan', 'Arjun', 'Sai', 'Reyansh', 'Krishna', 'Ishaan', 'Rohan',
+    'Ananya', 'Diya', 'Saanvi', 'Aadhya', 'Pari', 'Myra', 'Kavya', 'Anika', 'Riya', 'Meera',
+]
+LAST_NAMES = [
+    'Sharma', 'Verma', 'Reddy', 'Patel', 'Iyer', 'Nair', 'Gupta', 'Rao', 'Singh', 'Das',
+    'Kumar', 'Mehta', 'Joshi', 'Menon', 'Pillai', 'Bose', 'Chopra', 'Kapoor', 'Naidu', 'Shetty',
+]
+CONDITIONS = [
+    'Diabetes', 'Hypertension', 'Asthma', 'Obesity', 'Heart Disease', 'Arthritis', 'Depression',
+    'Anxiety Disorders', 'Osteoporosis', 'Chronic Kidney Disease', 'COPD', 'Hepatitis', 'Epilepsy',
+]
+MEDICATIONS = [
+    'Metformin', 'Insulin', 'Amlodipine', 'Losartan', 'Salbutamol', 'Atorvastatin', 'Aspirin',
+    'Ibuprofen', 'Sertraline', 'Paracetamol', 'Omeprazole', 'Levothyroxine', 'Prednisone',
+]
+ALLERGIES = ['Penicillin', 'Peanuts', 'Latex', 'Dust', 'Pollen', 'Shellfish', 'Sulfa', 'None']
+CITIES = ['Hyderabad', 'Bengaluru', 'Chennai', 'Mumbai', 'Delhi', 'Pune', 'Kolkata', 'Kochi']
+PROVIDER_NAMES = ['City Hospital', 'General Clinic']
+CITY_COORDINATES = {
+    'Hyderabad': (17.385, 78.4867), 'Bengaluru': (12.9716, 77.5946), 'Chennai': (13.0827, 80.2707),
+    'Mumbai': (19.076, 72.8777), 'Delhi': (28.7041, 77.1025), 'Pune': (18.5204, 73.8567),
+    'Kolkata': (22.5726, 88.3639), 'Kochi': (9.9312, 76.2673),
+}
+FACILITY_TYPES = ['Hospital', 'Clinic', 'Pharmacy', 'Diagnostic Centre']
+FACILITY_SERVICES = ['Emergency', 'Pharmacy', 'Pediatrics', 'Cardiology', 'Radiology', 'Maternity', 'Dialysis', 'ICU']
+
+START_DATE = datetime(2020, 1, 1)
+
+
+def parse_scale(scale):
+    if scale in SCALES:
+        return SCALES[scale]
+    return int(scale)
+
+
+def random_access_code(rng):
+    return ''.join(rng.choices(string.ascii_uppercase + string.digits, k=8))
+
+
+def random_timestamp(rng):
+    return START_DATE + timedelta(seconds=rng.randrange(0, 5 * 365 * 24 * 3600))
+
+
+def generate_record(rng):
+    return MedicalRecordEntry(
+        rng.choice(CONDITIONS),
+        rng.sample(MEDICATIONS, rng.randint(1, 3)),
+        rng.sample(ALLERGIES, rng.randint(1, 2)),
+        random_timestamp(rng),
+    )
+
+
+def generate_patients(count, seed=0, max_records=5):
+    rng = random.Random(seed)
+    patients = []
+    for i in range(count):
+        # The index suffix keeps names unique, since HealthLinkSystem keys patients by name.
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}"
+        first = generate_record(rng)
+        patient = Patient(name, random_access_code(rng), first.condition, first.medications,
+                          first.allergies, first.timestamp)
+        for _ in range(rng.randint(0, max_records - 1)):
+            patient.add_medical_record_entry(generate_record(rng))
+        patient.update_location(rng.choice(CITIES))
+        patients.append(patient)
+    return patients
+
+
+def generate_staff(count, seed=0):
+    rng = random.Random(seed + 1)
+    return [{'name': f"staff{i}", 'password': ''.join(rng.choices(string.ascii_letters, k=12))}
+            for i in range(count)]
+
+
+def generate_appointments(patients, fraction=0.3, seed=0):
+    rng = random.Random(seed + 2)
+    appointments = {}
+    for patient in patients:
+        if rng.random() < fraction:
+            appointments[patient.name] = (datetime(2026, 1, 1) + timedelta(days=rng.randrange(365))).strftime("%Y-%m-%d")
+    return appointments
+
+
+def generate_facilities(count, seed=0, spread_degrees=0.5):
+    """Facilities scattered around CITIES, about ``spread_degrees`` either way of each city centre."""
+    rng = random.Random(seed + 3)
+    facilities = []
+    for i in range(count):
+        city = rng.choice(CITIES)
+        latitude, longitude = CITY_COORDINATES[city]
+        kind = rng.choice(FACILITY_TYPES)
+        facilities.append(Facility(
+            f"{city} {kind} {i}", kind,
+            round(latitude + rng.uniform(-spread_degrees, spread_degrees), 5),
+            round(longitude + rng.uniform(-spread_degrees, spread_degrees), 5),
+            city, rng.sample(FACILITY_SERVICES, rng.randint(1, 4)),
+            f"+91 {rng.randrange(10 ** 9, 10 ** 10)}",
+        ))
+    return facilities
+
+
+def write_facilities_csv(count, seed=0, path=os.path.join("medilink_data", "facilities.csv")):
+    FacilityRegistry(generate_facilities(count, seed)).save(path)
+
+
+def build_system(count, seed=0, staff_count=None, start_backup=False):
+    """Return a HealthLinkSystem populated in memory; the caller picks the working directory."""
+    system = HealthLinkSystem(start_backup=start_backup)
+    providers = [system.register_provider(name, 'password') for name in PROVIDER_NAMES]
+    patients = generate_patients(count, seed)
+    for i, patient in enumerate(patients):
+        system.add_patient(patient, providers[i % len(providers)])
+    system.staff_profiles = generate_staff(staff_count if staff_count is not None else max(10, count // 100), seed)
+    system.appointment_reminders = generate_appointments(patients, seed=seed)
+    return system
+
+
+def build_healthlink_system(patients):
+    """Mirror ``patients`` into the console HealthLink.py system, split across its two providers."""
+    import HealthLink
+
+    system = HealthLink.HealthLinkSystem()
+    providers = [system.register_provider(name) for name in PROVIDER_NAMES]
+    for i, patient in enumerate(patients):
+        first = patient.medical_records[0]
+        system.register_patient(patient.name, patient.access_code, first.condition, first.medications,
+                                first.allergies, first.timestamp, providers[i % len(providers)])
+    return system
+
+
+def record_to_legacy_dict(record):
+    return {
+        'condition': record.condition,
+        'medications': record.medications,
+        'allergies': record.allergies,
+        'timestamp': record.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def patient_to_legacy_dict(patient):
+    return {
+        'name': patient.name,
+        'access_code': patient.access_code,
+        'medical_records': [record_to_legacy_dict(record) for record in patient.medical_records],
+    }
+
+
+def write_patients_json(patients, path='patients.json'):
+    with open(path, 'w') as f:
+        json.dump({patient.name: patient_to_legacy_dict(patient) for patient in patients}, f)
+
+
+def write_patient_record_files(patients, root=os.path.join("medilink_data", "Patient_Records")):
+    for patient in patients:
+        patient_folder = os.path.join(root, patient.name)
+        os.makedirs(patient_folder, exist_ok=True)
+        with open(os.path.join(patient_folder, "2026-01-01_00-00-00.json"), 'w') as f:
+            json.dump(patient_to_legacy_dict(patient), f)
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # HealthLinkSystem reads and writes its files relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    for name in ('MEDILINK_STORAGE_FORMAT', 'MEDILINK_TERMINAL_ID'):
+        monkeypatch.delenv(name, raising=False)
+    return tmp_path
+
+
+@pytest.fixture
+def system(workdir):
+    import synthetic_data
+
+    system = synthetic_data.build_system(20)
+    system.save_data()
+    return system
@@ -0,0 +1,94 @@
+from access_control import AccessGuard
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Lookup:
+    def __init__(self, codes):
+        self.codes = codes
+        self.calls = 0
+
+    def __call__(self, access_code):
+        self.calls += 1
+        return self.codes.get(access_code)
+
+
+def make_guard():
+    clock = Clock()
+    return AccessGuard(capacity=3, refill_per_second=1.0, negative_ttl=30.0, clock=clock), clock
+
+
+def test_wrong_codes_empty_the_bucket():
+    guard, clock = make_guard()
+    lookup = Lookup({'GOOD': 'patient'})
+    for code in ('BAD1', 'BAD2', 'BAD3'):
+        assert guard.verify('terminal', code, lookup) is None
+    assert lookup.calls == 3
+
+    # Refused before any lookup, even for the right code
+    assert guard.verify('terminal', 'GOOD', lookup) is None
+    assert lookup.calls == 3
+    assert guard.retry_after('terminal') == 1.0
+
+    clock.now += 1.0
+    assert guard.verify('terminal', 'GOOD', lookup) == 'patient'
+
+
+def test_correct_codes_cost_nothing():
+    guard, _ = make_guard()
+    lookup = Lookup({'GOOD': 'patient'})
+    for _ in range(10):
+        assert guard.verify('terminal', 'GOOD', lookup) == 'patient'
+    assert guard.retry_after('terminal') == 0.0
+
+
+def test_clients_have_separate_buckets():
+    guard, _ = make_guard()
+    lookup = Lookup({'GOOD': 'patient'})
+    for code in ('BAD1', 'BAD2', 'BAD3'):
+        guard.verify('terminal-1', code, lookup)
+    assert guard.verify('terminal-1', 'GOOD', lookup) is None
+    assert guard.verify('terminal-2', 'GOOD', lookup) == 'patient'
+
+
+def test_repeated_wrong_code_skips_lookup():
+    guard, clock = make_guard()
+    lookup = Lookup({})
+    guard.verify('terminal', 'BAD', lookup)
+    clock.now += 5.0
+    assert guard.verify('terminal', 'BAD', lookup) is None
+    assert lookup.calls == 1
+
+    clock.now += 30.0
+    guard.verify('terminal', 'BAD', lookup)
+    assert lookup.calls == 2
+
+
+def test_forget_code_clears_the_negative_cache():
+    guard, _ = make_guard()
+    lookup = Lookup({})
+    guard.verify('terminal', 'NEW', lookup)
+    lookup.codes['NEW'] = 'patient'
+    guard.forget_code('NEW')
+    assert guard.verify('terminal', 'NEW', lookup) == 'patient'
+
+
+def test_portal_limit_survives_logging_out(system, monkeypatch, capsys):
+    from MediLink1 import verify_access_code
+
+    monkeypatch.setenv('MEDILINK_TERMINAL_ID', 'kiosk-1')
+    # Each call is a fresh portal session, as after logging out and in again
+    results = [verify_access_code(system, f'WRONG{i}') for i in range(12)]
+    assert results == [None] * 12
+    assert 'Too many access attempts' in capsys.readouterr().out
+    code = next(iter(system.directory.patients))
+    assert verify_access_code(system, code) is None
+
+    monkeypatch.setenv('MEDILINK_TERMINAL_ID', 'kiosk-2')
+    assert verify_access_code(system, code) is not None
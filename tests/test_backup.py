@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import backup
+import codec
+from MediLink1 import HealthLinkSystem
+
+
+def patient_dicts(system):
+    system.load_all_patients()
+    return sorted((codec.patient_to_dict(patient) for patient in system.patients.values()),
+                  key=lambda data: data['access_code'])
+
+
+def test_create_and_verify(system):
+    path = backup.create_backup(system)
+    manifest = backup.verify_backup(path)
+    assert manifest['chunks']['patients'] == 1
+    assert manifest['change_sequence'] == system.changes.sequence
+    assert backup.list_backups() == [path]
+
+
+def test_verify_detects_corruption(system):
+    path = backup.create_backup(system)
+    with open(path, 'r+b') as f:
+        f.seek(len(backup.MAGIC) + backup.CHUNK_HEADER.size + 4)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    with pytest.raises(backup.BackupError):
+        backup.verify_backup(path)
+
+
+def test_restore_replaces_later_changes(system):
+    expected = patient_dicts(system)
+    path = backup.create_backup(system)
+    doomed = next(iter(system.directory.patients.values()))
+    system.delete_patient(doomed.access_code)
+    system.save_data()
+
+    backup.restore_backup(path)
+
+    restored = HealthLinkSystem(start_backup=False)
+    assert patient_dicts(restored) == expected
+    assert not os.path.exists(backup.RESTORE_JOURNAL)
+    assert not [name for name in os.listdir('.') if name.endswith('.tmp')]
+
+
+def test_failed_restore_leaves_data_alone(system):
+    path = backup.create_backup(system)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 10)
+    with open('patients.json', 'rb') as f:
+        before = f.read()
+
+    with pytest.raises(backup.BackupError):
+        backup.restore_backup(path)
+
+    with open('patients.json', 'rb') as f:
+        assert f.read() == before
+    assert not [name for name in os.listdir('.') if name.endswith('.tmp')]
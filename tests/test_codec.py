@@ -0,0 +1,66 @@
+import io
+import json
+from datetime import datetime
+
+import codec
+import synthetic_data
+from MediLink1 import MedicalRecordEntry, Patient
+
+
+def sample_patients():
+    patients = synthetic_data.generate_patients(30, seed=7)
+    odd = patients[0]
+    typed = MedicalRecordEntry('Asthma', [], ['Dust'], 'last spring')
+    typed.url = 'https://example.org/a'
+    odd.medical_records.append(typed)
+    odd.medical_records.append(MedicalRecordEntry('Flu', ['Paracetamol'], [], None))
+    odd.email = 'patient@example.org'
+    odd.medication_reminders = [{'medication': 'Aspirin', 'frequency': 'daily'}]
+    odd.appointments = [{'date': '2024-05-01', 'provider': 'City Hospital'}]
+    return patients
+
+
+def as_dicts(patients):
+    return [codec.patient_to_dict(patient) for patient in patients]
+
+
+def test_json_round_trip():
+    patients = sample_patients()
+    f = io.StringIO()
+    codec.dump_json(patients, f)
+    f.seek(0)
+    loaded = codec.load_json(f, Patient, MedicalRecordEntry)
+    assert as_dicts(loaded.values()) == as_dicts(patients)
+
+
+def test_binary_round_trip():
+    patients = sample_patients()
+    f = io.BytesIO()
+    codec.dump_binary(patients, f)
+    f.seek(0)
+    loaded = codec.load_binary(f, Patient, MedicalRecordEntry)
+    assert as_dicts(loaded.values()) == as_dicts(patients)
+    assert loaded[patients[0].name].medical_records[-2].timestamp == 'last spring'
+
+
+def test_legacy_json_loads():
+    legacy = {'Jane Doe': {
+        'name': 'Jane Doe',
+        'access_code': 'ABC12345',
+        'medical_records': [{'condition': 'Asthma', 'medications': ['Salbutamol'], 'allergies': [],
+                             'timestamp': '2021-03-04 05:06:07'}],
+    }}
+    loaded = codec.load_json(io.StringIO(json.dumps(legacy)), Patient, MedicalRecordEntry)
+    record = loaded['Jane Doe'].medical_records[0]
+    assert record.timestamp == datetime(2021, 3, 4, 5, 6, 7)
+    assert loaded['Jane Doe'].medication_reminders == []
+
+
+def test_newer_schema_is_refused():
+    data = json.dumps({'schema_version': codec.SCHEMA_VERSION + 1, 'patients': {}})
+    try:
+        codec.load_json(io.StringIO(data), Patient, MedicalRecordEntry)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a newer schema version loaded")
@@ -0,0 +1,75 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from MediLink1 import HealthLinkSystem, Patient
+
+HISTORY_PATH = os.path.join("medilink_data", "record_history.jsonl")
+CHANGES_PATH = os.path.join("medilink_data", "changes.jsonl")
+
+
+def read_file(path):
+    if not os.path.exists(path):
+        return ''
+    with open(path) as f:
+        return f.read()
+
+
+def first_patient(system):
+    return next(iter(system.directory.patients.values()))
+
+
+def test_rollback_undoes_changes_and_writes_nothing(system):
+    patient = first_patient(system)
+    count = len(patient.medical_records)
+    conditions = [record.condition for record in patient.medical_records]
+    system.update_medical_record(patient, 0, condition='Committed')
+    history = read_file(HISTORY_PATH)
+    changes = read_file(CHANGES_PATH)
+    trail = system.record_audit_trail(patient)
+
+    with pytest.raises(RuntimeError):
+        with system.transaction():
+            system.add_medical_record(patient.access_code, 'Flu', ['Aspirin'], [])
+            system.update_medical_record(patient, count, condition='Changed')
+            system.update_medical_record(patient, 0, condition='Other')
+            raise RuntimeError("abort")
+
+    assert len(patient.medical_records) == count
+    assert [record.condition for record in patient.medical_records] == ['Committed'] + conditions[1:]
+    assert read_file(HISTORY_PATH) == history
+    assert read_file(CHANGES_PATH) == changes
+    assert system.record_audit_trail(patient) == trail
+
+
+def test_rolled_back_add_patient_emits_no_events(system):
+    changes = read_file(CHANGES_PATH)
+
+    with pytest.raises(RuntimeError):
+        with system.transaction():
+            system.add_patient(Patient("Ghost Person", "GHOST001", "Flu", [], [], datetime.now()))
+            raise RuntimeError("abort")
+
+    assert system.directory.get("GHOST001") is None
+    assert "Ghost Person" not in system.patients
+    assert read_file(CHANGES_PATH) == changes
+
+
+def test_commit_saves_once_and_writes_logs(system):
+    patient = first_patient(system)
+    count = len(patient.medical_records)
+
+    with system.transaction():
+        system.add_medical_record(patient.access_code, 'Flu', ['Aspirin'], [])
+        system.update_medical_record(patient, count, condition='Influenza')
+
+    events = [json.loads(line) for line in read_file(CHANGES_PATH).splitlines()]
+    assert [event['type'] for event in events[-2:]] == ['record_added', 'record_updated']
+    assert all(event['access_code'] == patient.access_code for event in events[-2:])
+    reloaded = HealthLinkSystem(start_backup=False)
+    reloaded.load_all_patients()
+    records = reloaded.directory.get(patient.access_code).medical_records
+    assert len(records) == count + 1
+    assert records[-1].condition == 'Influenza'
@@ -0,0 +1,120 @@
+"""Medical records in time order.
+
+Record timestamps are datetimes, ISO strings, or whatever was typed at
+HealthLink.py's optional timestamp prompt. normalize_timestamp reads the usual
+spellings of a date; anything else counts as undated.
+
+PatientTimeline keeps one patient's dated records sorted by time, inserting
+with bisect, so "latest condition" or "records in the last 90 days" is a
+bisect and a slice instead of a scan. ChangeIndex keeps every record in the
+system sorted by when it was last added or edited, for "what changed since T".
+"""
+import bisect
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from codec import parse_timestamp
+
+# Day first where it is ambiguous, like the rest of the data
+TEXT_FORMATS = (
+    "%Y-%m-%d %H:%M", "%Y/%m/%d", "%d/%m/%Y %H:%M", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y",
+    "%d %B %Y", "%d %b %Y", "%B %d, %Y", "%b %d, %Y", "%B %d %Y", "%b %d %Y",
+)
+
+
+def naive(value):
+    # Aware times (e.g. from the web app) become local time, which is what every other record holds
+    return value.astimezone().replace(tzinfo=None) if value.tzinfo is not None else value
+
+
+@lru_cache(maxsize=65536)
+def parse_text(text):
+    parsed = parse_timestamp(text)
+    if isinstance(parsed, datetime):
+        return naive(parsed)
+    for fmt in TEXT_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def normalize_timestamp(value):
+    """A naive datetime for a record timestamp, or None if it is missing or not a date."""
+    if isinstance(value, datetime):
+        return naive(value)
+    if isinstance(value, str) and value.strip():
+        return parse_text(value.strip())
+    return None
+
+
+class PatientTimeline:
+    def __init__(self, records=()):
+        dated = []
+        self.undated = []
+        for record in records:
+            when = normalize_timestamp(record.timestamp)
+            if when is None:
+                self.undated.append(record)
+            else:
+                dated.append((when, record))
+        # Stable, so records with the same time keep their stored order
+        dated.sort(key=lambda item: item[0])
+        self.times = [when for when, _ in dated]
+        self.records = [record for _, record in dated]
+
+    def __len__(self):
+        return len(self.records) + len(self.undated)
+
+    def __iter__(self):
+        """Dated records oldest first, then the undated ones."""
+        yield from self.records
+        yield from self.undated
+
+    def add(self, record):
+        when = normalize_timestamp(record.timestamp)
+        if when is None:
+            self.undated.append(record)
+            return
+        position = bisect.bisect_right(self.times, when)
+        self.times.insert(position, when)
+        self.records.insert(position, record)
+
+    def latest(self):
+        return self.records[-1] if self.records else None
+
+    def between(self, start=None, end=None):
+        """Dated records with ``start`` <= time <= ``end``, oldest first; either bound may be None."""
+        low = bisect.bisect_left(self.times, start) if start is not None else 0
+        high = bisect.bisect_right(self.times, end) if end is not None else len(self.times)
+        return self.records[low:high]
+
+    def last_days(self, days, now=None):
+        return self.between((now or datetime.now()) - timedelta(days=days))
+
+
+class ChangeIndex:
+    """(time changed, access code, record) for every record, sorted by time.
+
+    Entries are never removed: an edited or deleted record simply stops being
+    current, and HealthLinkSystem skips such entries when it answers a query.
+    """
+
+    def __init__(self, entries=()):
+        entries = sorted(entries, key=lambda entry: entry[0])
+        self.times = [entry[0] for entry in entries]
+        self.entries = [entry[1:] for entry in entries]
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, when, access_code, record, archived=False):
+        position = bisect.bisect_right(self.times, when)
+        self.times.insert(position, when)
+        self.entries.insert(position, (access_code, record, archived))
+
+    def since(self, when):
+        """[(time, access code, record, archived)] changed at or after ``when``, oldest first."""
+        start = bisect.bisect_left(self.times, when)
+        return [(self.times[i],) + self.entries[i] for i in range(start, len(self.times))]
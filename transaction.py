@@ -0,0 +1,140 @@
+"""Batched mutations for HealthLinkSystem.
+
+A Transaction collects an undo action for every mutation made inside
+``HealthLinkSystem.transaction()``, the lines its changes append to the
+record history and change feed, and hooks that should only run once the
+batch is committed. The system writes its files once at commit as one
+FileGroup, so after a crash either every file is the new one or none is.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+
+class Transaction:
+    def __init__(self):
+        self.undo_log = []
+        self.commit_hooks = []
+        self.dirty = False
+        self.owner = threading.get_ident()
+        # log name -> lines held back until commit; other threads' writes never land here
+        self.buffers = {}
+
+    def buffer(self, name):
+        return self.buffers.setdefault(name, [])
+
+    def add_undo(self, action):
+        self.undo_log.append(action)
+
+    def add_commit_hook(self, hook):
+        self.commit_hooks.append(hook)
+
+    def rollback(self):
+        undo_log, self.undo_log = self.undo_log, []
+        # Undo in reverse so each action sees the state its mutation left behind.
+        for action in reversed(undo_log):
+            action()
+        # Undo actions go through the same methods, whose own undo entries and hooks must not survive
+        self.undo_log = []
+        self.commit_hooks = []
+
+    def run_commit_hooks(self):
+        hooks, self.commit_hooks = self.commit_hooks, []
+        for hook in hooks:
+            hook()
+
+
+@contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    """Write to a temporary file next to ``path`` and move it into place once complete."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class FileGroup:
+    """Replace several files together, e.g. everything one save writes.
+
+    Each file is written completely to ``<path>.tmp`` first. Writing the journal
+    that lists them is the commit point: the temporary files are then moved
+    into place and the journal removed. If the process dies after the commit,
+    recover_file_group() finishes the moves; before it, the old files stay.
+    """
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.paths = []
+        self.removals = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            for path in self.paths:
+                if os.path.exists(f"{path}.tmp"):
+                    os.remove(f"{path}.tmp")
+        return False
+
+    @contextmanager
+    def write(self, path, mode='w', **kwargs):
+        """Like atomic_write, but the file only replaces ``path`` when the whole group commits."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        try:
+            with open(temp_path, mode, **kwargs) as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.paths.append(path)
+
+    def remove(self, path):
+        """Delete ``path`` when the group commits, together with the files it replaces."""
+        self.removals.append(path)
+
+    def commit(self):
+        entries = self.paths + [{'remove': path} for path in self.removals]
+        with atomic_write(self.journal_path) as f:
+            json.dump(entries, f)
+        move_into_place(entries)
+        os.remove(self.journal_path)
+
+
+def recover_file_group(journal_path):
+    """Finish a FileGroup that committed but was interrupted before all its files were moved."""
+    if not os.path.exists(journal_path):
+        return
+    with open(journal_path, 'r') as f:
+        paths = json.load(f)
+    move_into_place(paths)
+    os.remove(journal_path)
+
+
+def move_into_place(paths):
+    # A path whose .tmp is gone was already moved before an interruption
+    for path in paths:
+        if isinstance(path, dict):
+            if os.path.exists(path['remove']):
+                os.remove(path['remove'])
+        elif os.path.exists(f"{path}.tmp"):
+            os.replace(f"{path}.tmp", path)
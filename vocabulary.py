@@ -0,0 +1,96 @@
+"""Normalized medication and allergy terms.
+
+Typed lists like "Aspirin,Ibuprofen", "aspirin ; ibuprofen" or "Aspirin, " all
+parse to ['Aspirin', 'Ibuprofen'], and so do stored lists such as
+['Aspirin,Ibuprofen'] written before terms were split. Each Vocabulary maps a
+term's normalized key (collapsed whitespace, case folded) to one shared display
+string, so every record that mentions a term references the same string object.
+"""
+import re
+import sys
+import threading
+
+SEPARATORS = re.compile(r"\s*[,;\n]+\s*")
+
+
+def term_key(term):
+    return ' '.join(term.split()).casefold()
+
+
+def split_terms(text):
+    """'Aspirin,ibuprofen ; ' -> ['Aspirin', 'ibuprofen']"""
+    return [' '.join(part.split()) for part in SEPARATORS.split(text or '') if part.strip()]
+
+
+class Vocabulary:
+    def __init__(self):
+        self.ids = {}
+        self.terms = []
+        # Exact spelling -> ids of the terms in it, so spellings seen before skip the split and the key computation.
+        self.spellings = {}
+        # The vocabularies are shared by every thread; new ids are handed out one at a time
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return term_key(term) in self.ids
+
+    def intern(self, term):
+        """Return the id of ``term``, adding it on first sight."""
+        key = term_key(term)
+        term_id = self.ids.get(key)
+        if term_id is None:
+            with self.lock:
+                # Another thread may have added it while this one waited
+                term_id = self.ids.get(key)
+                if term_id is None:
+                    display = ' '.join(term.split())
+                    if display.islower():
+                        display = display[0].upper() + display[1:]
+                    # The term goes in before its id is published, so readers never see an id without a term
+                    self.terms.append(sys.intern(display))
+                    term_id = self.ids[key] = len(self.terms) - 1
+        return term_id
+
+    def normalize(self, terms):
+        """Canonical display strings for ``terms`` (a list or typed text), without blanks or duplicates."""
+        if isinstance(terms, str):
+            terms = split_terms(terms)
+        spellings = self.spellings
+        normalized = []
+        for term in terms:
+            term_ids = spellings.get(term)
+            if term_ids is None:
+                # A list element can itself hold several terms, e.g. ['Aspirin,Ibuprofen'] from older data
+                term_ids = spellings[term] = tuple(self.intern(part) for part in split_terms(term))
+            for term_id in term_ids:
+                canonical = self.terms[term_id]
+                # Records list a handful of terms, so a list scan is cheaper than a set.
+                if canonical not in normalized:
+                    normalized.append(canonical)
+        return normalized
+
+
+# One vocabulary per process, shared by every system, menu and loader.
+MEDICATIONS = Vocabulary()
+ALLERGIES = Vocabulary()
+
+
+def parse_medications(text):
+    return MEDICATIONS.normalize(text)
+
+
+def parse_allergies(text):
+    return ALLERGIES.normalize(text)
+
+
+def normalize_record(record):
+    """Normalize a record's medications and allergies in place; True if either changed."""
+    medications = MEDICATIONS.normalize(record.medications)
+    allergies = ALLERGIES.normalize(record.allergies)
+    changed = medications != record.medications or allergies != record.allergies
+    record.medications = medications
+    record.allergies = allergies
+    return changed
@@ -0,0 +1,262 @@
+"""Two-way sync between the web app's data.json and the HealthLinkSystem stores.
+
+The web app keeps providers and patients in camelCase::
+
+    {"providers": [{"name": ..., "username": ..., "password": ..., "patients": [patient, ...]}],
+     "patients": [{"name": ..., "accessCode": ..., "medicalRecords": [{"condition": ..., "medications": [...],
+                                                                       "allergies": [...], "timestamp": ...}]}]}
+
+Patients are matched by access code. A patient's version is a digest of its
+name and its records, and the versions seen at the last sync are kept in
+medilink_data/web_sync.json. Comparing both sides with that baseline tells
+which side changed, so only changed patients are touched:
+
+* changed on one side only: the change is copied to the other side;
+* added on one side: the patient is added to the other;
+* deleted on one side and unchanged on the other: deleted on the other too;
+* changed on both: records added on the web are added to the backend, and the
+  backend's version is written back to the web.
+
+A web patient whose name belongs to another backend patient is not added,
+since the backend keys patients by name; it is reported and retried next time.
+
+Records are matched by content. The backend never deletes or rewrites a record
+because of the web, so a record edited on the web arrives as a new record and
+one deleted on the web is written back. Names and locations follow the backend
+once a patient exists there.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+from collections import Counter
+from datetime import datetime
+
+from codec import parse_timestamp
+from transaction import atomic_write
+
+DEFAULT_WEB_PATH = os.path.join("Medilink", "medilink_data", "data.json")
+STATE_PATH = os.path.join("medilink_data", "web_sync.json")
+AUTHOR = 'web-sync'
+
+
+class SyncReport:
+    def __init__(self):
+        self.patients_to_backend = 0
+        self.records_to_backend = 0
+        self.deleted_in_backend = 0
+        self.patients_to_web = 0
+        self.deleted_on_web = 0
+        self.conflicts = 0
+        self.name_clashes = 0
+
+    def __str__(self):
+        return (f"Backend: {self.patients_to_backend} patients and {self.records_to_backend} records added, "
+                f"{self.deleted_in_backend} patients deleted. Web: {self.patients_to_web} patients written, "
+                f"{self.deleted_on_web} deleted. {self.conflicts} patients changed on both sides, "
+                f"{self.name_clashes} web patients skipped because the backend has another patient of that name.")
+
+
+def web_timestamp(timestamp):
+    return timestamp.isoformat() if isinstance(timestamp, datetime) else (timestamp or '')
+
+
+def web_terms(terms):
+    # The web form splits on ", " but older entries may hold a single string
+    if isinstance(terms, str):
+        return [term.strip() for term in terms.split(',') if term.strip()]
+    return list(terms or [])
+
+
+def record_to_web(record):
+    return {
+        'condition': record.condition or '',
+        'medications': list(record.medications),
+        'allergies': list(record.allergies),
+        'timestamp': web_timestamp(record.timestamp),
+    }
+
+
+def record_from_web(data, record_cls):
+    timestamp = parse_timestamp(data.get('timestamp') or '') or datetime.now()
+    if isinstance(timestamp, datetime) and timestamp.tzinfo is not None:
+        # JavaScript writes UTC ("...Z"); the backend compares naive local times
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return record_cls(data.get('condition') or '', web_terms(data.get('medications')),
+                      web_terms(data.get('allergies')), timestamp)
+
+
+def record_key(data):
+    text = json.dumps([data.get('condition') or '', web_terms(data.get('medications')),
+                       web_terms(data.get('allergies')), data.get('timestamp') or ''])
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def version_of(name, record_keys):
+    return hashlib.sha1(json.dumps([name, record_keys]).encode('utf-8')).hexdigest()[:16]
+
+
+class Side:
+    """A patient as one side sees it: its record keys and version."""
+
+    def __init__(self, name, records):
+        self.name = name
+        self.records = records
+        self.keys = [record_key(record) for record in records]
+        self.version = version_of(name, self.keys)
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def sync(system, patient_cls, record_cls, records_of, web_path=DEFAULT_WEB_PATH, state_path=STATE_PATH):
+    """Bring data.json and the backend to the same patients; returns a SyncReport.
+
+    ``records_of(patient)`` gives all of a patient's records, archived ones included.
+    """
+    with system.lock:
+        return sync_locked(system, patient_cls, record_cls, records_of, web_path, state_path)
+
+
+def sync_locked(system, patient_cls, record_cls, records_of, web_path, state_path):
+    web = load_json(web_path, {})
+    web.setdefault('providers', [])
+    web.setdefault('patients', [])
+    baseline = load_json(state_path, {}).get('patients', {})
+    web_patients = {data['accessCode']: data for data in web['patients'] if data.get('accessCode')}
+    web_members = {}
+    for provider in web['providers']:
+        for data in provider.get('patients', []):
+            if data.get('accessCode'):
+                web_members.setdefault(data['accessCode'], []).append(provider.get('name'))
+
+    report = SyncReport()
+    backend_sides = {}
+
+    def backend_side(patient):
+        side = Side(patient.name, [record_to_web(record) for record in records_of(patient)])
+        backend_sides[patient.access_code] = side
+        return side
+
+    def add_web_records(patient, web_side, base):
+        # Only records that neither the backend nor the last sync had are new on the web
+        new = Counter(web_side.keys) - (Counter(base.get('records', [])) | Counter(backend_side(patient).keys))
+        for data, key in zip(web_side.records, web_side.keys):
+            if new[key] > 0:
+                new[key] -= 1
+                system.add_record_entry(patient, record_from_web(data, record_cls), author=AUTHOR)
+                report.records_to_backend += 1
+
+    updated_web = {}
+    with system.transaction():
+        for code in set(web_patients) | set(system.directory.patients) | set(baseline):
+            base = baseline.get(code, {})
+            data = web_patients.get(code)
+            patient = system.directory.get(code)
+            web_side = Side(data.get('name', ''), data.get('medicalRecords', [])) if data is not None else None
+            ours = backend_side(patient) if patient is not None else None
+            if data is not None and patient is not None:
+                if web_side.version == ours.version:
+                    continue
+                if web_side.version != base.get('version'):
+                    if ours.version != base.get('version'):
+                        report.conflicts += 1
+                    add_web_records(patient, web_side, base)
+                updated_web[code] = patient
+            elif data is not None:
+                if base and web_side.version == base.get('version'):
+                    updated_web[code] = None
+                    continue
+                if system.name_taken(web_side.name or "Anonymous Patient", code):
+                    # The backend stores patients by name; left out of the baseline so it is tried again
+                    report.name_clashes += 1
+                    continue
+                patient = new_patient(system, patient_cls, record_cls, code, data, web_members.get(code, []))
+                report.patients_to_backend += 1
+                report.records_to_backend += len(patient.medical_records)
+                updated_web[code] = patient
+            elif patient is not None:
+                if base and ours.version == base.get('version'):
+                    system.delete_patient(code)
+                    report.deleted_in_backend += 1
+                    backend_sides.pop(code, None)
+                    continue
+                updated_web[code] = patient
+        if report.patients_to_backend or report.deleted_in_backend:
+            # Adding and deleting patients does not save by itself
+            system.persist()
+
+    for code, patient in updated_web.items():
+        if patient is None:
+            web_patients.pop(code, None)
+            report.deleted_on_web += 1
+            continue
+        # Unknown keys the web app keeps on a patient are left as they are
+        data = dict(web_patients.get(code) or {})
+        data.update(name=patient.name, accessCode=code,
+                    medicalRecords=backend_side(patient).records)
+        if patient.location:
+            data['location'] = patient.location
+        web_patients[code] = data
+        report.patients_to_web += 1
+
+    if updated_web:
+        write_web(web, web_patients, system.directory, web_path)
+    state = {code: {'version': side.version, 'records': side.keys}
+             for code, side in backend_sides.items() if code in web_patients}
+    with atomic_write(state_path) as f:
+        json.dump({'synced_at': datetime.now().isoformat(), 'patients': state}, f)
+    return report
+
+
+def new_patient(system, patient_cls, record_cls, code, data, provider_names):
+    records = [record_from_web(record, record_cls) for record in data.get('medicalRecords', [])]
+    first = records[0] if records else record_cls('', [], [], datetime.now())
+    patient = patient_cls(data.get('name') or "Anonymous Patient", code, first.condition, first.medications,
+                          first.allergies, first.timestamp)
+    for record in records[1:]:
+        patient.add_medical_record_entry(record)
+    if data.get('location'):
+        patient.update_location(data['location'])
+    provider = next((p for p in system.providers if p.name in provider_names), None)
+    system.add_patient(patient, provider)
+    # Memberships are kept by provider name, so providers not registered in this run still get theirs
+    for provider_name in provider_names:
+        system.directory.attach(provider_name, patient)
+    return patient
+
+
+def write_web(web, web_patients, directory, path):
+    order = [data['accessCode'] for data in web['patients'] if data.get('accessCode') in web_patients]
+    listed = set(order)
+    order += [code for code in web_patients if code not in listed]
+    web['patients'] = [web_patients[code] for code in order]
+    for provider in web['providers']:
+        # The backend's memberships win for providers it knows; others keep their list
+        if provider.get('name') in directory.members:
+            codes = [patient.access_code for patient in directory.patients_of(provider['name'])]
+        else:
+            codes = [data.get('accessCode') for data in provider.get('patients', [])]
+        provider['patients'] = [web_patients[code] for code in codes if code in web_patients]
+    with atomic_write(path) as f:
+        json.dump(web, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sync the web app's data.json with the MediLink data.")
+    parser.add_argument('--web', default=DEFAULT_WEB_PATH, help="path of the web data.json")
+    args = parser.parse_args(argv)
+
+    from MediLink1 import HealthLinkSystem
+    system = HealthLinkSystem(start_backup=False)
+    print(system.sync_web_data(args.web))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())